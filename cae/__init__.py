@@ -1,5 +1,5 @@
 from cae.config import config
-from cae.controllers import bp_instance, bp_ingress, bp_image
+from cae.controllers import bp_instance, bp_ingress, bp_image, bp_session
 from madara.app import Madara
 
 app = Madara(config=config)
@@ -7,3 +7,4 @@ app = Madara(config=config)
 app.register_blueprint(bp_instance, url_prefix="/api/instance")
 app.register_blueprint(bp_image, url_prefix="/api/image")
 app.register_blueprint(bp_ingress, url_prefix="/api/ingress")
+app.register_blueprint(bp_session, url_prefix="/api/session")
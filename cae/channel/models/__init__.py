@@ -1,3 +1,11 @@
 from .connections import Connection, Client
 from .interface import SSHInterface
 from .interactive import InteractiveServer
+from .cache import instance_cache, container_cache
+from .relay import Session, relay_engine
+from .proxy import SSHConnection
+from .forward import forward_manager
+from .recorder import recorder
+from .audit import auditor
+from .registry import registry
+from .resize import resizer
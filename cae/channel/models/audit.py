@@ -0,0 +1,226 @@
+from cae.config import channel_config as config
+from cae.channel.utils import TtyIOParser
+from cae.models import audit
+from pretty_logging import pretty_logger
+import json
+import queue
+import threading
+import time
+import traceback
+
+
+class SessionAudit:
+    """
+    Command extraction state of one pty session, only touched by its
+    worker. The echo of the line being typed is parsed into the command
+    on enter, what follows is its output until the user types again.
+    """
+
+    def __init__(self, session, worker):
+        meta = session.client.request.meta
+        self.worker = worker
+        self.parser = TtyIOParser(width=meta.get("width", 80), height=meta.get("height", 24))
+        self.info = session_info(session)
+        self.input_data = []
+        self.input_size = 0
+        self.output_data = []
+        self.output_size = 0
+        self.command = None
+        self.date_command = None
+        self.lost = False
+
+    def feed(self, ts, code, data) -> dict:
+        """
+        :return a finished command record or None
+        """
+        if code == "r":
+            width, height = data
+            self.parser.screen.resize(lines=height, columns=width)
+            return None
+        if code == "o":
+            if self.command is None:
+                if self.input_size > config["AUDIT_OUTPUT_MAX"]:
+                    # no enter for long, e.g. a full screen program
+                    self.input_data, self.input_size = [], 0
+                self.input_data.append(data)
+                self.input_size += len(data)
+            elif self.output_size < config["AUDIT_OUTPUT_MAX"]:
+                self.output_data.append(data)
+                self.output_size += len(data)
+            return None
+        record = None
+        if self.command is not None:
+            # typing again, the previous command is done
+            record = self.finish()
+        if b"\r" in data:
+            command = self.parser.parse_input(self.input_data)
+            self.input_data, self.input_size = [], 0
+            if command:
+                self.command = command
+                self.date_command = ts
+        return record
+
+    def finish(self) -> dict:
+        if self.command is None:
+            return None
+        output = self.parser.parse_output(self.output_data)
+        record = dict(self.info)
+        record.update({
+            "command": self.command,
+            "output": output[:config["AUDIT_OUTPUT_MAX"]],
+            "timestamp": self.date_command,
+        })
+        if self.lost:
+            record["incomplete"] = True
+            self.lost = False
+        self.command = None
+        self.output_data, self.output_size = [], 0
+        return record
+
+
+class AuditWorker(threading.Thread):
+    """
+    Parses the sessions sharded to it, a session always lands on the same
+    worker so its chunks stay in order.
+    """
+
+    def __init__(self, name, auditor):
+        super().__init__(name=name, daemon=True)
+        self.queue = queue.Queue(maxsize=config["AUDIT_QUEUE_SIZE"])
+        self.auditor = auditor
+
+    def run(self):
+        records = []
+        last_flush = time.monotonic()
+        while True:
+            # batch like the recorder, waking per chunk would compete with the relay loops
+            time.sleep(config["AUDIT_BATCH_INTERVAL"])
+            for _ in range(config["AUDIT_BATCH"]):
+                try:
+                    session_audit, ts, code, data = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                try:
+                    if code == "exec":
+                        record = data
+                    elif code is None:
+                        record = session_audit.finish()
+                    else:
+                        record = session_audit.feed(ts, code, data)
+                except Exception:
+                    pretty_logger.error(traceback.format_exc())
+                    continue
+                if record:
+                    records.append(record)
+                time.sleep(0)
+            if records and (len(records) >= config["AUDIT_BATCH"]
+                            or time.monotonic() - last_flush >= config["AUDIT_FLUSH_INTERVAL"]):
+                last_flush = time.monotonic()
+                self.auditor.emit(records)
+                records = []
+
+
+class CommandAuditor:
+    """
+    Relay loops only enqueue a copy of the session bytes, the pyte
+    parsing runs on a few worker threads and the command records are
+    written in batches to a redis stream or a local file.
+    """
+
+    def __init__(self):
+        self.workers = []
+        self.lock = threading.Lock()
+        self.file_lock = threading.Lock()
+        self.sessions = 0
+        self.commands = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def start(self):
+        with self.lock:
+            if self.workers:
+                return
+            for i in range(config["AUDIT_WORKERS"]):
+                worker = AuditWorker("audit-{}".format(i), self)
+                worker.start()
+                self.workers.append(worker)
+
+    def new_audit(self, session):
+        """
+        :return a SessionAudit for pty sessions when auditing is enabled, else None.
+        An exec request is recorded right away, its command is known.
+        """
+        if not config["AUDIT_ENABLED"]:
+            return None
+        request = session.client.request
+        self.start()
+        if request.type == "exec":
+            record = session_info(session)
+            record.update({
+                "command": session.command,
+                "output": None,
+                "timestamp": time.time(),
+            })
+            worker = self.workers[hash(session.id) % len(self.workers)]
+            worker.queue.put((None, time.time(), "exec", record))
+            return None
+        if "term" not in request.meta:
+            return None
+        self.sessions += 1
+        worker = self.workers[hash(session.id) % len(self.workers)]
+        return SessionAudit(session, worker)
+
+    def feed(self, session_audit, code, data):
+        """
+        Called on the relay loop, never blocks.
+        """
+        try:
+            session_audit.worker.queue.put_nowait((session_audit, time.time(), code, bytes(data)))
+        except queue.Full:
+            session_audit.lost = True
+            self.dropped += 1
+
+    def resize(self, session_audit, width, height):
+        try:
+            session_audit.worker.queue.put_nowait((session_audit, time.time(), "r", (width, height)))
+        except queue.Full:
+            self.dropped += 1
+
+    def stop(self, session_audit):
+        # the last command is only complete when the session ends
+        session_audit.worker.queue.put((session_audit, time.time(), None, None))
+
+    def emit(self, records):
+        try:
+            if config["AUDIT_SINK"] == "redis":
+                audit.add_commands(records, maxlen=config["AUDIT_STREAM_MAXLEN"])
+            else:
+                lines = "".join(json.dumps(r, ensure_ascii=False) + "\n" for r in records)
+                with self.file_lock, open(config["AUDIT_FILE"], "a", encoding="utf-8") as f:
+                    f.write(lines)
+            self.commands += len(records)
+        except Exception as e:
+            self.failed += len(records)
+            pretty_logger.error("Write {} audit records failed: {}".format(len(records), e))
+
+    def stats(self):
+        return {
+            "sessions": self.sessions,
+            "commands": self.commands,
+            "queued": sum(w.queue.qsize() for w in self.workers),
+            "dropped": self.dropped,
+            "failed": self.failed,
+        }
+
+
+def session_info(session) -> dict:
+    return {
+        "session_id": session.id,
+        "instance_id": session.client.user.get("instance_id"),
+        "user": session.client.user.get("username"),
+        "remote_addr": session.client.addr[0],
+        "login_from": session.client.login_from,
+    }
+
+
+auditor = CommandAuditor()
@@ -0,0 +1,353 @@
+from cae.config import channel_config as config
+from cae.models import instance, redis_client
+from cae.services import docker_service
+from cae.channel.utils import ObjDict
+from docker.errors import NotFound
+from docker.models.containers import Container
+from pretty_logging import pretty_logger
+import threading
+import time
+
+
+class InstanceCache:
+    """
+    In-process index of instance name -> (instance id, {key blob: auth key line}).
+
+    Entries are dropped on the change notifications put_instance/del_instance
+    publish, the ttl only covers notifications lost while redis reconnects.
+    Failed (name, key) lookups are remembered for AUTH_NEGATIVE_TTL so
+    repeated attempts with a wrong key cost no redis round trip.
+    """
+
+    def __init__(self, ttl=None):
+        self.ttl = ttl if ttl is not None else config["INSTANCE_CACHE_TTL"]
+        self.entries = {}
+        self.failures = {}  # name -> {key blob: expire time}
+        self.lock = threading.Lock()
+        self.watcher = None
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+
+    def get(self, name):
+        entry = self.entries.get(name)
+        if entry and time.monotonic() - entry[2] < self.ttl:
+            self.hits += 1
+            return entry[0], entry[1]
+        self.misses += 1
+        instance_id, index = instance.get_auth_key_index(name)
+        if instance_id:
+            with self.lock:
+                self.entries[name] = (instance_id, index, time.monotonic())
+        return instance_id, index
+
+    def lookup(self, name, key_blob):
+        """
+        :return (instance id, auth key line, all auth key lines) or None
+        """
+        expire = self.failures.get(name, {}).get(key_blob)
+        if expire and expire > time.monotonic():
+            self.negative_hits += 1
+            return None
+        instance_id, index = self.get(name)
+        auth_key = index.get(key_blob) if instance_id else None
+        if not auth_key:
+            self.add_failure(name, key_blob)
+            return None
+        return instance_id, auth_key, list(index.values())
+
+    def add_failure(self, name, key_blob):
+        now = time.monotonic()
+        with self.lock:
+            if len(self.failures) >= config["AUTH_NEGATIVE_MAX"]:
+                self.failures = {n: {k: e for k, e in keys.items() if e > now} for n, keys in self.failures.items()}
+                self.failures = {n: keys for n, keys in self.failures.items() if keys}
+                if len(self.failures) >= config["AUTH_NEGATIVE_MAX"]:
+                    self.failures.clear()
+            self.failures.setdefault(name, {})[key_blob] = now + config["AUTH_NEGATIVE_TTL"]
+
+    def invalidate(self, name=None):
+        with self.lock:
+            if name is None:
+                self.entries.clear()
+                self.failures.clear()
+            else:
+                self.entries.pop(name, None)
+                # a key may have been added
+                self.failures.pop(name, None)
+
+    def start(self):
+        if self.watcher:
+            return
+        self.watcher = threading.Thread(target=self.watch, daemon=True, name="instance-cache")
+        self.watcher.start()
+
+    def watch(self):
+        while True:
+            pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+            try:
+                pubsub.subscribe(instance.instance_event_channel)
+                # anything may have changed while not subscribed
+                self.invalidate()
+                for msg in pubsub.listen():
+                    self.invalidate(msg["data"].decode())
+            except Exception as e:
+                pretty_logger.error("Instance cache watch error: {}".format(e))
+            finally:
+                pubsub.close()
+            time.sleep(1)
+
+    def stats(self):
+        return {
+            "instances": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "negative": len(self.failures),
+            "negative_hits": self.negative_hits,
+        }
+
+
+class ContainerCache:
+    """
+    In-process map of instance id -> running container, ip, state and sshd
+    capability. Docker events evict changed containers, the ttl only covers
+    events lost while the event stream reconnects.
+
+    entry:{
+        id string
+        container Container
+        info dict
+        ip string
+        status string
+    }
+
+    The sshd capability is kept apart by container id and only dropped when
+    the container process (re)starts or dies, so reconnects skip the probe.
+    A failed probe is only trusted for SSHD_NEGATIVE_TTL.
+    A `cae.sshd=true|false` image or container label skips it altogether.
+    The login shell of sshd-less containers is found once per image id,
+    or taken from a `cae.shell` image or container label.
+    The digest of the authorized_keys last pushed per container and user
+    and the parsed /etc/passwd follow the same lifetime. Directory
+    listings for sftp are also kept per user for SFTP_LISTING_TTL, writes
+    through the channel drop them.
+    """
+    container_actions = {"start", "restart", "die", "stop", "kill", "destroy", "pause", "unpause", "rename", "update"}
+    network_actions = {"connect", "disconnect"}
+    sshd_actions = {"start", "restart", "die", "destroy"}
+    started_actions = {"start", "restart"}
+
+    def __init__(self, ttl=None):
+        self.ttl = ttl if ttl is not None else config["CONTAINER_CACHE_TTL"]
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.watcher = None
+        self._dc = None
+        self.sshd = {}
+        self.no_sshd = {}  # container id -> expire time of a failed probe
+        self.public_keys = {}
+        self.passwd = {}
+        self.listings = {}
+        self.shells = {}  # (image id, configured shell) -> login shell, images do not change
+        self.start_listeners = []
+        self.hits = 0
+        self.misses = 0
+        self.sshd_probes = 0
+        self.shell_probes = 0
+
+    @property
+    def dc(self):
+        if self._dc is None:
+            self._dc = docker_service.get_docker_client(max_pool_size=config["DOCKER_POOL_SIZE"])
+        return self._dc
+
+    def get(self, instance_id):
+        entry = self.entries.get(instance_id)
+        if entry and time.monotonic() - entry.loaded < self.ttl:
+            self.hits += 1
+            return entry
+        self.misses += 1
+        try:
+            container: Container = self.dc.containers.get(instance_id)
+        except NotFound:
+            self.invalidate(instance_id)
+            return None
+        if container.labels.get("cae.app") != "true" or container.status != "running":
+            self.invalidate(instance_id)
+            return None
+        info = instance.inspec_to_info(container)
+        entry = ObjDict()
+        entry.update({
+            "id": container.id,
+            "container": container,
+            "info": info,
+            "ip": info.get("IP"),
+            "status": container.status,
+            "loaded": time.monotonic(),
+        })
+        with self.lock:
+            self.entries[instance_id] = entry
+        return entry
+
+    def has_sshd(self, entry: ObjDict) -> bool:
+        sshd = self.sshd.get(entry.id)
+        if sshd is not None:
+            return sshd
+        expire = self.no_sshd.get(entry.id)
+        if expire and expire > time.monotonic():
+            return False
+        hint = entry.container.labels.get("cae.sshd")
+        if hint in ("true", "false"):
+            sshd = hint == "true"
+        else:
+            self.sshd_probes += 1
+            sshd = docker_service.check_container_sshd(entry.container)
+            pretty_logger.info("{} sshd {}".format(entry.id, sshd))
+            if not sshd:
+                # sshd may still be starting or get installed later
+                self.no_sshd[entry.id] = time.monotonic() + config["SSHD_NEGATIVE_TTL"]
+                return False
+        self.sshd[entry.id] = sshd
+        self.no_sshd.pop(entry.id, None)
+        return sshd
+
+    def login_shell(self, entry: ObjDict) -> str:
+        """
+        First of the `cae.shell` label and EXEC_SHELLS present in the
+        container, stat by the archive api rather than a failing exec.
+        """
+        configured = entry.container.labels.get("cae.shell")
+        key = (entry.container.attrs.get("Image"), configured)
+        shell = self.shells.get(key)
+        if shell:
+            return shell
+        candidates = ([configured] if configured else []) + config["EXEC_SHELLS"]
+        for path in candidates:
+            self.shell_probes += 1
+            try:
+                docker_service.container_path_stat(entry.container, path)
+            except NotFound:
+                continue
+            shell = path
+            break
+        if not shell:
+            raise Exception("container no shell")
+        pretty_logger.info("{} login shell {}".format(entry.id, shell))
+        self.shells[key] = shell
+        return shell
+
+    def forget_shell(self, entry: ObjDict):
+        self.shells.pop((entry.container.attrs.get("Image"), entry.container.labels.get("cae.shell")), None)
+
+    def public_key_digest(self, container_id, username):
+        return self.public_keys.get((container_id, username))
+
+    def set_public_key_digest(self, container_id, username, digest):
+        self.public_keys[(container_id, username)] = digest
+
+    def forget_public_key(self, container_id, username=None):
+        with self.lock:
+            for key in [k for k in self.public_keys if k[0] == container_id and username in (None, k[1])]:
+                self.public_keys.pop(key, None)
+
+    def passwd_entries(self, container_id):
+        """
+        :return (file stat, {username: user info}) or None
+        """
+        return self.passwd.get(container_id)
+
+    def set_passwd_entries(self, container_id, stat, users):
+        self.passwd[container_id] = (stat, users)
+
+    def listing(self, container_id, path, uid):
+        """
+        :return {name: attributes} of a directory listed by uid within SFTP_LISTING_TTL or None
+        """
+        entry = self.listings.get((container_id, path), {}).get(uid)
+        if entry and time.monotonic() - entry[0] < config["SFTP_LISTING_TTL"]:
+            return entry[1]
+        return None
+
+    def set_listing(self, container_id, path, uid, entries):
+        # per user, what one may see is not what another may
+        with self.lock:
+            self.listings.setdefault((container_id, path), {})[uid] = (time.monotonic(), entries)
+
+    def forget_listing(self, container_id, path=None):
+        with self.lock:
+            if path is not None:
+                self.listings.pop((container_id, path), None)
+                return
+            for key in [k for k in self.listings if k[0] == container_id]:
+                self.listings.pop(key, None)
+
+    def on_container_start(self, fn):
+        """
+        Call fn(container id) from the event thread when a container
+        (re)starts, fn must not block.
+        """
+        self.start_listeners.append(fn)
+
+    def invalidate(self, instance_id=None):
+        with self.lock:
+            if instance_id is None:
+                self.entries.clear()
+                self.sshd.clear()
+                self.no_sshd.clear()
+                self.public_keys.clear()
+                self.passwd.clear()
+                self.listings.clear()
+            else:
+                self.entries.pop(instance_id, None)
+
+    def start(self):
+        if self.watcher:
+            return
+        self.watcher = threading.Thread(target=self.watch, daemon=True, name="container-cache")
+        self.watcher.start()
+
+    def watch(self):
+        while True:
+            try:
+                events = self.dc.events(decode=True, filters={"type": ["container", "network"]})
+                # anything may have changed while not watching
+                self.invalidate()
+                for event in events:
+                    self.on_event(event)
+            except Exception as e:
+                pretty_logger.error("Container cache watch error: {}".format(e))
+            time.sleep(1)
+
+    def on_event(self, event: dict):
+        action = event.get("Action", "")
+        actor = event.get("Actor", {})
+        if event.get("Type") == "container" and action in self.container_actions:
+            self.invalidate(actor.get("ID"))
+            if action in self.sshd_actions:
+                self.sshd.pop(actor.get("ID"), None)
+                self.no_sshd.pop(actor.get("ID"), None)
+                self.passwd.pop(actor.get("ID"), None)
+                self.forget_public_key(actor.get("ID"))
+                self.forget_listing(actor.get("ID"))
+            if action in self.started_actions:
+                for fn in self.start_listeners:
+                    try:
+                        fn(actor.get("ID"))
+                    except Exception as e:
+                        pretty_logger.error("Container start listener error: {}".format(e))
+        elif event.get("Type") == "network" and action in self.network_actions:
+            self.invalidate(actor.get("Attributes", {}).get("container"))
+
+    def stats(self):
+        return {
+            "containers": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "sshd_probes": self.sshd_probes,
+            "shells": len(self.shells),
+            "shell_probes": self.shell_probes,
+        }
+
+
+instance_cache = InstanceCache()
+container_cache = ContainerCache()
@@ -1,12 +1,17 @@
+import datetime
 import socket
+import threading
 import uuid
 from pretty_logging import pretty_logger
-from cae.channel.utils import ObjDict, SelectEvent
+from cae.channel.utils import ObjDict
+from .registry import registry
+from .resize import resizer
 
 
 class Connection(object):
     connections = {}
     clients_num = 0
+    lock = threading.Lock()
 
     def __init__(self, cid=None, sock=None, addr=None):
         if not cid:
@@ -18,6 +23,8 @@ class Connection(object):
         self.otp_auth = False
         self.login_from = 'ST'
         self.clients = {}
+        self.transport = None
+        self.date_start = datetime.datetime.utcnow()
 
     def __str__(self):
         return '<{} from {}>'.format(self.user, self.addr)
@@ -28,8 +35,10 @@ class Connection(object):
             login_from=self.login_from
         )
         client.connection_id = self.id
-        self.clients[tid] = client
-        self.__class__.clients_num += 1
+        with self.lock:
+            self.clients[tid] = client
+            self.__class__.clients_num += 1
+        registry.update_connection(self)
         pretty_logger.info("New client {} join, total {} now".format(
             client, self.__class__.clients_num
         ))
@@ -42,18 +51,21 @@ class Connection(object):
         return client
 
     def remove_client(self, tid):
-        client = self.get_client(tid)
-        if not client:
-            return
+        if hasattr(tid, 'get_id'):
+            tid = tid.get_id()
+        with self.lock:
+            client = self.clients.pop(tid, None)
+            if not client:
+                return
+            self.__class__.clients_num -= 1
+        registry.update_connection(self)
         client.close()
-        self.__class__.clients_num -= 1
-        self.clients.pop(tid, None)
         pretty_logger.info("Client {} leave, total {} now".format(
             client, self.__class__.clients_num
         ))
 
     def close(self):
-        clients_copy = self.clients.keys()
+        clients_copy = list(self.clients.keys())
         for tid in clients_copy:
             self.remove_client(tid)
         self.sock.close()
@@ -63,21 +75,36 @@ class Connection(object):
         if not cid:
             cid = str(uuid.uuid4())
         connection = cls(cid=cid, sock=sock, addr=addr)
-        cls.connections[cid] = connection
+        with cls.lock:
+            cls.connections[cid] = connection
+        registry.update_connection(connection)
         return connection
 
     @classmethod
     def remove_connection(cls, cid):
-        connection = cls.get_connection(cid)
+        with cls.lock:
+            connection = cls.connections.pop(cid, None)
         if not connection:
             return
         connection.close()
-        cls.connections.pop(cid, None)
+        registry.remove_connection(cid)
 
     @classmethod
     def get_connection(cls, cid):
         return cls.connections.get(cid)
 
+    def to_json(self):
+        user = self.user or {}
+        return {
+            "id": self.id,
+            "user": user.get("username"),
+            "instance_id": user.get("instance_id"),
+            "login_from": self.login_from,
+            "remote_addr": self.addr[0] if self.addr else None,
+            "clients": len(self.clients),
+            "date_start": self.date_start.strftime("%Y-%m-%d %H:%M:%S") + " +0000",
+        }
+
 
 class Request(object):
     def __init__(self):
@@ -108,11 +135,21 @@ class Client(object):
         self.request = Request()
         self.connection_id = None
         self.login_from = login_from
-        self.change_size_evt = SelectEvent()
+        self.request_evt = threading.Event()
+        self.session = None
+        self.line_editor = None  # net_input's, keeps type-ahead between prompts
 
     def fileno(self):
         return self.chan.fileno()
 
+    def resize(self):
+        """
+        Window changed, coalesced and applied off the relay loop.
+        """
+        session = self.session
+        if session and not session.is_finished:
+            resizer.request(session, self.request.meta['width'], self.request.meta['height'])
+
     def send(self, b):
         try:
             return self.chan.send(b)
@@ -124,6 +161,12 @@ class Client(object):
         b = s.encode()
         self.send(b)
 
+    def send_exit_status(self, status):
+        try:
+            self.chan.send_exit_status(status)
+        except (OSError, EOFError, socket.error) as e:
+            pretty_logger.error('Send exit status to client {} error: {}'.format(self, e))
+
     @property
     def closed(self):
         return self.chan.closed
@@ -1,15 +1,17 @@
-from cae.channel.utils import SelectEvent
+from cae.config import channel_config as config
+from cae.channel.utils import tune_socket
 from pretty_logging import pretty_logger
+from .relay import Session
+from .resize import resizer
 import uuid
-import datetime
-import selectors
 import socket
+import time
 from docker.models.containers import Container, ExecResult
 import traceback
 
 
 class ExecServer:
-    def __init__(self, client, asset, system_user, container: Container):
+    def __init__(self, client, asset, system_user, container: Container, shell="/bin/sh"):
         """
         asset:{
             origin:(ip,port)
@@ -17,6 +19,7 @@ class ExecServer:
         system_user:{
             destination:(ip,port)
         }
+        shell: login shell found by container_cache.login_shell
         """
         self.client = client
         self.asset: dict = asset
@@ -25,6 +28,9 @@ class ExecServer:
         self.connecting = True
         self.container = container
         self.exec_id = None
+        self.shell = shell
+        # ssh host 'cmd' runs through `sh -c`, with a tty only when the client asked for one
+        self.command = client.request.meta.get("command") if client.request.type == "exec" else None
 
     def proxy(self):
         self.server = self.get_server_conn()
@@ -36,7 +42,7 @@ class ExecServer:
             self.server.close()
             return
 
-        session = Session.new_session(self.client, self.server)
+        session = Session.new_session(self.client, self.server, kind="exec", command=self.command)
         if not session:
             msg = "Connect with api server failed"
             pretty_logger.error(msg)
@@ -44,50 +50,81 @@ class ExecServer:
             self.server.close()
             return
 
-        try:
-            session.bridge()
-        finally:
-            Session.remove_session(session.id)
+        session.on_finish(self.finish)
+        if not self.server.multiplexed:
+            # not waited for, the shell redraws its prompt on the SIGWINCH. A
+            # window change meanwhile replaces this size in the resizer
+            width, height = self.client.request.meta['width'], self.client.request.meta['height']
+            resizer.request(session, width, height)
+        session.bridge()
+
+    def finish(self, session):
+        Session.remove_session(session.id)
+        if self.command is not None:
+            self.server.close()
+            exit_code = self.exit_code()
+            if exit_code is not None:
+                self.client.send_exit_status(exit_code)
+        else:
             try:
                 self.server.send("exit\n".encode())
             except Exception as e:
                 pretty_logger.error(traceback.format_exc())
             self.server.close()
-            msg = 'Session end, total {} now'.format(
-                len(Session.sessions),
-            )
-            pretty_logger.info(msg)
+        msg = 'Session end, total {} now'.format(
+            len(Session.sessions),
+        )
+        pretty_logger.info(msg)
 
     def get_server_conn(self):
-        sock = self.exec_run(user=self.system_user.get("username"))
+        if self.command is not None:
+            tty = 'term' in self.client.request.meta
+            sock = self.exec_run(user=self.system_user.get("username"), tty=tty, command=self.command,
+                                 environment=self.client.request.meta.get('env') or None)
+        else:
+            tty = True
+            sock = self.exec_run(user=self.system_user.get("username"))
         if not hasattr(sock, "send"):
             sock = sock._sock
-        return Server(chan=sock, asset=self.asset, system_user=self.system_user, container=self.container, exec_id=self.exec_id)
+        if sock.family in (socket.AF_INET, socket.AF_INET6):
+            # docker over tcp rather than its unix socket
+            tune_socket(sock, config["TCP_KEEPALIVE"])
+        server = Server(chan=sock, asset=self.asset, system_user=self.system_user, container=self.container, exec_id=self.exec_id)
+        # without a tty docker frames stdout and stderr on the one stream
+        server.multiplexed = not tty
+        return server
+
+    def exit_code(self, attempts=10):
+        """
+        Exit code of the finished exec, docker may lag the stream close a little.
+        """
+        for _ in range(attempts):
+            try:
+                info = self.container.client.api.exec_inspect(self.exec_id)
+            except Exception as e:
+                pretty_logger.error("exec inspect error {} {}".format(self.exec_id, e))
+                return None
+            if not info.get("Running") and info.get("ExitCode") is not None:
+                return info.get("ExitCode")
+            time.sleep(0.05)
+        return None
 
     def exec_run(self, stdout=True, stderr=True, stdin=True, tty=True,
                  privileged=False, user='', detach=False, stream=False,
-                 sock=True, environment=None, workdir=None, demux=False):
-        for cmd in ["/bin/bash", "/bin/sh"]:
-            try:
-                resp = self.container.client.api.exec_create(
-                    self.container.id, cmd, stdout=stdout, stderr=stderr, stdin=stdin, tty=tty,
-                    privileged=privileged, user=user, environment=environment,
-                    workdir=workdir,
-                )
-
-                exec_output = self.container.client.api.exec_start(
-                    resp['Id'], detach=detach, tty=tty, stream=stream, socket=sock,
-                    demux=demux
-                )
-                self.exec_id = resp['Id']
-                # resize pty
-                width, height = self.client.request.meta['width'], self.client.request.meta['height']
-                self.container.client.api.exec_resize(self.exec_id, height=height, width=width)
-
-                return exec_output
-            except Exception as e:
-                pretty_logger.error("exec run error {} {}".format(self.container.id, cmd))
-        raise Exception("container no shell")
+                 sock=True, environment=None, workdir=None, demux=False, command=None):
+        cmd = [self.shell] if command is None else [self.shell, "-c", command]
+        api = self.container.client.api
+        resp = api.exec_create(
+            self.container.id, cmd, stdout=stdout, stderr=stderr, stdin=stdin, tty=tty,
+            privileged=privileged, user=user, environment=environment,
+            workdir=workdir,
+        )
+        self.exec_id = resp['Id']
+        exec_output = api.exec_start(
+            self.exec_id, detach=detach, tty=tty, stream=stream, socket=sock,
+            demux=demux
+        )
+        return exec_output
 
 
 class Server(object):
@@ -100,6 +137,7 @@ class Server(object):
         self._closed = False
         self.container = container
         self.exec_id = exec_id
+        self.multiplexed = False
 
     def fileno(self):
         return self.chan.fileno()
@@ -137,110 +175,3 @@ class Server(object):
 
     def __str__(self):
         return "server %s:%s" % (self.asset, self.system_user)
-
-
-class Session:
-    sessions = {}
-
-    def __init__(self, client, server):
-        self.id = str(uuid.uuid4())
-        self.client = client  # Master of the session, it's a client sock
-        self.server = server  # Server channel
-        self.date_start = datetime.datetime.utcnow()
-        self.date_end = None
-        self.is_finished = False
-        self.closed = False
-        self.sel = selectors.DefaultSelector()
-        self.stop_evt = SelectEvent()
-        self.date_last_active = datetime.datetime.utcnow()
-
-    @classmethod
-    def new_session(cls, client, server):
-        session = cls(client, server)
-        cls.sessions[session.id] = session
-        return session
-
-    @classmethod
-    def get_session(cls, sid):
-        return cls.sessions.get(sid)
-
-    @classmethod
-    def remove_session(cls, sid):
-        session = cls.get_session(sid)
-        if session:
-            session.close()
-            cls.sessions.pop(sid, None)
-
-    def bridge(self):
-        """
-        Bridge clients with server
-        :return:
-        """
-        pretty_logger.info("Start bridge session: {}".format(self.id))
-        self.sel.register(self.client, selectors.EVENT_READ)
-        self.sel.register(self.server, selectors.EVENT_READ)
-        self.sel.register(self.stop_evt, selectors.EVENT_READ)
-        self.sel.register(self.client.change_size_evt, selectors.EVENT_READ)
-        # self.resize_win_size()
-        while not self.is_finished:
-            events = self.sel.select(timeout=60)
-            if self.client.closed:
-                break
-            if self.server.closed:
-                break
-            for sock in [key.fileobj for key, _ in events]:
-                data = sock.recv(1024)
-                if sock == self.server:
-                    if len(data) == 0:
-                        msg = "Server close the connection"
-                        pretty_logger.info(msg)
-                        self.is_finished = True
-                        break
-                    self.date_last_active = datetime.datetime.utcnow()
-                    self.client.send(data)
-                elif sock == self.client:
-                    if len(data) == 0:
-                        msg = "Client close the connection: {}".format(self.client)
-                        pretty_logger.info(msg)
-                        self.is_finished = True
-                        break
-                    self.server.send(data)
-                elif sock == self.stop_evt:
-                    self.is_finished = True
-                    break
-                elif sock == self.client.change_size_evt:
-                    self.resize_win_size()
-        pretty_logger.info("Session stop event set: {}".format(self.id))
-
-    def resize_win_size(self):
-        width, height = self.client.request.meta['width'], self.client.request.meta['height']
-        # pretty_logger.info("Resize server chan size {}*{}".format(width, height))
-        self.server.resize_pty(width=width, height=height)
-
-    def close(self):
-        if self.closed:
-            pretty_logger.info("Session has been closed: {} ".format(self.id))
-            return
-        pretty_logger.info("Close the session: {} ".format(self.id))
-        self.is_finished = True
-        self.closed = True
-        self.date_end = datetime.datetime.utcnow()
-
-    def to_json(self):
-        return {
-            "id": self.id,
-            "user": "{}".format(self.client.user.username),
-            "asset": self.server.asset,
-            "system_user": self.server.system_user,
-            "login_from": self.client.login_from,
-            "remote_addr": self.client.addr[0],
-            "is_finished": self.is_finished,
-            "date_start": self.date_start.strftime("%Y-%m-%d %H:%M:%S") + " +0000",
-            "date_end": self.date_end.strftime("%Y-%m-%d %H:%M:%S") + " +0000" if self.date_end else None
-        }
-
-    def __str__(self):
-        return self.id
-
-    def __repr__(self):
-        return self.id
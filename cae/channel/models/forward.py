@@ -0,0 +1,280 @@
+from cae.config import channel_config as config
+from cae.channel.utils import ObjDict, SelectEvent, tune_socket
+from cae.models import instance
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from pretty_logging import pretty_logger
+from .cache import container_cache
+from .connections import Client
+from .direct import Server
+from .relay import Session
+import paramiko
+import datetime
+import selectors
+import socket
+import threading
+import traceback
+import uuid
+
+
+class RemoteForward:
+    """
+    One `ssh -R` listener, connections to it become forwarded-tcpip
+    channels back to the ssh client. Only the instance of the user may
+    connect, others are closed as they are accepted.
+    """
+
+    def __init__(self, connection, address, port, sock, peer):
+        self.id = str(uuid.uuid4())
+        self.connection = connection
+        self.address = address  # as requested, echoed in the forwarded-tcpip open
+        self.port = port  # bound port
+        self.sock = sock
+        self.peer = peer  # address of the instance on DOCKER_NETWORK
+        self.user_key = user_key(connection.user)
+        self.date_start = datetime.datetime.utcnow()
+        self.connections = 0
+        self.active = 0
+        self.rejected = 0
+        self.bytes_up = 0  # ssh client -> accepted connection
+        self.bytes_down = 0
+        self.closed = False
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def to_json(self):
+        return {
+            "id": self.id,
+            "user": self.user_key[1],
+            "instance_id": self.user_key[0],
+            "remote_addr": self.connection.addr[0],
+            "peer": self.peer,
+            "listen": "{}:{}".format(self.sock.getsockname()[0], self.port),
+            "connections": self.connections,
+            "active": self.active,
+            "rejected": self.rejected,
+            "bytes_up": self.bytes_up,
+            "bytes_down": self.bytes_down,
+            "date_start": self.date_start.strftime("%Y-%m-%d %H:%M:%S") + " +0000",
+        }
+
+
+class ForwardManager:
+    """
+    Listeners of every remote forward on one accept thread. Opening the
+    channel waits on the ssh client and runs on a small pool, the relay
+    engine carries the data like direct-tcpip sessions.
+
+    The channel can't listen inside an instance, so a forward listens on
+    the channel's own address facing the instance on DOCKER_NETWORK, the
+    requested bind address is ignored. The instance reaches its forward
+    there, connections from any other address are refused.
+    """
+
+    def __init__(self):
+        self.forwards = {}  # id -> RemoteForward
+        self.users = {}  # (instance id, username) -> listeners
+        self.lock = threading.Lock()
+        self.sel = selectors.DefaultSelector()
+        self.wakeup_evt = SelectEvent()
+        self.calls = deque()
+        self.thread = None
+        self.workers = None
+
+    def start(self):
+        with self.lock:
+            if self.thread:
+                return
+            self.workers = ThreadPoolExecutor(max_workers=config["FORWARD_WORKERS"], thread_name_prefix="forward")
+            self.sel.register(self.wakeup_evt, selectors.EVENT_READ)
+            self.thread = threading.Thread(target=self.run, daemon=True, name="forward-accept")
+            self.thread.start()
+
+    def call(self, fn, *args):
+        self.calls.append((fn, args))
+        self.wakeup_evt.set()
+
+    def add(self, connection, address, port):
+        """
+        Bind a listener for a tcpip-forward request, :return the bound port or False
+        """
+        key = user_key(connection.user)
+        if port and port < config["REMOTE_FORWARD_MIN_PORT"]:
+            pretty_logger.info("Remote forward {}:{} rejected, privileged port".format(address, port))
+            return False
+        peer = instance_address(key[0])
+        if not peer:
+            pretty_logger.info("Remote forward {}:{} rejected, {} has no address".format(address, port, key))
+            return False
+        with self.lock:
+            if len(self.forwards) >= config["REMOTE_FORWARD_MAX"]:
+                pretty_logger.warning("Remote forward {}:{} rejected, {} listeners open".format(address, port, len(self.forwards)))
+                return False
+            if self.users.get(key, 0) >= config["REMOTE_FORWARD_MAX_PER_USER"]:
+                pretty_logger.info("Remote forward {}:{} rejected, {} reached its listener limit".format(address, port, key))
+                return False
+            # reserve the slot while binding
+            self.users[key] = self.users.get(key, 0) + 1
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        bind_host = None
+        try:
+            bind_host = local_address(peer)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, True)
+            sock.bind((bind_host, port))
+            sock.listen(config["REMOTE_FORWARD_BACKLOG"])
+            sock.setblocking(False)
+        except OSError as e:
+            pretty_logger.info("Remote forward bind {}:{} failed: {}".format(bind_host, port, e))
+            sock.close()
+            self.release_user(key)
+            return False
+        forward = RemoteForward(connection, address, sock.getsockname()[1], sock, peer)
+        with self.lock:
+            self.forwards[forward.id] = forward
+        self.start()
+        self.call(self.sel.register, forward, selectors.EVENT_READ)
+        pretty_logger.info("Remote forward {} listen {}:{} for {}".format(key, bind_host, forward.port, peer))
+        return forward.port
+
+    def cancel(self, connection, address, port):
+        for forward in self.get_forwards(connection):
+            if forward.address == address and forward.port == port:
+                self.remove(forward)
+
+    def close_connection(self, connection):
+        for forward in self.get_forwards(connection):
+            self.remove(forward)
+
+    def get_forwards(self, connection=None) -> list:
+        with self.lock:
+            return [f for f in self.forwards.values() if connection is None or f.connection is connection]
+
+    def remove(self, forward):
+        with self.lock:
+            if self.forwards.pop(forward.id, None) is None:
+                return
+        self.release_user(forward.user_key)
+        forward.closed = True
+        self.call(self.unregister, forward)
+        pretty_logger.info("Remote forward {} closed {}".format(forward.user_key, forward.port))
+
+    def release_user(self, key):
+        with self.lock:
+            left = self.users.get(key, 0) - 1
+            if left > 0:
+                self.users[key] = left
+            else:
+                self.users.pop(key, None)
+
+    def unregister(self, forward):
+        try:
+            self.sel.unregister(forward)
+        except (KeyError, ValueError):
+            pass
+        forward.sock.close()
+
+    def run(self):
+        while True:
+            for key, _ in self.sel.select():
+                if key.fileobj is self.wakeup_evt:
+                    self.wakeup_evt.recv(1024)
+                    continue
+                self.accept(key.fileobj)
+            while self.calls:
+                fn, args = self.calls.popleft()
+                try:
+                    fn(*args)
+                except Exception:
+                    pretty_logger.error(traceback.format_exc())
+
+    def accept(self, forward):
+        while not forward.closed:
+            try:
+                sock, addr = forward.sock.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                pretty_logger.error("Remote forward accept error: {}".format(e))
+                return
+            if addr[0] != forward.peer:
+                forward.rejected += 1
+                pretty_logger.info("Remote forward {} refused {}, not {}".format(forward.port, addr[0], forward.peer))
+                sock.close()
+                continue
+            sock.setblocking(True)
+            tune_socket(sock, config["TCP_KEEPALIVE"])
+            forward.connections += 1
+            self.workers.submit(self.open, forward, sock, addr)
+
+    def open(self, forward, sock, addr):
+        transport = forward.connection.transport
+        try:
+            chan = transport.open_channel(
+                "forwarded-tcpip", (forward.address, forward.port), addr, timeout=config["SSH_TIMEOUT"],
+            )
+        except (paramiko.SSHException, EOFError, OSError) as e:
+            forward.rejected += 1
+            pretty_logger.info("Remote forward {} channel rejected: {}".format(forward.port, e))
+            sock.close()
+            return
+        client = Client(user=forward.connection.user, addr=addr, chan=chan)
+        client.connection_id = forward.connection.id
+        asset = ObjDict()
+        asset.update({"origin": addr})
+        system_user = ObjDict()
+        system_user.update({"destination": (forward.address, forward.port)})
+        server = Server(chan=sock, asset=asset, system_user=system_user)
+        session = Session.new_session(client, server, kind="forward")
+        forward.active += 1
+        session.on_finish(lambda s: self.finish(forward, client, server, s))
+        session.bridge()
+
+    @staticmethod
+    def finish(forward, client, server, session):
+        Session.remove_session(session.id)
+        forward.active -= 1
+        forward.bytes_up += session.bytes_up
+        forward.bytes_down += session.bytes_down
+        client.close()
+        server.close()
+
+    def stats(self):
+        forwards = self.get_forwards()
+        return {
+            "listeners": len(forwards),
+            "users": len(self.users),
+            "connections": sum(f.connections for f in forwards),
+            "active": sum(f.active for f in forwards),
+            "rejected": sum(f.rejected for f in forwards),
+        }
+
+
+def instance_address(instance_id):
+    """
+    :return the address of the running instance on DOCKER_NETWORK or None
+    """
+    entry = container_cache.get(instance_id) if instance_id else None
+    if entry is None:
+        return None
+    return instance.inspec_to_info(entry.container).get("IP")
+
+
+def local_address(peer) -> str:
+    """
+    :return the address of this host peer sends to, no packet is sent
+    """
+    probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        probe.connect((peer, 9))
+        return probe.getsockname()[0]
+    finally:
+        probe.close()
+
+
+def user_key(user) -> tuple:
+    user = user or {}
+    return user.get("instance_id"), user.get("username")
+
+
+forward_manager = ForwardManager()
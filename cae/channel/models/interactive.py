@@ -1,20 +1,18 @@
 import traceback
 from docker.models.containers import Container
-import docker.utils as dockerutils
 from cae.config import channel_config as config
-from cae.channel.utils import ObjDict
+from cae.channel.utils import ObjDict, get_host_key
 from cae.services import docker_service
-from cae.models import instance
 from pretty_logging import pretty_logger
-from .proxy import ProxyServer
+from .proxy import ProxyServer, SSHConnection
 from .direct import DirectServer
 from .exec import ExecServer
-from typing import List
-import shutil
-import tempfile
-import os
+from .sftp import SFTPServer
+from .cache import container_cache
+import hashlib
 import io
 import tarfile
+import time
 import socket
 import paramiko
 
@@ -25,52 +23,47 @@ class InteractiveServer:
     def __init__(self, client):
         self.client = client
         self.closed = False
-        self.dc = docker_service.get_docker_client()
 
     def __str__(self):
         return "interactive {}".format(self.client)
 
-    def proxy(self, container: Container):
+    def proxy(self, entry: ObjDict):
         """
         Proxy session
         """
-        instance_info = instance.inspec_to_info(container)
-        asset = ObjDict()
-        asset.update({
-            "ip": instance_info.get("IP"),
-            "ssh_port": 22,
-        })
-        system_user = ObjDict()
-        system_user.update({
-            "username": self.client.user.get("username"),
-            "password": None,
-            "private_key": paramiko.RSAKey.from_private_key_file(filename=config["HOST_PRIVATE_KEY"]),
-            "protocol": "ssh"
-        })
+        asset, system_user = upstream(entry, self.client.user.get("username"))
         forwarder = ProxyServer(self.client, asset, system_user)
-        forwarder.proxy()
-
-    def exec(self, container: Container):
+        try:
+            forwarder.proxy()
+        except paramiko.SSHException:
+            # authorized_keys may have changed inside the container, push it again next time
+            container_cache.forget_public_key(entry.id, system_user.username)
+            raise
+        recent_users.setdefault(entry.id, set()).add(system_user.username)
+
+    def exec(self, entry: ObjDict):
         """
         Proxy exec
         """
-        instance_info = instance.inspec_to_info(container)
-        asset = ObjDict()
-        asset.update({
-            "ip": instance_info.get("IP"),
-            "ssh_port": 22,
-        })
-        system_user = ObjDict()
-        system_user.update({
-            "username": self.client.user.get("username"),
-            "password": None,
-            "private_key": paramiko.RSAKey.from_private_key_file(filename=config["HOST_PRIVATE_KEY"]),
-            "protocol": "ssh"
-        })
-        forwarder = ExecServer(self.client, asset, system_user, container)
+        asset, system_user = upstream(entry, self.client.user.get("username"))
+        forwarder = ExecServer(self.client, asset, system_user, entry.container, shell=container_cache.login_shell(entry))
+        try:
+            forwarder.proxy()
+        except Exception:
+            # e.g. the shell was removed in a running container, look it up again next time
+            container_cache.forget_shell(entry)
+            raise
+
+    def sftp(self, entry: ObjDict):
+        """
+        sftp without sshd
+        """
+        asset, system_user = upstream(entry, self.client.user.get("username"))
+        userinfo = get_user_info(entry.container, system_user.username)
+        forwarder = SFTPServer(self.client, asset, system_user, entry.container, userinfo)
         forwarder.proxy()
 
-    def tunnel(self, container: Container):
+    def tunnel(self, entry: ObjDict):
         """
         Proxy tunnel
         """
@@ -85,10 +78,8 @@ class InteractiveServer:
 
         # check destination is instance self
         dest: tuple = self.client.request.meta.get("destination")
-        instance_info = instance.inspec_to_info(container)
-        instance_ip = instance_info.get("IP")
-        if dest[0] != instance_ip:
-            pretty_logger.error("{} tunnel destination ip {} error".format(container.id, dest[0]))
+        if dest[0] != entry.ip:
+            pretty_logger.error("{} tunnel destination ip {} error".format(entry.id, dest[0]))
             return
 
         forwarder = DirectServer(self.client, asset, system_user)
@@ -100,20 +91,16 @@ class InteractiveServer:
         """
         try:
             instance_id = self.client.user.get("instance_id")
-            cs: List[Container] = self.dc.containers.list(filters={
-                "label": ["cae.app=true"],
-                "id": instance_id
-            })
-            if not cs:
+            entry = container_cache.get(instance_id)
+            if not entry:
                 raise Exception("not found instance {}".format(instance_id))
-            container: Container = cs[0]
+            container: Container = entry.container
 
-            is_have_sshd = check_container_sshd(container)
+            is_have_sshd = container_cache.has_sshd(entry)
 
             if is_have_sshd:
                 public_keys = "\n".join(self.client.user.get("auth_keys", []))
-                with open(config["HOST_PUBLIC_KEY"]) as fd:
-                    public_keys = "{}\n{}\n".format(public_keys, fd.read())
+                public_keys = "{}\n{}\n".format(public_keys, host_public_key())
 
                 username = self.client.user.get("username")
                 ensure_public_key(container, username, public_keys)
@@ -126,16 +113,18 @@ class InteractiveServer:
         if kind == "session":
             try:
                 if is_have_sshd:
-                    self.proxy(container)
+                    self.proxy(entry)
+                elif self.client.request.type == "subsystem":
+                    self.sftp(entry)
                 else:
-                    self.exec(container)
+                    self.exec(entry)
             except socket.error as e:
                 pretty_logger.error("Socket error: {}".format(e))
             except Exception as e:
                 pretty_logger.error(traceback.format_exc())
         elif is_have_sshd and kind == "direct-tcpip":
             try:
-                self.tunnel(container)
+                self.tunnel(entry)
             except socket.error as e:
                 pretty_logger.error("Socket error: {}".format(e))
             except Exception as e:
@@ -150,47 +139,128 @@ class InteractiveServer:
         self.closed = True
 
 
-def ensure_public_key(container: Container, username, public_key):
+def upstream(entry: ObjDict, username) -> tuple:
+    """
+    :return (asset, system_user) of the container sshd for username
+    """
+    asset = ObjDict()
+    asset.update({
+        "ip": entry.ip,
+        "ssh_port": 22,
+    })
+    system_user = ObjDict()
+    system_user.update({
+        "username": username,
+        "password": None,
+        "private_key": host_private_key(),
+        "protocol": "ssh"
+    })
+    return asset, system_user
+
+
+# container id -> users proxied to it, connected ahead when it restarts
+recent_users = {}
+
+
+def prewarm(container_id):
+    """
+    Container (re)started, called from the docker event thread.
+    """
+    usernames = recent_users.get(container_id)
+    if usernames:
+        SSHConnection.submit(prewarm_container, container_id, list(usernames))
+
+
+def prewarm_container(container_id, usernames, attempts=5):
+    entry = container_cache.get(container_id)
+    if not entry:
+        recent_users.pop(container_id, None)
+        return
+    if not container_cache.has_sshd(entry):
+        return
+    for username in usernames:
+        asset, system_user = upstream(entry, username)
+        user = ObjDict()
+        user.update({"username": username})
+        # sshd may still be starting
+        for _ in range(attempts):
+            if SSHConnection.prewarm(user, asset, system_user):
+                break
+            time.sleep(1)
+
+
+if config["SSH_POOL_PREWARM"]:
+    container_cache.on_container_start(prewarm)
+
+
+def host_private_key():
+    private_key, _ = get_host_key(config["HOST_KEY_TYPE"], config["HOST_PRIVATE_KEY"], config["HOST_PUBLIC_KEY"])
+    return private_key
+
+
+def host_public_key():
+    _, public_key = get_host_key(config["HOST_KEY_TYPE"], config["HOST_PRIVATE_KEY"], config["HOST_PUBLIC_KEY"])
+    return public_key
+
+
+def ensure_public_key(container: Container, username, public_key) -> bool:
+    """
+    Push authorized_keys into the user home unless the same content was
+    already pushed to this container.
+
+    :return pushed or not
+    """
+    digest = hashlib.sha256(public_key.encode()).hexdigest()
+    if container_cache.public_key_digest(container.id, username) == digest:
+        return False
 
     userinfo = get_user_info(container, username)
+    uid, gid = int(userinfo.get("uid")), int(userinfo.get("gid"))
 
-    # create tar
-    data_dir = make_tree([".ssh"], [(".ssh/authorized_keys", public_key, 0o644)])
-    current_bts = dockerutils.tar(data_dir)
-
-    # update tarinfo uid/gid
+    # build tar in memory
+    data = public_key.encode()
+    mtime = time.time()
     out_bts = io.BytesIO()
-    out_tar = tarfile.open(mode="w", fileobj=out_bts)
-    with tarfile.open(fileobj=current_bts) as tarobj:
-        for info in tarobj:
-            info.uid = int(userinfo.get("uid"))
-            info.gid = int(userinfo.get("gid"))
-            out_tar.addfile(info, fileobj=tarobj.extractfile(info.name))
-    out_tar.close()
+    with tarfile.open(mode="w", fileobj=out_bts) as out_tar:
+        dir_info = tarfile.TarInfo(".ssh")
+        dir_info.type = tarfile.DIRTYPE
+        dir_info.mode = 0o755
+        key_info = tarfile.TarInfo(".ssh/authorized_keys")
+        key_info.size = len(data)
+        key_info.mode = 0o644
+        for info in (dir_info, key_info):
+            info.uid, info.gid, info.mtime = uid, gid, mtime
+        out_tar.addfile(dir_info)
+        out_tar.addfile(key_info, fileobj=io.BytesIO(data))
 
     # put tar
-    out_bts.seek(0)
-    container.put_archive(path=userinfo.get("home"), data=out_bts)
-
-    # clean tmp
-    current_bts.close()
-    out_bts.close()
-    shutil.rmtree(data_dir)
-
-
-def check_container_sshd(container: Container) -> bool:
-    try:
-        bts, stat = container.get_archive("/var/run/sshd.pid")
-        pretty_logger.info("{} sshd.pid {}".format(container.id, stat))
-        if stat.get("size") < 1:
-            raise Exception("container sshd.pid file if none {}".format(container.id))
-        return True
-    except Exception as e:
-        pretty_logger.error("{}".format(e))
-        return False
+    container.put_archive(path=userinfo.get("home"), data=out_bts.getvalue())
+    container_cache.set_public_key_digest(container.id, username, digest)
+    return True
 
 
 def get_user_info(container: Container, username) -> dict:
+    """
+    User info from the container /etc/passwd, parsed once per container.
+    An unknown username re-reads the file only if its size or mtime changed.
+    """
+    cached = container_cache.passwd_entries(container.id)
+    if cached:
+        stat, users = cached
+        if username in users:
+            return users[username]
+        current = docker_service.container_path_stat(container, "/etc/passwd")
+        if (current.get("size"), current.get("mtime")) != (stat.get("size"), stat.get("mtime")):
+            cached = None
+    if not cached:
+        stat, users = read_passwd(container)
+        container_cache.set_passwd_entries(container.id, stat, users)
+    if username in users:
+        return users[username]
+    raise Exception("not found user info {} {}".format(container.id, username))
+
+
+def read_passwd(container: Container) -> tuple:
     bts, stat = container.get_archive("/etc/passwd")
     if stat.get("size") < 1:
         raise Exception("container passwd file if none {}".format(container.id))
@@ -198,33 +268,18 @@ def get_user_info(container: Container, username) -> dict:
     for chunk in bts:
         passwd_tar.write(chunk)
     passwd_tar.seek(0)
+    users = {}
     with tarfile.open(fileobj=passwd_tar) as tar_obj:
         for item in tar_obj.extractfile("passwd").readlines():
             line = item.decode().strip().split(":")
-            if line[0] == username:
-                passwd_tar.close()
-                return {
-                    "username": username,
-                    "uid": line[2],
-                    "gid": line[3],
-                    "home": line[-2],
-                    "shell": line[-1]
-                }
+            if len(line) < 7 or line[0] in users:
+                continue
+            users[line[0]] = {
+                "username": line[0],
+                "uid": line[2],
+                "gid": line[3],
+                "home": line[-2],
+                "shell": line[-1]
+            }
     passwd_tar.close()
-    raise Exception("not found user info {} {}".format(container.id, username))
-
-
-def make_tree(dirs, files):
-    base = tempfile.mkdtemp()
-
-    for path in dirs:
-        the_path = os.path.join(base, path)
-        os.makedirs(the_path)
-
-    for path, data, mode in files:
-        the_path = os.path.join(base, path)
-        with open(the_path, 'w') as f:
-            f.write(data)
-        os.chmod(the_path, mode)
-
-    return base
+    return stat, users
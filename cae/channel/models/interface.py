@@ -1,8 +1,9 @@
 import paramiko
-import threading
 from pretty_logging import pretty_logger
-from cae.models import instance
-from cae.channel.utils import parser_public_key
+from cae.config import channel_config as config
+from .cache import instance_cache
+from .forward import forward_manager
+from .limiter import auth_failure_limiter
 
 
 class SSHInterface(paramiko.ServerInterface):
@@ -15,7 +16,6 @@ class SSHInterface(paramiko.ServerInterface):
 
     def __init__(self, connection):
         self.connection = connection
-        self.event = threading.Event()
         self.user = None
 
     def enable_auth_gssapi(self):
@@ -46,33 +46,30 @@ class SSHInterface(paramiko.ServerInterface):
     def validate_auth(self, username: str, password="", public_key=""):
         remote_addr = self.connection.addr[0]
 
-        ins_name, ins_user = username.split(":")
+        ins_name, _, ins_user = username.partition(":")
         if not ins_name or not ins_user:
             pretty_logger.info("validate username fail {} {}".format(username, remote_addr))
             return None
 
-        # instance info
-        ins: dict = instance.get_instance_by_name(ins_name)
-        if not ins:
-            pretty_logger.info("varlidate instance not found {} {}".format(username, remote_addr))
+        # only failures are charged, per address so guesses from elsewhere can't lock out the owner
+        limit_key = "{}/{}".format(remote_addr, ins_name)
+        if auth_failure_limiter.limited(limit_key):
+            pretty_logger.info("validate instance {} auth failures limited {}".format(ins_name, remote_addr))
             return None
 
-        # auth key
-        auth_key = ""
-        for key in ins.get("auth_keys", []):
-            the_pub_key = parser_public_key(key)
-            if the_pub_key == public_key:
-                auth_key = key
-                break
-        if not auth_key:
-            pretty_logger.info("validate public key not found {} {}".format(username, remote_addr))
+        # instance auth key
+        found = instance_cache.lookup(ins_name, public_key)
+        if not found:
+            auth_failure_limiter.charge(limit_key)
+            pretty_logger.info("validate instance public key not found {} {}".format(username, remote_addr))
             return None
+        instance_id, auth_key, auth_keys = found
 
         # instance user
         user = {
             "username": ins_user,
-            "instance_id": ins.get("id"),
-            "auth_keys": ins.get("auth_keys"),
+            "instance_id": instance_id,
+            "auth_keys": auth_keys,
             "auth_key": auth_key
         }
         if user:
@@ -88,13 +85,16 @@ class SSHInterface(paramiko.ServerInterface):
         client.request.meta.update({
             'origin': origin, 'destination': destination
         })
-        self.event.set()
+        client.request_evt.set()
         return 0
 
     def check_port_forward_request(self, address, port):
         pretty_logger.info("Check channel port forward request: %s %s" % (address, port))
-        self.event.set()
-        return False
+        return forward_manager.add(self.connection, address, port)
+
+    def cancel_port_forward_request(self, address, port):
+        pretty_logger.info("Cancel channel port forward request: %s %s" % (address, port))
+        forward_manager.cancel(self.connection, address, port)
 
     def check_channel_request(self, kind, chanid):
         pretty_logger.info("Check channel request: %s %d" % (kind, chanid))
@@ -109,20 +109,22 @@ class SSHInterface(paramiko.ServerInterface):
         return False
 
     def check_channel_exec_request(self, channel, command):
+        # paramiko hands the raw bytes of the request
+        if isinstance(command, bytes):
+            command = command.decode("utf-8", "replace")
         pretty_logger.info("Check channel exec request:  `%s`" % command)
         client = self.connection.get_client(channel)
         client.request.type = 'exec'
         client.request.meta.update({
             'command': command
         })
-        self.event.set()
+        client.request_evt.set()
         return True
 
     def check_channel_forward_agent_request(self, channel):
         pretty_logger.info("Check channel forward agent request: %s" % channel)
         client = self.connection.get_client(channel)
         client.request.meta['forward-agent'] = True
-        self.event.set()
         return True
 
     def check_channel_pty_request(self, channel, term, width, height, pixelwidth, pixelheight, modes):
@@ -134,22 +136,25 @@ class SSHInterface(paramiko.ServerInterface):
             'height': height, 'pixelwidth': pixelwidth,
             'pixelheight': pixelheight,
         })
-        self.event.set()
         return True
 
     def check_channel_shell_request(self, channel):
         pretty_logger.info("Check channel shell request: %s" % channel.get_id())
         client = self.connection.get_client(channel)
         client.request.meta['shell'] = True
+        # pty-req and agent forwarding come first, shell/exec/subsystem start the channel
+        client.request_evt.set()
         return True
 
     def check_channel_subsystem_request(self, channel, name):
         pretty_logger.info("Check channel subsystem request: %s" % name)
+        if name not in config["SUBSYSTEMS"]:
+            return False
         client = self.connection.get_client(channel)
         client.request.type = 'subsystem'
         client.request.meta['subsystem'] = name
-        self.event.set()
-        return super(SSHInterface, self).check_channel_subsystem_request(channel, name)
+        client.request_evt.set()
+        return True
 
     def check_channel_window_change_request(self, channel, width, height, pixelwidth, pixelheight):
         client = self.connection.get_client(channel)
@@ -159,7 +164,7 @@ class SSHInterface(paramiko.ServerInterface):
             'pixelwidth': pixelwidth,
             'pixelheight': pixelheight,
         })
-        client.change_size_evt.set()
+        client.resize()
         return True
 
     def check_channel_x11_request(self, channel, single_connection, auth_protocol, auth_cookie, screen_number):
@@ -0,0 +1,109 @@
+from cae.config import channel_config as config
+import ipaddress
+import threading
+import time
+
+
+class RateLimiter:
+    """
+    Token bucket per key, `rate` tokens a second up to `burst`. Buckets
+    that filled up again are pruned once the table grows past max_keys,
+    so a flood of distinct addresses can not grow it without bound.
+    """
+
+    def __init__(self, rate, burst, max_keys=65536):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.buckets = {}  # key -> [tokens, last refill]
+        self.lock = threading.Lock()
+        self.rejected = 0
+
+    def refill(self, key, now):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            if len(self.buckets) >= self.max_keys:
+                self.prune(now)
+            bucket = self.buckets[key] = [self.burst, now]
+        else:
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        return bucket
+
+    def allow(self, key, cost=1) -> bool:
+        """
+        Take cost tokens, :return False (counted as rejected) when there are not enough.
+        """
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.refill(key, now)
+            if bucket[0] < cost:
+                self.rejected += 1
+                return False
+            bucket[0] -= cost
+            return True
+
+    def limited(self, key) -> bool:
+        """
+        Check without taking, for limits charged only on failures.
+        """
+        now = time.monotonic()
+        with self.lock:
+            if key not in self.buckets:
+                return False
+            if self.refill(key, now)[0] < 1:
+                self.rejected += 1
+                return True
+            return False
+
+    def charge(self, key, cost=1):
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.refill(key, now)
+            bucket[0] = max(bucket[0] - cost, 0)
+
+    def prune(self, now):
+        full = [k for k, (tokens, last) in self.buckets.items()
+                if tokens + (now - last) * self.rate >= self.burst]
+        for k in full:
+            del self.buckets[k]
+        if len(self.buckets) >= self.max_keys:
+            # everyone is limited, drop the oldest half rather than grow
+            oldest = sorted(self.buckets.items(), key=lambda x: x[1][1])[:len(self.buckets) // 2]
+            for k, _ in oldest:
+                del self.buckets[k]
+
+    def stats(self):
+        return {
+            "keys": len(self.buckets),
+            "rejected": self.rejected,
+        }
+
+
+def parse_networks(items) -> list:
+    return [ipaddress.ip_network(item.strip(), strict=False) for item in items if item.strip()]
+
+
+exempt_networks = parse_networks(config["LIMIT_EXEMPT"])
+
+
+def is_exempt(addr, networks=None) -> bool:
+    """
+    :return whether the remote address is in LIMIT_EXEMPT
+    """
+    networks = exempt_networks if networks is None else networks
+    if not networks:
+        return False
+    try:
+        ip = ipaddress.ip_address(addr)
+    except ValueError:
+        return False
+    if ip.version == 6 and ip.ipv4_mapped:
+        ip = ip.ipv4_mapped
+    return any(ip in network for network in networks)
+
+
+# new connections per remote address, taken at accept
+connection_limiter = RateLimiter(config["LIMIT_CONNECTION_RATE"], config["LIMIT_CONNECTION_BURST"])
+# failed public key auths per remote address and instance name, checked before the lookup
+auth_failure_limiter = RateLimiter(config["LIMIT_AUTH_FAILURE_RATE"], config["LIMIT_AUTH_FAILURE_BURST"])
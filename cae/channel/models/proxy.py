@@ -1,11 +1,14 @@
 from cae.config import channel_config as config
-from cae.channel.utils import get_private_key_fingerprint, wrap_with_line_feed, wrap_with_warning, SelectEvent
+from cae.channel.utils import get_private_key_fingerprint, wrap_with_line_feed, wrap_with_warning, tune_socket
 from pretty_logging import pretty_logger
+from .relay import Session
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import paramiko
 import uuid
-import datetime
-import selectors
 import socket
+import threading
+import time
 
 
 class ProxyServer:
@@ -27,6 +30,9 @@ class ProxyServer:
         self.system_user = system_user
         self.server = None
         self.connecting = True
+        # ssh host 'cmd' runs as an upstream exec channel, sftp as an upstream subsystem
+        self.command = client.request.meta.get("command") if client.request.type == "exec" else None
+        self.subsystem = client.request.meta.get("subsystem") if client.request.type == "subsystem" else None
 
     def proxy(self):
         self.server = self.get_server_conn_from_cache()
@@ -37,7 +43,8 @@ class ProxyServer:
         if self.client.closed:
             self.server.close()
             return
-        session = Session.new_session(self.client, self.server)
+        session = Session.new_session(self.client, self.server, kind="proxy",
+                                      command=self.command if self.subsystem is None else self.subsystem)
         if not session:
             msg = "Connect with api server failed"
             pretty_logger.error(msg)
@@ -45,15 +52,22 @@ class ProxyServer:
             self.server.close()
             return
 
-        try:
-            session.bridge()
-        finally:
-            Session.remove_session(session.id)
-            self.server.close()
-            msg = 'Session end, total {} now'.format(
-                len(Session.sessions),
-            )
-            pretty_logger.info(msg)
+        session.on_finish(self.finish)
+        session.bridge()
+
+    def finish(self, session):
+        Session.remove_session(session.id)
+        if session.command is not None:
+            # exit-status usually comes with the eof, give the rest a moment
+            self.server.chan.status_event.wait(config["EXIT_STATUS_TIMEOUT"])
+            # -1 when the channel closed without one
+            if self.server.chan.exit_status_ready() and self.server.chan.exit_status >= 0:
+                self.client.send_exit_status(self.server.chan.exit_status)
+        self.server.close()
+        msg = 'Session end, total {} now'.format(
+            len(Session.sessions),
+        )
+        pretty_logger.info(msg)
 
     def get_server_conn_from_cache(self):
         server = None
@@ -67,7 +81,8 @@ class ProxyServer:
             server = self.get_ssh_server_conn()
         else:
             server = None
-        self.client.send(b'\r\n')
+        if self.command is None and self.subsystem is None:
+            self.client.send(b'\r\n')
         self.connecting = False
         return server
 
@@ -86,9 +101,20 @@ class ProxyServer:
                 self.system_user = conn.system_user
         else:
             conn = SSHConnection.new_connection(self.client.user, self.asset, self.system_user)
-        chan = conn.get_channel(term=term, width=width, height=height)
+        try:
+            if self.subsystem is not None:
+                chan = conn.get_subsystem_channel(self.subsystem)
+            elif self.command is not None:
+                pty = dict(term=term, width=width, height=height) if 'term' in request.meta else None
+                chan = conn.get_exec_channel(self.command, pty=pty)
+            else:
+                chan = conn.get_channel(term=term, width=width, height=height)
+        except Exception:
+            conn.close()
+            raise
         if not chan:
             self.client.send_unicode(wrap_with_warning(wrap_with_line_feed(conn.error, before=1, after=0)))
+            conn.close()
             server = None
         else:
             server = Server(chan, conn, self.asset, self.system_user)
@@ -96,7 +122,22 @@ class ProxyServer:
 
 
 class SSHConnection:
-    connections = {}
+    """
+    Pool of upstream ssh transports keyed by user, ip and system user.
+
+    A transport carries up to SSH_POOL_MAX_CHANNELS sessions, `ref` counts
+    the ones in use. Released transports stay warm for SSH_POOL_IDLE_TIMEOUT,
+    the least recently used idle one is closed once the pool holds more
+    than SSH_POOL_SIZE transports.
+    """
+    connections = OrderedDict()  # key -> [SSHConnection], least recently used first
+    lock = threading.Lock()
+    hits = 0
+    misses = 0
+    evicted = 0
+    reaper = None
+    prewarmer = None
+    reap_interval = 10
 
     @staticmethod
     def make_key(user, asset, system_user):
@@ -106,19 +147,28 @@ class SSHConnection:
     @classmethod
     def new_connection_from_cache(cls, user, asset, system_user):
         key = cls.make_key(user, asset, system_user)
-        connection = cls.connections.get(key)
-        if not connection:
-            return None
-        if not connection.is_active:
-            cls.connections.pop(key, None)
-            return None
-        connection.ref += 1
-        return connection
+        with cls.lock:
+            for connection in list(cls.connections.get(key, [])):
+                if not connection.is_active:
+                    cls._remove(connection)
+                    continue
+                if connection.ref < config["SSH_POOL_MAX_CHANNELS"]:
+                    connection.ref += 1
+                    connection.last_used = time.monotonic()
+                    cls.connections.move_to_end(key)
+                    cls.hits += 1
+                    return connection
+        return None
 
     @classmethod
     def set_connection_to_cache(cls, conn):
         key = cls.make_key(conn.user, conn.asset, conn.system_user)
-        cls.connections[key] = conn
+        with cls.lock:
+            cls.connections.setdefault(key, []).append(conn)
+            cls.connections.move_to_end(key)
+            victims = cls._evict()
+        for victim in victims:
+            victim.shutdown()
 
     @classmethod
     def new_connection(cls, user, asset, system_user):
@@ -127,16 +177,128 @@ class SSHConnection:
         if connection:
             pretty_logger.info("Reuse connection: {}->{}@{}".format(user.username, asset.ip, system_user.username))
             return connection
+        with cls.lock:
+            cls.misses += 1
         connection = cls(user, asset, system_user)
         connection.connect()
+        connection.ref = 1
         if connection.is_active:
             cls.set_connection_to_cache(connection)
         return connection
 
     @classmethod
     def remove_ssh_connection(cls, conn):
-        key = "{}_{}_{}".format(conn.user.username, conn.asset.ip, conn.system_user.username)
-        cls.connections.pop(key, None)
+        with cls.lock:
+            cls._remove(conn)
+
+    @classmethod
+    def _remove(cls, conn):
+        key = cls.make_key(conn.user, conn.asset, conn.system_user)
+        conns = cls.connections.get(key)
+        if conns and conn in conns:
+            conns.remove(conn)
+            if not conns:
+                cls.connections.pop(key, None)
+
+    @classmethod
+    def _evict(cls):
+        """
+        Drop idle transports, least recently used first, until the pool
+        fits. Called with the lock held, :return transports to shut down
+        """
+        victims = []
+        excess = cls.size() - config["SSH_POOL_SIZE"]
+        for conns in list(cls.connections.values()):
+            for conn in list(conns):
+                if excess <= 0:
+                    return victims
+                if conn.ref == 0:
+                    cls._remove(conn)
+                    victims.append(conn)
+                    cls.evicted += 1
+                    excess -= 1
+        return victims
+
+    @classmethod
+    def size(cls):
+        return sum(len(conns) for conns in cls.connections.values())
+
+    @classmethod
+    def reap(cls):
+        """
+        Close transports idle for longer than SSH_POOL_IDLE_TIMEOUT or dead.
+        """
+        now = time.monotonic()
+        with cls.lock:
+            victims = [
+                conn for conns in cls.connections.values() for conn in conns
+                if conn.ref == 0 and (now - conn.last_used > config["SSH_POOL_IDLE_TIMEOUT"] or not conn.is_active)
+            ]
+            for conn in victims:
+                cls._remove(conn)
+            cls.evicted += len(victims)
+        for conn in victims:
+            conn.shutdown()
+
+    @classmethod
+    def start(cls):
+        with cls.lock:
+            if cls.reaper:
+                return
+            cls.reaper = threading.Thread(target=cls.reap_forever, daemon=True, name="ssh-pool")
+            cls.reaper.start()
+
+    @classmethod
+    def reap_forever(cls):
+        while True:
+            time.sleep(cls.reap_interval)
+            try:
+                cls.reap()
+            except Exception as e:
+                pretty_logger.error("SSH pool reap error: {}".format(e))
+
+    @classmethod
+    def submit(cls, fn, *args):
+        """
+        Run fn in the background prewarm pool.
+        """
+        with cls.lock:
+            if cls.prewarmer is None:
+                cls.prewarmer = ThreadPoolExecutor(max_workers=4, thread_name_prefix="ssh-prewarm")
+        return cls.prewarmer.submit(fn, *args)
+
+    @classmethod
+    def prewarm(cls, user, asset, system_user) -> bool:
+        """
+        Connect and park the transport idle in the pool, so the next
+        session to it only opens a channel.
+        """
+        key = cls.make_key(user, asset, system_user)
+        with cls.lock:
+            if any(conn.is_active for conn in cls.connections.get(key, [])):
+                return True
+        connection = cls(user, asset, system_user)
+        try:
+            connection.connect()
+        except Exception as e:
+            pretty_logger.info("Prewarm {} failed: {}".format(key, e))
+            return False
+        pretty_logger.info("Prewarm connection: {}->{}@{}".format(user.username, asset.ip, system_user.username))
+        cls.set_connection_to_cache(connection)
+        return True
+
+    @classmethod
+    def stats(cls):
+        with cls.lock:
+            conns = [conn for conns in cls.connections.values() for conn in conns]
+        return {
+            "transports": len(conns),
+            "channels": sum(conn.ref for conn in conns),
+            "idle": len([conn for conn in conns if conn.ref == 0]),
+            "hits": cls.hits,
+            "misses": cls.misses,
+            "evicted": cls.evicted,
+        }
 
     def __init__(self, user, asset, system_user):
         """
@@ -160,7 +322,8 @@ class SSHConnection:
         self.transport = None
         self.sock = None
         self.error = ""
-        self.ref = 1
+        self.ref = 0
+        self.last_used = time.monotonic()
 
     def connect(self):
         ssh = paramiko.SSHClient()
@@ -189,6 +352,8 @@ class SSHConnection:
                 )
             transport = ssh.get_transport()
             transport.set_keepalive(60)
+            # paramiko leaves Nagle on, it would hold back keystrokes of pooled transports
+            tune_socket(transport.sock, config["TCP_KEEPALIVE"])
             self.transport = transport
         except Exception as e:
             password_short = "None"
@@ -226,32 +391,73 @@ class SSHConnection:
         else:
             return None
 
+    def get_exec_channel(self, command, pty=None):
+        """
+        Exec channel for a non-interactive command, a pty only when the
+        client asked for one (ssh -t).
+        """
+        if not self.reconnect_if_need():
+            return None
+        chan = self.transport.open_session(timeout=config['SSH_TIMEOUT'])
+        if pty:
+            chan.get_pty(**pty)
+        chan.exec_command(command)
+        return chan
+
+    def get_subsystem_channel(self, name):
+        """
+        Raw subsystem channel, opened with large windows as it is
+        relayed byte for byte to the client.
+        """
+        if not self.reconnect_if_need():
+            return None
+        chan = self.transport.open_session(
+            window_size=config["CHANNEL_WINDOW_SIZE"], max_packet_size=config["CHANNEL_MAX_PACKET_SIZE"],
+            timeout=config['SSH_TIMEOUT'],
+        )
+        chan.invoke_subsystem(name)
+        return chan
+
     def get_sftp(self):
-        if self.reconnect_if_need():
-            return self.client.open_sftp()
-        else:
+        chan = self.get_subsystem_channel("sftp")
+        if chan is None:
             return None
+        return paramiko.SFTPClient(chan)
 
     @property
     def is_active(self):
         return self.transport and self.transport.is_active()
 
     def close(self):
-        if self.ref > 1:
-            self.ref -= 1
-            msg = "Connection ref -1: {}->{}@{}. {}".format(self.user.username, self.asset.ip, self.system_user.username, self.ref)
-            pretty_logger.info(msg)
-            return
-        self.__class__.remove_ssh_connection(self)
+        """
+        Release one channel, the transport stays pooled while it is alive.
+        """
+        with self.lock:
+            self.ref = max(self.ref - 1, 0)
+            self.last_used = time.monotonic()
+            if self.ref > 0:
+                msg = "Connection ref -1: {}->{}@{}. {}".format(self.user.username, self.asset.ip, self.system_user.username, self.ref)
+                pretty_logger.info(msg)
+                return
+            if self.is_active and config["SSH_POOL_IDLE_TIMEOUT"] > 0:
+                key = self.make_key(self.user, self.asset, self.system_user)
+                if self in self.connections.get(key, []):
+                    pretty_logger.info("Connection idle: {}->{}@{}".format(self.user.username, self.asset.ip, self.system_user.username))
+                    return
+            self._remove(self)
+        self.shutdown()
+
+    def shutdown(self):
         try:
-            self.client.close()
+            if self.client:
+                self.client.close()
             if self.sock:
                 self.sock.close()
         except Exception as e:
             pretty_logger.error("Close connection error: {}".format(e))
 
         msg = "Close connection: {}->{}@{}. Total connections live: {}".format(self.user.username,
-                                                                               self.asset.ip, self.system_user.username, len(self.connections))
+                                                                               self.asset.ip, self.system_user.username, self.size())
         pretty_logger.info(msg)
 
 
@@ -298,110 +504,3 @@ class Server(object):
 
     def __str__(self):
         return "server %s:%s" % (self.asset.ip, self.asset.ssh_port)
-
-
-class Session:
-    sessions = {}
-
-    def __init__(self, client, server):
-        self.id = str(uuid.uuid4())
-        self.client = client  # Master of the session, it's a client sock
-        self.server = server  # Server channel
-        self.date_start = datetime.datetime.utcnow()
-        self.date_end = None
-        self.is_finished = False
-        self.closed = False
-        self.sel = selectors.DefaultSelector()
-        self.stop_evt = SelectEvent()
-        self.date_last_active = datetime.datetime.utcnow()
-
-    @classmethod
-    def new_session(cls, client, server):
-        session = cls(client, server)
-        cls.sessions[session.id] = session
-        return session
-
-    @classmethod
-    def get_session(cls, sid):
-        return cls.sessions.get(sid)
-
-    @classmethod
-    def remove_session(cls, sid):
-        session = cls.get_session(sid)
-        if session:
-            session.close()
-            cls.sessions.pop(sid, None)
-
-    def bridge(self):
-        """
-        Bridge clients with server
-        :return:
-        """
-        pretty_logger.info("Start bridge session: {}".format(self.id))
-        self.sel.register(self.client, selectors.EVENT_READ)
-        self.sel.register(self.server, selectors.EVENT_READ)
-        self.sel.register(self.stop_evt, selectors.EVENT_READ)
-        self.sel.register(self.client.change_size_evt, selectors.EVENT_READ)
-        while not self.is_finished:
-            events = self.sel.select(timeout=60)
-            if self.client.closed:
-                break
-            if self.server.closed:
-                break
-            for sock in [key.fileobj for key, _ in events]:
-                data = sock.recv(1024)
-                if sock == self.server:
-                    if len(data) == 0:
-                        msg = "Server close the connection"
-                        pretty_logger.info(msg)
-                        self.is_finished = True
-                        break
-
-                    self.date_last_active = datetime.datetime.utcnow()
-                    self.client.send(data)
-                elif sock == self.client:
-                    if len(data) == 0:
-                        msg = "Client close the connection: {}".format(self.client)
-                        pretty_logger.info(msg)
-                        self.is_finished = True
-                        break
-                    self.server.send(data)
-                elif sock == self.stop_evt:
-                    self.is_finished = True
-                    break
-                elif sock == self.client.change_size_evt:
-                    self.resize_win_size()
-        pretty_logger.info("Session stop event set: {}".format(self.id))
-
-    def resize_win_size(self):
-        width, height = self.client.request.meta['width'], self.client.request.meta['height']
-        #pretty_logger.info("Resize server chan size {}*{}".format(width, height))
-        self.server.resize_pty(width=width, height=height)
-
-    def close(self):
-        if self.closed:
-            pretty_logger.info("Session has been closed: {} ".format(self.id))
-            return
-        pretty_logger.info("Close the session: {} ".format(self.id))
-        self.is_finished = True
-        self.closed = True
-        self.date_end = datetime.datetime.utcnow()
-
-    def to_json(self):
-        return {
-            "id": self.id,
-            "user": "{}".format(self.client.user.username),
-            "asset": self.server.asset.ip,
-            "system_user": self.server.system_user.username,
-            "login_from": self.client.login_from,
-            "remote_addr": self.client.addr[0],
-            "is_finished": self.is_finished,
-            "date_start": self.date_start.strftime("%Y-%m-%d %H:%M:%S") + " +0000",
-            "date_end": self.date_end.strftime("%Y-%m-%d %H:%M:%S") + " +0000" if self.date_end else None
-        }
-
-    def __str__(self):
-        return self.id
-
-    def __repr__(self):
-        return self.id
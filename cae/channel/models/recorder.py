@@ -0,0 +1,233 @@
+from cae.config import channel_config as config
+from pretty_logging import pretty_logger
+import codecs
+import datetime
+import gzip
+import json
+import os
+import queue
+import threading
+import time
+import traceback
+
+try:
+    import zstandard
+except ImportError:  # optional, recordings fall back to gzip
+    zstandard = None
+
+
+class Recording:
+    """
+    asciinema v2 cast of one pty session, the file is only touched by the
+    writer thread.
+    """
+
+    def __init__(self, session, width, height, term):
+        self.session_id = session.id
+        self.title = "{}@{}".format(session.client.user.get("username"), session.client.user.get("instance_id"))
+        self.width = width
+        self.height = height
+        self.term = term
+        self.date_start = datetime.datetime.utcnow()
+        self.part = 0
+        self.part_start = None
+        self.path = None
+        self.file = None
+        self.raw = None
+        self.size = 0
+        self.lines = []
+        self.failed = False
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+    def base_path(self):
+        name = self.session_id if not self.part else "{}.{}".format(self.session_id, self.part)
+        return os.path.join(config["RECORD_DIR"], self.date_start.strftime("%Y-%m-%d"), name + ".cast")
+
+    def open(self, ts):
+        path = self.base_path()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        compress = config["RECORD_COMPRESS"]
+        if compress == "zstd" and zstandard is None:
+            compress = "gzip"
+        if compress == "zstd":
+            self.path = path + ".zst"
+            self.raw = open(self.path, "wb")
+            self.file = zstandard.ZstdCompressor(level=3).stream_writer(self.raw)
+        elif compress == "gzip":
+            self.path = path + ".gz"
+            self.raw = open(self.path, "wb")
+            self.file = gzip.GzipFile(fileobj=self.raw, mode="wb", compresslevel=6)
+        else:
+            self.path = path
+            self.file = open(self.path, "wb")
+        self.part_start = ts
+        self.size = 0
+        self.write_line({
+            "version": 2,
+            "width": self.width,
+            "height": self.height,
+            "timestamp": int(time.time()),
+            "title": self.title,
+            "env": {"TERM": self.term},
+        })
+
+    def write_line(self, obj):
+        line = json.dumps(obj, ensure_ascii=False).encode("utf-8") + b"\n"
+        self.lines.append(line)
+        self.size += len(line)
+
+    def commit(self):
+        """
+        One write per batch, the compressor then works on a large buffer
+        without holding the interpreter lock.
+        """
+        if self.lines:
+            self.file.write(b"".join(self.lines))
+            self.lines = []
+
+    def event(self, ts, code, data):
+        if self.file is None:
+            self.open(ts)
+        elif self.size >= config["RECORD_ROTATE_SIZE"]:
+            self.close()
+            self.part += 1
+            self.open(ts)
+        if code == "r":
+            self.width, self.height = data
+            text = "{}x{}".format(*data)
+        else:
+            text = self.decoder.decode(data)
+            if not text:
+                return
+        self.write_line([round(ts - self.part_start, 6), code, text])
+
+    def flush(self):
+        if self.file is not None:
+            self.file.flush()
+
+    def close(self):
+        if self.file is None:
+            return
+        self.commit()
+        self.file.close()
+        if self.raw is not None and not self.raw.closed:
+            self.raw.close()
+        self.file = self.raw = None
+
+
+class SessionRecorder:
+    """
+    The relay loop only enqueues chunks, never waiting on the disk. When
+    the queue is full chunks are dropped and counted instead. A writer
+    thread batches the events, compresses and rotates the cast files.
+    """
+
+    def __init__(self):
+        self.queue = queue.Queue(maxsize=config["RECORD_QUEUE_SIZE"])
+        self.thread = None
+        self.lock = threading.Lock()
+        self.recordings = 0
+        self.dropped = 0
+        self.dropped_bytes = 0
+        self.written = 0
+
+    def start(self):
+        with self.lock:
+            if self.thread:
+                return
+            self.thread = threading.Thread(target=self.run, daemon=True, name="recorder")
+            self.thread.start()
+
+    def new_recording(self, session):
+        """
+        :return a Recording for pty sessions when recording is enabled, else None
+        """
+        meta = session.client.request.meta
+        if not config["RECORD_ENABLED"] or "term" not in meta:
+            return None
+        self.start()
+        self.recordings += 1
+        return Recording(session, meta.get("width", 80), meta.get("height", 24), meta.get("term"))
+
+    def record(self, recording, code, data):
+        """
+        Called on the relay loop, copies data as socket reads reuse their buffer.
+        """
+        try:
+            self.queue.put_nowait((recording, time.monotonic(), code, bytes(data)))
+        except queue.Full:
+            self.dropped += 1
+            self.dropped_bytes += len(data)
+
+    def resize(self, recording, width, height):
+        try:
+            self.queue.put_nowait((recording, time.monotonic(), "r", (width, height)))
+        except queue.Full:
+            self.dropped += 1
+
+    def stop(self, recording):
+        # not from the relay loop, wait for room rather than leak the file
+        self.queue.put((recording, time.monotonic(), None, None))
+
+    def run(self):
+        dirty = set()
+        last_flush = time.monotonic()
+        while True:
+            # wake up a few times a second and take what piled up, waking per
+            # chunk would compete with the relay loop for the interpreter
+            time.sleep(config["RECORD_BATCH_INTERVAL"])
+            batch = []
+            while len(batch) < config["RECORD_BATCH"]:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            touched = set()
+            for recording, ts, code, data in batch:
+                if recording.failed and code is not None:
+                    continue
+                try:
+                    if code is None:
+                        recording.close()
+                        touched.discard(recording)
+                        dirty.discard(recording)
+                        pretty_logger.info("Recording {} closed {}".format(recording.session_id, recording.path))
+                        continue
+                    recording.event(ts, code, data)
+                    touched.add(recording)
+                    self.written += 1
+                    # let a waiting relay loop in between events
+                    time.sleep(0)
+                except Exception:
+                    # e.g. the record dir is not writable, give up on this session
+                    recording.failed = True
+                    touched.discard(recording)
+                    dirty.discard(recording)
+                    pretty_logger.error(traceback.format_exc())
+            for recording in touched:
+                try:
+                    recording.commit()
+                    dirty.add(recording)
+                except Exception:
+                    recording.failed = True
+                    pretty_logger.error(traceback.format_exc())
+            if dirty and time.monotonic() - last_flush >= config["RECORD_FLUSH_INTERVAL"]:
+                last_flush = time.monotonic()
+                for recording in dirty:
+                    try:
+                        recording.flush()
+                    except Exception:
+                        pretty_logger.error(traceback.format_exc())
+                dirty.clear()
+
+    def stats(self):
+        return {
+            "recordings": self.recordings,
+            "queued": self.queue.qsize(),
+            "written": self.written,
+            "dropped": self.dropped,
+            "dropped_bytes": self.dropped_bytes,
+        }
+
+
+recorder = SessionRecorder()
@@ -0,0 +1,151 @@
+from cae.config import channel_config as config
+from cae.models import redis_client, session as session_model
+from pretty_logging import pretty_logger
+import os
+import socket
+import threading
+import time
+import traceback
+
+
+class SessionRegistry:
+    """
+    Publishes the live connections and sessions of this channel process
+    to redis for the api workers. An event only updates a dict under the
+    lock, a flusher thread sends what changed in one pipeline per
+    interval. Kill requests from the api arrive by pubsub and end the
+    session through its stop_evt.
+    """
+
+    def __init__(self):
+        self.node = "{}:{}".format(socket.gethostname(), os.getpid())
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.connections = {}
+        self.removed_sessions = set()
+        self.dirty_connections = set()
+        self.removed_connections = set()
+        self.published = {}  # session id -> (bytes up, bytes down) last sent, flusher thread only
+        self.flusher = None
+        self.watcher = None
+        self.flushes = 0
+        self.errors = 0
+        self.kills = 0
+
+    def add_session(self, session):
+        with self.lock:
+            self.sessions[session.id] = session
+            self.removed_sessions.discard(session.id)
+
+    def remove_session(self, sid):
+        with self.lock:
+            if self.sessions.pop(sid, None) is not None:
+                self.removed_sessions.add(sid)
+
+    def update_connection(self, connection):
+        with self.lock:
+            self.connections[connection.id] = connection
+            self.dirty_connections.add(connection.id)
+            self.removed_connections.discard(connection.id)
+
+    def remove_connection(self, cid):
+        with self.lock:
+            if self.connections.pop(cid, None) is not None:
+                self.dirty_connections.discard(cid)
+                self.removed_connections.add(cid)
+
+    def start(self):
+        if self.flusher:
+            return
+        # the pid changes in forked channel workers
+        self.node = "{}:{}".format(socket.gethostname(), os.getpid())
+        self.flusher = threading.Thread(target=self.run, daemon=True, name="session-registry")
+        self.flusher.start()
+        self.watcher = threading.Thread(target=self.watch, daemon=True, name="session-kill")
+        self.watcher.start()
+
+    def run(self):
+        while True:
+            time.sleep(config["REGISTRY_INTERVAL"])
+            try:
+                self.flush()
+            except Exception:
+                pretty_logger.error(traceback.format_exc())
+
+    def flush(self):
+        with self.lock:
+            sessions = list(self.sessions.values())
+            removed_sessions, self.removed_sessions = self.removed_sessions, set()
+            connections = [self.connections[cid] for cid in self.dirty_connections]
+            self.dirty_connections = set()
+            removed_connections, self.removed_connections = self.removed_connections, set()
+        # byte counters move without events, only sessions that changed are sent
+        changed = {}
+        for session in sessions:
+            mark = (session.bytes_up, session.bytes_down)
+            if self.published.get(session.id) != mark:
+                self.published[session.id] = mark
+                data = session.to_json()
+                data["node"] = self.node
+                changed[session.id] = data
+        for sid in removed_sessions:
+            self.published.pop(sid, None)
+        connection_data = {}
+        for connection in connections:
+            data = connection.to_json()
+            data["node"] = self.node
+            connection_data[connection.id] = data
+        try:
+            session_model.publish_state(
+                self.node, changed, list(removed_sessions), connection_data, list(removed_connections),
+                ttl=config["REGISTRY_TTL"],
+            )
+            self.flushes += 1
+        except Exception as e:
+            self.errors += 1
+            pretty_logger.error("Publish session registry failed: {}".format(e))
+            # send everything again next time
+            self.published.clear()
+            with self.lock:
+                self.removed_sessions |= removed_sessions
+                self.removed_connections |= removed_connections
+                self.dirty_connections |= {c.id for c in connections if c.id in self.connections}
+
+    def watch(self):
+        while True:
+            pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+            try:
+                pubsub.subscribe(session_model.session_kill_channel)
+                for msg in pubsub.listen():
+                    self.kill(msg["data"].decode())
+            except Exception as e:
+                pretty_logger.error("Session registry watch error: {}".format(e))
+            finally:
+                pubsub.close()
+            time.sleep(1)
+
+    def kill(self, sid):
+        session = self.sessions.get(sid)
+        if not session:
+            return
+        pretty_logger.info("Terminate session {} by api".format(sid))
+        self.kills += 1
+        session.stop_evt.set()
+
+    def publish_stats(self, stats):
+        try:
+            session_model.publish_stats(self.node, stats, ttl=config["STATS_INTERVAL"] * 3)
+        except Exception as e:
+            pretty_logger.error("Publish channel stats failed: {}".format(e))
+
+    def stats(self):
+        return {
+            "sessions": len(self.sessions),
+            "connections": len(self.connections),
+            "flushes": self.flushes,
+            "errors": self.errors,
+            "kills": self.kills,
+        }
+
+
+registry = SessionRegistry()
@@ -0,0 +1,853 @@
+from cae.config import channel_config as config
+from cae.channel.utils import SelectEvent, adapt_buffer_size, percentile
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from pretty_logging import pretty_logger
+from .recorder import recorder
+from .audit import auditor
+from .registry import registry
+from .shaper import shaper
+import paramiko
+import uuid
+import select
+import bisect
+import datetime
+import heapq
+import itertools
+import selectors
+import socket
+import struct
+import sys
+import threading
+import time
+import traceback
+
+
+class Endpoint:
+    """
+    One side of a session as seen by the relay loop.
+    """
+    __slots__ = ("session", "conn", "io", "peer", "err_peer", "to_stderr", "demux", "is_channel",
+                 "recv_size", "buf", "pending", "mask", "bytes", "eof", "coalesce", "paused", "throttled",
+                 "waiting", "fd")
+
+    def __init__(self, session, conn, to_stderr=False):
+        self.session = session
+        self.conn = conn  # Client/Server wrapper
+        self.io = conn.chan  # raw paramiko channel or socket
+        self.peer = None
+        self.err_peer = None  # where this side's stderr goes, exec requests only
+        self.to_stderr = to_stderr
+        self.demux = None
+        self.is_channel = isinstance(self.io, paramiko.Channel)
+        self.recv_size = config["RELAY_BUFFER_MIN"]
+        self.buf = None
+        self.pending = None
+        self.mask = 0
+        self.bytes = 0
+        self.eof = False
+        self.coalesce = 0  # read on up to this many bytes while more is ready
+        self.paused = False  # out of bandwidth tokens
+        self.throttled = False  # the next read was held back by a pause
+        self.waiting = False  # a channel write waits for its window or transport socket
+        self.fd = None
+
+    def fileno(self):
+        # pinned, the selector must find this registration after the io
+        # closed and its number went to another one
+        if self.fd is None:
+            self.fd = self.io.fileno()
+        return self.fd
+
+    def recv(self, size=None):
+        """
+        Sockets read into a buffer owned by the endpoint, the view is only
+        valid until the next recv. The loop reads this side again only
+        after its peers drained, so the pending tail is never overwritten.
+        """
+        size = size or self.recv_size
+        try:
+            if self.is_channel:
+                return self.io.recv(size)
+            if self.buf is None or len(self.buf) < self.recv_size:
+                self.buf = memoryview(bytearray(self.recv_size))
+            n = self.io.recv_into(self.buf[:size])
+            return self.buf[:n]
+        except (socket.timeout, BlockingIOError, InterruptedError):
+            return None
+
+    def recv_more(self, data, limit):
+        """
+        Append what else is ready to data without waiting, so a burst of
+        small pty writes is sent on as one packet instead of one each.
+        """
+        chunks = bytearray(data)
+        while len(chunks) < limit:
+            if self.is_channel and not self.io.recv_ready():
+                break
+            more = self.recv(min(self.recv_size, limit - len(chunks)))
+            if not more:
+                # an eof is read again on the next event
+                break
+            chunks += more
+        return memoryview(chunks)
+
+    def recv_stderr(self):
+        if not self.io.recv_stderr_ready():
+            return None
+        return self.io.recv_stderr(self.recv_size)
+
+    def send(self, data) -> int:
+        """
+        Non-blocking write, :return bytes taken, 0 when the peer is full.
+        """
+        if self.is_channel:
+            return channel_send(self.io, data, self.to_stderr)
+        try:
+            return self.io.send(data)
+        except (BlockingIOError, InterruptedError):
+            return 0
+
+    def shutdown_write(self):
+        """
+        Pass an end of input on, the other direction keeps flowing.
+        """
+        try:
+            if self.is_channel:
+                self.io.shutdown_write()
+            else:
+                self.io.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+
+    def idle(self):
+        return self.pending is None
+
+    def drained(self):
+        """
+        Everything read from this side was delivered to its peers.
+        """
+        return self.peer.idle() and (self.err_peer is None or self.err_peer.idle())
+
+    def can_read(self):
+        """
+        Its peers have room for more, backpressure stops reading before.
+        """
+        return all(out.pending is None for out in (self.peer, self.err_peer) if out is not None)
+
+
+# SO_MEMINFO, not exported by the socket module
+_SO_MEMINFO = 55 if sys.platform.startswith("linux") else None
+# ssh packet header, padding and mac on top of the payload
+_PACKET_OVERHEAD = 128
+
+
+def send_room(sock) -> int:
+    """
+    Bytes the socket takes right now without blocking, about. A python
+    socket with a timeout polls for writability before each send, so
+    nothing fits while it is not writable. Without SO_MEMINFO one small
+    packet is assumed to fit.
+    """
+    poll = select.poll()
+    poll.register(sock, select.POLLOUT)
+    if not poll.poll(0):
+        return 0
+    if _SO_MEMINFO is not None:
+        try:
+            info = struct.unpack("9I", sock.getsockopt(socket.SOL_SOCKET, _SO_MEMINFO, 36))
+            # sndbuf counts kernel overhead too, half of what is free is payload
+            return (info[3] - max(info[2], info[5])) // 2
+        except OSError:
+            pass
+    return config["RELAY_BUFFER_MIN"]
+
+
+def channel_send(chan, data, to_stderr=False) -> int:
+    """
+    Send to a paramiko channel without blocking the relay loop, a packet
+    at a time while the remote window and the transport socket have room.
+    paramiko writes a packet out in full, blocking until the socket took
+    it, so it is only started when it fits. :return bytes taken
+    """
+    if chan.closed or chan.eof_sent:
+        raise EOFError("channel closed")
+    transport = chan.get_transport()
+    send = chan.send_stderr if to_stderr else chan.send
+    sent = 0
+    while sent < len(data):
+        # a key exchange holds every user packet until it is done
+        if not transport.clear_to_send.is_set():
+            break
+        room = send_room(transport.sock) - _PACKET_OVERHEAD
+        if room <= 0:
+            break
+        try:
+            n = send(data[sent:sent + room])
+        except socket.timeout:
+            # remote window full
+            break
+        if n == 0:
+            break
+        sent += n
+    return sent
+
+
+class SendWaiter:
+    """
+    Channel endpoints of a loop waiting for room in one transport socket.
+    """
+    __slots__ = ("sock", "endpoints", "fd")
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.endpoints = set()
+        self.fd = sock.fileno()
+
+    def fileno(self):
+        return self.fd
+
+
+class StreamDemux:
+    """
+    Splits the docker attach stream of a tty-less exec into (stream, payload),
+    frames are an 8 byte header [stream, 0, 0, 0, size uint32be] then payload.
+    """
+    __slots__ = ("buf",)
+
+    def __init__(self):
+        self.buf = b""
+
+    def feed(self, data) -> list:
+        buf = self.buf + bytes(data)
+        frames = []
+        while len(buf) >= 8:
+            size = int.from_bytes(buf[4:8], "big")
+            if len(buf) < 8 + size:
+                break
+            frames.append((buf[0], buf[8:8 + size]))
+            buf = buf[8 + size:]
+        self.buf = buf
+        return frames
+
+
+class StopEvent:
+    """
+    `session.stop_evt.set()` ends the session from any thread.
+    """
+    __slots__ = ("session",)
+
+    def __init__(self, session):
+        self.session = session
+
+    def set(self):
+        self.session.stop()
+
+
+class Session:
+    sessions = {}
+    lock = threading.Lock()
+
+    __slots__ = ("id", "kind", "client", "server", "date_start", "date_end", "date_last_active",
+                 "is_finished", "closed", "stop_evt", "loop", "endpoints", "callbacks", "command", "recording", "audit",
+                 "echo", "echo_start", "shaping", "__weakref__")
+
+    def __init__(self, client, server, kind="", command=None):
+        self.id = str(uuid.uuid4())
+        self.kind = kind
+        self.command = command  # exec request, stdin eof is passed on and stderr kept apart
+        self.client = client  # Master of the session, it's a client sock
+        self.server = server  # Server channel
+        self.date_start = datetime.datetime.utcnow()
+        self.date_end = None
+        self.date_last_active = datetime.datetime.utcnow()
+        self.is_finished = False
+        self.closed = False
+        self.stop_evt = StopEvent(self)
+        self.loop = None
+        self.endpoints = ()
+        self.callbacks = []
+        self.recording = None
+        self.audit = None
+        self.echo = None  # recent input to output latencies of pty sessions
+        self.echo_start = None
+        self.shaping = None  # bandwidth buckets, None when unlimited
+
+    @classmethod
+    def new_session(cls, client, server, kind="", command=None):
+        session = cls(client, server, kind=kind, command=command)
+        with cls.lock:
+            cls.sessions[session.id] = session
+        registry.add_session(session)
+        client.session = session
+        return session
+
+    @classmethod
+    def get_session(cls, sid):
+        return cls.sessions.get(sid)
+
+    @classmethod
+    def remove_session(cls, sid):
+        with cls.lock:
+            session = cls.sessions.pop(sid, None)
+        if session:
+            registry.remove_session(sid)
+            session.close()
+
+    def bridge(self):
+        """
+        Hand the session to the relay engine and return, the finish
+        callbacks run once either side closes or the session is stopped.
+        """
+        pretty_logger.info("Start bridge session: {}".format(self.id))
+        if "term" in self.client.request.meta:
+            self.echo = deque(maxlen=config["ECHO_SAMPLES"])
+        recording, audit, shaping = recorder.new_recording(self), auditor.new_audit(self), shaper.attach(self)
+        with self.lock:
+            # finished() sees them only when set before it ran
+            attached = not self.is_finished
+            if attached:
+                self.recording, self.audit, self.shaping = recording, audit, shaping
+        if not attached:
+            pretty_logger.info("Session {} stopped before the relay started".format(self.id))
+            if recording is not None:
+                recorder.stop(recording)
+            if audit is not None:
+                auditor.stop(audit)
+            if shaping is not None:
+                shaper.detach(shaping)
+            return
+        relay_engine.add(self)
+
+    def on_finish(self, fn):
+        """
+        Run fn(session) when the session finishes, at once if it already did.
+        """
+        with self.lock:
+            if not self.is_finished:
+                self.callbacks.append(fn)
+                return
+        fn(self)
+
+    def finished(self):
+        with self.lock:
+            self.is_finished = True
+            callbacks, self.callbacks = self.callbacks, []
+        pretty_logger.info("Session stop event set: {}".format(self.id))
+        if self.recording is not None:
+            recorder.stop(self.recording)
+        if self.audit is not None:
+            auditor.stop(self.audit)
+        if self.shaping is not None:
+            shaper.detach(self.shaping)
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception:
+                pretty_logger.error(traceback.format_exc())
+
+    def stop(self):
+        with self.lock:
+            loop = self.loop
+            if loop is None:
+                # not handed to the relay engine, it won't be anymore
+                self.is_finished = True
+        if loop is not None:
+            loop.call(loop.finish, self)
+        else:
+            self.finished()
+
+    def resize_win_size(self, width, height):
+        """
+        Called from the resizer pool, not the relay loop.
+        """
+        resize_pty = getattr(self.server, "resize_pty", None)
+        if not resize_pty:
+            return
+        resize_pty(width=width, height=height)
+        if self.recording is not None:
+            recorder.resize(self.recording, width, height)
+        if self.audit is not None:
+            auditor.resize(self.audit, width, height)
+
+    def close(self):
+        if self.closed:
+            pretty_logger.info("Session has been closed: {} ".format(self.id))
+            return
+        pretty_logger.info("Close the session: {} ".format(self.id))
+        self.is_finished = True
+        self.closed = True
+        self.date_end = datetime.datetime.utcnow()
+
+    def metrics(self) -> dict:
+        """
+        Throughput over the session lifetime, plus the server side tcp rtt
+        where the server is a plain socket (direct-tcpip tunnels).
+        """
+        end = self.date_end or datetime.datetime.utcnow()
+        seconds = max((end - self.date_start).total_seconds(), 0.001)
+        metrics = {
+            "seconds": round(seconds, 3),
+            "up_kb_s": round(self.bytes_up / seconds / 1024, 1),
+            "down_kb_s": round(self.bytes_down / seconds / 1024, 1),
+        }
+        if self.echo:
+            # from the bastion, the upstream hop and the remote program
+            samples = list(self.echo)
+            metrics.update({
+                "echo_samples": len(samples),
+                "echo_p50_ms": round(percentile(samples, 50) * 1000, 3),
+                "echo_p99_ms": round(percentile(samples, 99) * 1000, 3),
+            })
+        if self.shaping is not None:
+            metrics["throttled_bytes"] = self.shaping.throttled_bytes
+        server_metrics = getattr(self.server, "metrics", None)
+        if callable(server_metrics):
+            metrics.update(server_metrics())
+        return metrics
+
+    @property
+    def bytes_up(self):
+        return self.endpoints[0].bytes if self.endpoints else 0
+
+    @property
+    def bytes_down(self):
+        return self.endpoints[1].bytes if self.endpoints else 0
+
+    def to_json(self):
+        asset = self.server.asset or {}
+        system_user = self.server.system_user or {}
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "command": self.command,
+            "user": "{}".format(self.client.user.username),
+            "instance_id": self.client.user.instance_id,
+            "asset": asset.get("ip", asset.get("origin")),
+            "system_user": system_user.get("username", system_user.get("destination")),
+            "login_from": self.client.login_from,
+            "remote_addr": self.client.addr[0],
+            "is_finished": self.is_finished,
+            "bytes_up": self.bytes_up,
+            "bytes_down": self.bytes_down,
+            "metrics": self.metrics(),
+            "date_start": self.date_start.strftime("%Y-%m-%d %H:%M:%S") + " +0000",
+            "date_last_active": self.date_last_active.strftime("%Y-%m-%d %H:%M:%S") + " +0000",
+            "date_end": self.date_end.strftime("%Y-%m-%d %H:%M:%S") + " +0000" if self.date_end else None
+        }
+
+    def __str__(self):
+        return self.id
+
+    def __repr__(self):
+        return self.id
+
+
+class RelayLoop(threading.Thread):
+    """
+    Selector thread relaying data for many sessions. Everything touching
+    the selector runs on this thread, other threads go through `call`.
+    """
+
+    def __init__(self, name, finisher):
+        super().__init__(name=name, daemon=True)
+        self.sel = selectors.DefaultSelector()
+        self.wakeup_evt = SelectEvent()
+        self.sel.register(self.wakeup_evt, selectors.EVENT_READ)
+        self.calls = deque()
+        self.finisher = finisher
+        self.paused = []  # heap of (resume time, seq, endpoint) out of bandwidth
+        self.retries = []  # heap of (retry time, seq, endpoint) waiting for a channel window
+        self.waiters = {}  # transport socket -> SendWaiter
+        self.seq = itertools.count()
+        self.sessions = 0
+        # counts per ECHO_BUCKETS_MS bucket
+        self.echo_histogram = [0] * (len(config["ECHO_BUCKETS_MS"]) + 1)
+
+    def call(self, fn, *args):
+        self.calls.append((fn, args))
+        self.wakeup_evt.set()
+
+    def add(self, session):
+        try:
+            self.register(session)
+        except Exception:
+            pretty_logger.error("Session {} relay add failed: {}".format(session.id, traceback.format_exc()))
+            self.finish(session)
+
+    def register(self, session):
+        client, server = Endpoint(session, session.client), Endpoint(session, session.server)
+        client.peer, server.peer = server, client
+        if session.command is not None:
+            server.err_peer = Endpoint(session, session.client, to_stderr=True)
+            server.err_peer.peer = server
+        if getattr(session.server, "multiplexed", False):
+            server.demux = StreamDemux()
+        if session.echo is not None:
+            server.coalesce = config["PTY_COALESCE"]
+        session.endpoints = (client, server)
+        self.sessions += 1
+        for ep in session.endpoints:
+            if ep.is_channel:
+                ep.io.settimeout(0.0)
+            else:
+                ep.io.setblocking(False)
+            self.set_mask(ep, selectors.EVENT_READ)
+
+    def set_mask(self, ep, mask):
+        if mask == ep.mask:
+            return
+        if not ep.mask:
+            self.register_io(ep, mask)
+        elif not mask:
+            self.sel.unregister(ep)
+        else:
+            self.sel.modify(ep, mask)
+        ep.mask = mask
+
+    def register_io(self, obj, mask):
+        """
+        An fd still registered here belongs to an io that closed before
+        the loop noticed and was handed out again, drop its stale holder.
+        """
+        key = self.sel.get_map().get(obj.fileno())
+        if key is not None:
+            stale = key.fileobj
+            self.sel.unregister(stale)
+            if isinstance(stale, SendWaiter):
+                self.waiters.pop(stale.sock, None)
+                sessions = {ep.session for ep in stale.endpoints}
+            else:
+                stale.mask = 0
+                sessions = {stale.session}
+            for session in sessions:
+                pretty_logger.info("Session {} relay closed: fd {} reused".format(session.id, key.fd))
+                self.finish(session)
+        self.sel.register(obj, mask)
+
+    def finish(self, session):
+        """
+        Runs after `add` of the session, as both go through `call` and
+        the engine queues the add before anyone can stop it.
+        """
+        if session.is_finished:
+            return
+        for ep in session.endpoints:
+            try:
+                self.set_mask(ep, 0)
+            except (KeyError, ValueError, OSError):
+                pass
+            ep.paused = False
+            if ep.err_peer is not None:
+                self.stop_waiting(ep.err_peer)
+            self.stop_waiting(ep)
+        if session.endpoints:
+            self.sessions -= 1
+        session.is_finished = True
+        self.finisher.submit(session.finished)
+
+    def run(self):
+        while True:
+            timeout = None
+            due = [heap[0][0] for heap in (self.paused, self.retries) if heap]
+            if due:
+                timeout = max(min(due) - time.monotonic(), 0)
+            events = self.sel.select(timeout=timeout)
+            for key, mask in events:
+                ep = key.fileobj
+                if ep is self.wakeup_evt:
+                    self.wakeup_evt.recv(1024)
+                    continue
+                if isinstance(ep, SendWaiter):
+                    self.send_ready(ep)
+                    continue
+                if ep.session.is_finished:
+                    continue
+                try:
+                    if mask & selectors.EVENT_WRITE:
+                        self.flush(ep)
+                    if mask & selectors.EVENT_READ and not ep.session.is_finished:
+                        self.read(ep)
+                except (OSError, EOFError, socket.error) as e:
+                    pretty_logger.info("Session {} relay closed: {}".format(ep.session.id, e))
+                    self.finish(ep.session)
+            if self.paused:
+                self.resume()
+            if self.retries:
+                self.retry()
+            while self.calls:
+                fn, args = self.calls.popleft()
+                try:
+                    fn(*args)
+                except Exception:
+                    pretty_logger.error(traceback.format_exc())
+
+    def pause(self, ep, delay):
+        """
+        Out of bandwidth, stop reading ep until its buckets refilled.
+        """
+        ep.session.shaping.pauses += 1
+        ep.paused = True
+        self.set_mask(ep, ep.mask & ~selectors.EVENT_READ)
+        heapq.heappush(self.paused, (time.monotonic() + delay, next(self.seq), ep))
+
+    def resume(self):
+        now = time.monotonic()
+        while self.paused and self.paused[0][0] <= now:
+            _, _, ep = heapq.heappop(self.paused)
+            if not ep.paused or ep.session.is_finished:
+                continue
+            ep.paused = False
+            ep.throttled = True
+            # backpressure keeps it off until its peers have room
+            if not ep.eof and ep.can_read():
+                self.set_mask(ep, ep.mask | selectors.EVENT_READ)
+
+    def read(self, ep):
+        session = ep.session
+        limit = ep.recv_size
+        shaping = session.shaping
+        if shaping is not None:
+            if ep.paused:
+                # read interest came back with a flush, the pause still holds
+                self.set_mask(ep, ep.mask & ~selectors.EVENT_READ)
+                return
+            limit = min(limit, shaping.allowance())
+            if limit < shaping.min_read():
+                self.pause(ep, shaping.delay())
+                return
+        if ep.err_peer is not None and ep.is_channel and not self.read_stderr(ep):
+            return
+        data = ep.recv(limit)
+        if data is None:
+            return
+        if len(data) == 0:
+            # stderr sent before the eof goes out first
+            if ep.err_peer is not None and ep.is_channel and not self.read_stderr(ep):
+                return
+            self.eof(ep)
+            return
+        if limit == ep.recv_size:
+            ep.recv_size = adapt_buffer_size(ep.recv_size, len(data), config["RELAY_BUFFER_MIN"], config["RELAY_BUFFER_MAX"])
+        if ep.coalesce and len(data) < min(ep.coalesce, limit):
+            data = ep.recv_more(data, min(ep.coalesce, limit))
+        ep.bytes += len(data)
+        if shaping is not None:
+            shaping.consume(len(data))
+            # delayed or cut short by the buckets
+            if ep.throttled or limit < ep.recv_size:
+                shaping.throttled_bytes += len(data)
+                ep.throttled = False
+        if session.echo is not None:
+            self.measure_echo(session, ep)
+        if ep is session.endpoints[1]:
+            session.date_last_active = datetime.datetime.utcnow()
+            if session.recording is not None:
+                recorder.record(session.recording, "o", data)
+            if session.audit is not None:
+                auditor.feed(session.audit, "o", data)
+        else:
+            if session.recording is not None and config["RECORD_INPUT"]:
+                recorder.record(session.recording, "i", data)
+            if session.audit is not None:
+                auditor.feed(session.audit, "i", data)
+        if ep.demux is None:
+            self.write(ep.peer, data if isinstance(data, memoryview) else memoryview(data))
+            return
+        for stream, payload in ep.demux.feed(data):
+            self.write(ep.err_peer if stream == 2 and ep.err_peer else ep.peer, memoryview(payload))
+
+    def read_stderr(self, ep) -> bool:
+        """
+        Relay all stderr paramiko buffered for an exec channel.
+        :return False when the client fell behind, the rest is read once it caught up
+        """
+        while ep.io.recv_stderr_ready():
+            if not ep.can_read():
+                self.set_mask(ep, ep.mask & ~selectors.EVENT_READ)
+                return False
+            data = ep.recv_stderr()
+            ep.bytes += len(data)
+            self.write(ep.err_peer, memoryview(data))
+        return True
+
+    def measure_echo(self, session, ep):
+        """
+        Time from client input to the next output of the server, the
+        echo of a keystroke. Output no key asked for (e.g. a clock
+        redraw) can end a measurement early.
+        """
+        if ep is session.endpoints[0]:
+            if session.echo_start is None:
+                session.echo_start = time.monotonic()
+        elif session.echo_start is not None:
+            latency = time.monotonic() - session.echo_start
+            session.echo_start = None
+            session.echo.append(latency)
+            self.echo_histogram[bisect.bisect_left(config["ECHO_BUCKETS_MS"], latency * 1000)] += 1
+
+    def eof(self, ep):
+        """
+        ep has no more input, finish the session once its data is
+        delivered. The end of an exec request's stdin only half closes.
+        """
+        session = ep.session
+        ep.eof = True
+        self.set_mask(ep, ep.mask & ~selectors.EVENT_READ)
+        if not ep.drained():
+            return
+        client = session.endpoints[0]
+        if ep is client and session.command is not None and not client.io.closed:
+            ep.peer.shutdown_write()
+            return
+        if ep is client:
+            msg = "Client close the connection: {}".format(session.client)
+        else:
+            msg = "Server close the connection"
+        pretty_logger.info(msg)
+        self.finish(session)
+
+    def write(self, ep, data):
+        if ep.pending is not None:
+            # keep order behind what is already waiting
+            ep.pending = bytes(ep.pending) + bytes(data)
+            return
+        sent = ep.send(data)
+        if sent == len(data):
+            return
+        # backpressure: stop reading the source until this side drained
+        ep.pending = data[sent:]
+        self.set_mask(ep.peer, ep.peer.mask & ~selectors.EVENT_READ)
+        self.wait_send(ep)
+
+    def flush(self, ep):
+        if ep.pending is None:
+            return
+        sent = ep.send(ep.pending)
+        if sent < len(ep.pending):
+            ep.pending = ep.pending[sent:]
+            self.wait_send(ep)
+            return
+        ep.pending = None
+        if not ep.is_channel:
+            self.set_mask(ep, ep.mask & ~selectors.EVENT_WRITE)
+        self.wake_source(ep)
+
+    def wait_send(self, ep):
+        """
+        Flush ep again once it may take more. A socket says so itself, a
+        channel waits for room in its transport socket or, when its
+        remote window is full, is retried after RELAY_WINDOW_RETRY.
+        """
+        if not ep.is_channel:
+            self.set_mask(ep, ep.mask | selectors.EVENT_WRITE)
+            return
+        if ep.waiting:
+            return
+        ep.waiting = True
+        sock = ep.io.get_transport().sock
+        if send_room(sock) > _PACKET_OVERHEAD:
+            heapq.heappush(self.retries, (time.monotonic() + config["RELAY_WINDOW_RETRY"], next(self.seq), ep))
+            return
+        waiter = self.waiters.get(sock)
+        if waiter is None:
+            waiter = self.waiters[sock] = SendWaiter(sock)
+            self.register_io(waiter, selectors.EVENT_WRITE)
+        waiter.endpoints.add(ep)
+
+    def stop_waiting(self, ep):
+        if not ep.waiting:
+            return
+        ep.waiting = False
+        # a retry left in the heap is skipped
+        for sock, waiter in list(self.waiters.items()):
+            waiter.endpoints.discard(ep)
+            if not waiter.endpoints:
+                self.drop_waiter(sock)
+
+    def drop_waiter(self, sock):
+        waiter = self.waiters.pop(sock)
+        try:
+            self.sel.unregister(waiter)
+        except (KeyError, ValueError, OSError):
+            pass
+
+    def send_ready(self, waiter):
+        """
+        The transport socket of waiting channel endpoints has room.
+        """
+        self.drop_waiter(waiter.sock)
+        for ep in waiter.endpoints:
+            self.send_again(ep)
+
+    def retry(self):
+        now = time.monotonic()
+        while self.retries and self.retries[0][0] <= now:
+            _, _, ep = heapq.heappop(self.retries)
+            self.send_again(ep)
+
+    def send_again(self, ep):
+        if not ep.waiting or ep.session.is_finished:
+            return
+        ep.waiting = False
+        try:
+            self.flush(ep)
+        except (OSError, EOFError, socket.error) as e:
+            pretty_logger.info("Session {} relay closed: {}".format(ep.session.id, e))
+            self.finish(ep.session)
+
+    def wake_source(self, ep):
+        """
+        ep took data, read its source again or finish a pending eof.
+        """
+        source = ep.peer
+        if source.eof:
+            if source.drained():
+                self.eof(source)
+        elif not source.paused and source.can_read():
+            self.set_mask(source, source.mask | selectors.EVENT_READ)
+
+
+class RelayEngine:
+    """
+    A few selector threads servicing every session's client/server pair.
+    """
+
+    def __init__(self, threads=None):
+        self.threads = threads or config["RELAY_THREADS"]
+        self.loops = []
+        self.finisher = None
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.loops:
+                return
+            # finish callbacks close channels and transports, keep that off the loops
+            self.finisher = ThreadPoolExecutor(max_workers=config["RELAY_FINISH_THREADS"], thread_name_prefix="relay-finish")
+            for i in range(self.threads):
+                loop = RelayLoop("relay-{}".format(i), self.finisher)
+                loop.start()
+                self.loops.append(loop)
+
+    def add(self, session):
+        self.start()
+        loop = min(self.loops, key=lambda x: (x.sessions, next(self.counter)))
+        with Session.lock:
+            if session.is_finished:
+                return
+            session.loop = loop
+            # queued under the lock, a stop seeing the loop queues its finish behind
+            loop.call(loop.add, session)
+
+    def stats(self):
+        return {
+            "sessions": len(Session.sessions),
+            "loops": [loop.sessions for loop in self.loops],
+            # sums up across channel workers in /api/session/stats
+            "echo_histogram": [sum(x) for x in zip(*(loop.echo_histogram for loop in self.loops))],
+        }
+
+
+relay_engine = RelayEngine()
@@ -0,0 +1,88 @@
+from cae.config import channel_config as config
+from concurrent.futures import ThreadPoolExecutor
+from pretty_logging import pretty_logger
+import threading
+import time
+import traceback
+
+
+class PtyResizer:
+    """
+    Window changes only store the latest size of the session, a dispatcher
+    thread waits RESIZE_DEBOUNCE for a burst to settle and applies it from
+    a small pool, as the docker exec_resize is a blocking http call. A size
+    replaced before it was applied is counted as dropped. One resize per
+    session is in flight at a time, sizes arriving meanwhile follow it.
+    """
+
+    def __init__(self):
+        self.pending = {}  # session -> (width, height)
+        self.inflight = set()
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.workers = None
+        self.requested = 0
+        self.applied = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def start(self):
+        with self.lock:
+            if self.thread:
+                return
+            self.workers = ThreadPoolExecutor(max_workers=config["RESIZE_THREADS"], thread_name_prefix="resize")
+            self.thread = threading.Thread(target=self.run, daemon=True, name="resize")
+            self.thread.start()
+
+    def request(self, session, width, height):
+        """
+        Called from the transport thread, never blocks on docker.
+        """
+        self.start()
+        with self.lock:
+            self.requested += 1
+            if session in self.pending:
+                self.dropped += 1
+            self.pending[session] = (width, height)
+        self.wakeup.set()
+
+    def run(self):
+        while True:
+            self.wakeup.wait()
+            time.sleep(config["RESIZE_DEBOUNCE"])
+            with self.lock:
+                self.wakeup.clear()
+                ready = [(s, size) for s, size in self.pending.items() if s not in self.inflight]
+                for session, _ in ready:
+                    del self.pending[session]
+                    self.inflight.add(session)
+            for session, (width, height) in ready:
+                self.workers.submit(self.apply, session, width, height)
+
+    def apply(self, session, width, height):
+        try:
+            if not session.is_finished:
+                session.resize_win_size(width, height)
+                self.applied += 1
+        except Exception:
+            self.failed += 1
+            pretty_logger.error(traceback.format_exc())
+        finally:
+            with self.lock:
+                self.inflight.discard(session)
+                again = session in self.pending
+            if again:
+                self.wakeup.set()
+
+    def stats(self):
+        return {
+            "pending": len(self.pending),
+            "requested": self.requested,
+            "applied": self.applied,
+            "dropped": self.dropped,
+            "failed": self.failed,
+        }
+
+
+resizer = PtyResizer()
@@ -0,0 +1,662 @@
+from cae.config import channel_config as config
+from cae.services import docker_service
+from docker.errors import NotFound
+from docker.models.containers import Container
+from pretty_logging import pretty_logger
+from .relay import Session
+from .cache import container_cache
+import datetime
+import io
+import os
+import posixpath
+import re
+import stat
+import tarfile
+import tempfile
+import time
+import uuid
+import paramiko
+from paramiko import SFTPAttributes, SFTPHandle, SFTP_OK, SFTP_FAILURE, SFTP_NO_SUCH_FILE, SFTP_PERMISSION_DENIED, \
+    SFTP_OP_UNSUPPORTED
+
+
+class SFTPServer:
+    def __init__(self, client, asset, system_user, container: Container, userinfo: dict):
+        """
+        sftp for containers without sshd, files go through the docker
+        archive api and file operations through `docker exec` as the user.
+
+        userinfo:{
+            username string
+            uid string
+            gid string
+            home string
+        }
+        """
+        self.client = client
+        self.asset = asset
+        self.system_user = system_user
+        self.container = container
+        self.userinfo = userinfo
+        self.server = None
+
+    def proxy(self):
+        if self.client.closed:
+            return
+        self.server = Server(self.asset, self.system_user, self.container)
+        session = Session.new_session(self.client, self.server, kind="sftp", command="sftp")
+        session.on_finish(self.finish)
+        handler = SFTPSubsystem(session, self.client.chan, "sftp", None, ContainerSFTPInterface,
+                                container=self.container, userinfo=self.userinfo)
+        handler.start()
+
+    def finish(self, session):
+        Session.remove_session(session.id)
+        self.server.close()
+        msg = 'Session end, total {} now'.format(
+            len(Session.sessions),
+        )
+        pretty_logger.info(msg)
+
+
+class SFTPSubsystem(paramiko.SFTPServer):
+    """
+    paramiko sftp server on its own thread, bound to the session so the
+    client is released when it ends and `stop_evt` ends it.
+    """
+
+    def __init__(self, session, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.session = session
+
+    def finish_subsystem(self):
+        # uploads the client never closed are dropped, not committed
+        for f in self.file_table.values():
+            f.aborted = True
+        try:
+            super().finish_subsystem()
+        finally:
+            self.session.stop()
+
+
+class Server(object):
+
+    def __init__(self, asset, system_user, container: Container):
+        self.id = str(uuid.uuid4())
+        self.chan = None
+        self.asset = asset
+        self.system_user = system_user
+        self.container = container
+        self._closed = False
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def close(self):
+        pretty_logger.info("Server {} close".format(self))
+        self._closed = True
+
+    def __str__(self):
+        return "sftp %s:%s" % (self.container.id[:12], self.system_user.get("username"))
+
+
+class ContainerSFTPInterface(paramiko.SFTPServerInterface):
+    """
+    Reads stream `get_archive` tar extraction, writes are spooled (memory,
+    then disk) and streamed to `put_archive` on close. Users other than
+    root get the same access they have inside the container: paths are
+    checked with `test` and `stat` run as the user before the archive api
+    touches them, writes are staged in their home and moved in place by
+    the user, everything else runs as the user.
+    """
+
+    def __init__(self, server, container: Container, userinfo: dict, *args, **kwargs):
+        super().__init__(server, *args, **kwargs)
+        self.container = container
+        self.username = userinfo["username"]
+        self.uid = int(userinfo["uid"])
+        self.gid = int(userinfo["gid"])
+        self.home = userinfo["home"] or "/"
+
+    def canonicalize(self, path):
+        if not path.startswith("/"):
+            path = posixpath.join(self.home, path)
+        return posixpath.normpath(path).replace("//", "/")
+
+    def run(self, *cmd):
+        """
+        Run cmd as the user, :return (exit code, stdout, stderr)
+        """
+        try:
+            result = self.container.exec_run(list(cmd), user=self.username, demux=True)
+        except Exception as e:
+            pretty_logger.error("sftp exec {} error: {}".format(cmd[0], e))
+            return -1, b"", str(e).encode()
+        out, err = result.output if result.output else (b"", b"")
+        return result.exit_code, out or b"", err or b""
+
+    def run_status(self, *cmd):
+        code, _, err = self.run(*cmd)
+        if code == 0:
+            return SFTP_OK
+        return error_status(err)
+
+    def access(self, path, test=None):
+        """
+        Check path as the user, the archive api reads it as root. Reaching
+        path takes search permission on every directory above it, test
+        ("-r", "-w", "-x") is then checked on path itself.
+        :return SFTP_OK or an sftp error code
+        """
+        if self.uid == 0:
+            return SFTP_OK
+        if test is not None and self.run("test", test, path)[0] == 0:
+            return SFTP_OK
+        # why it failed, or whether path can be reached at all
+        code, _, err = self.run("stat", "-c", "%n", "--", path)
+        if code != 0:
+            return error_status(err)
+        return SFTP_OK if test is None else SFTP_PERMISSION_DENIED
+
+    def list_folder(self, path):
+        path = self.canonicalize(path)
+        entries = container_cache.listing(self.container.id, path, self.uid)
+        if entries is None:
+            entries = self.read_folder(path)
+            if isinstance(entries, int):
+                return entries
+            container_cache.set_listing(self.container.id, path, self.uid, entries)
+        return list(entries.values())
+
+    def read_folder(self, path):
+        """
+        :return {name: SFTPAttributes} or an sftp error code
+        """
+        # one exec listing with stat, falls back to walking the archive headers
+        code, out, err = self.run("find", path, "-mindepth", "1", "-maxdepth", "1",
+                                  "-exec", "stat", "-c", "%s|%f|%u|%g|%X|%Y|%n", "{}", "+")
+        if code == 0:
+            entries = {}
+            for line in out.decode(errors="surrogateescape").splitlines():
+                fields = line.split("|", 6)
+                if len(fields) < 7:
+                    continue
+                attr = SFTPAttributes()
+                attr.st_size, attr.st_mode = int(fields[0]), int(fields[1], 16)
+                attr.st_uid, attr.st_gid = int(fields[2]), int(fields[3])
+                attr.st_atime, attr.st_mtime = int(fields[4]), int(fields[5])
+                attr.filename = posixpath.basename(fields[6])
+                entries[attr.filename] = attr
+            return entries
+        if b"No such file" in err:
+            return SFTP_NO_SUCH_FILE
+        if b"Permission denied" in err:
+            return SFTP_PERMISSION_DENIED
+        return self.walk_folder(path)
+
+    def walk_folder(self, path):
+        for test in ("-r", "-x"):
+            code = self.access(path, test)
+            if code != SFTP_OK:
+                return code
+        entries = {}
+        try:
+            stream, tar = self.open_archive(path)
+        except NotFound:
+            return SFTP_NO_SUCH_FILE
+        try:
+            with tar:
+                root = None
+                for member in tar:
+                    if root is None:
+                        root = member.name.rstrip("/")
+                        continue
+                    name = member.name[len(root) + 1:].rstrip("/")
+                    if name and "/" not in name:
+                        entries[name] = tar_attributes(member, name)
+        finally:
+            stream.close()
+        return entries
+
+    def stat(self, path):
+        path = self.canonicalize(path)
+        # a fresh listing of the parent by this user saves the round trips
+        entries = container_cache.listing(self.container.id, posixpath.dirname(path), self.uid)
+        if entries and posixpath.basename(path) in entries:
+            return entries[posixpath.basename(path)]
+        code = self.access(path)
+        if code != SFTP_OK:
+            return code
+        return self.path_stat(path)
+
+    lstat = stat
+
+    def path_stat(self, path):
+        try:
+            info = docker_service.container_path_stat(self.container, path)
+        except NotFound:
+            return SFTP_NO_SUCH_FILE
+        if not info:
+            return SFTP_NO_SUCH_FILE
+        attr = SFTPAttributes()
+        attr.st_size = info.get("size", 0)
+        attr.st_mode = posix_mode(info.get("mode", 0))
+        attr.st_mtime = attr.st_atime = parse_time(info.get("mtime"))
+        attr.filename = info.get("name") or posixpath.basename(path)
+        return attr
+
+    def readlink(self, path):
+        path = self.canonicalize(path)
+        code = self.access(path)
+        if code != SFTP_OK:
+            return code
+        try:
+            info = docker_service.container_path_stat(self.container, path)
+        except NotFound:
+            return SFTP_NO_SUCH_FILE
+        return info.get("linkTarget") or SFTP_FAILURE
+
+    def open(self, path, flags, attr):
+        path = self.canonicalize(path)
+        if flags & (os.O_WRONLY | os.O_RDWR):
+            return self.open_write(path, flags, attr)
+        code = self.access(path, "-r")
+        if code != SFTP_OK:
+            return code
+        handle = ArchiveReader(self, path, flags)
+        code = handle.open_stream()
+        if code != SFTP_OK:
+            return code
+        return handle
+
+    def open_write(self, path, flags, attr):
+        code = self.access(path)
+        if code not in (SFTP_OK, SFTP_NO_SUCH_FILE):
+            return code
+        current = self.path_stat(path) if code == SFTP_OK else code
+        exists = not isinstance(current, int)
+        if not exists and not flags & os.O_CREAT:
+            return SFTP_NO_SUCH_FILE
+        if exists and flags & os.O_EXCL:
+            return SFTP_FAILURE
+        if exists and (attr is None or attr.st_mode is None):
+            # overwriting keeps the mode
+            attr = attr or SFTPAttributes()
+            attr.st_mode = current.st_mode
+        handle = ArchiveWriter(self, path, flags, attr)
+        if exists and not flags & os.O_TRUNC:
+            # resume or in place edit, start from the current content
+            code = handle.prefill()
+            if code != SFTP_OK:
+                return code
+        return handle
+
+    def open_archive(self, path):
+        """
+        :return (stream, tar) reading the archive of path as it arrives
+        """
+        res = docker_service.container_get_archive(self.container, path)
+        stream = IterStream(res.iter_content(config["SFTP_CHUNK_SIZE"], False), res)
+        try:
+            return stream, tarfile.open(fileobj=stream, mode="r|")
+        except Exception:
+            stream.close()
+            raise
+
+    def commit(self, path, spool, size, attr):
+        """
+        Stream the spooled file to path through `put_archive`.
+        """
+        name = posixpath.basename(path)
+        target_dir = posixpath.dirname(path)
+        if self.uid != 0:
+            # staged as the user's own file, the user moves it so their permissions apply
+            name = ".cae-upload-{}".format(uuid.uuid4().hex)
+            target_dir = self.home
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mode = attr.st_mode & 0o7777 if attr and attr.st_mode is not None else 0o644
+        info.mtime = attr.st_mtime if attr and attr.st_mtime is not None else time.time()
+        info.uid, info.gid = self.uid, self.gid
+        if not self.container.put_archive(target_dir, tar_stream(info, spool)):
+            return SFTP_FAILURE
+        container_cache.forget_listing(self.container.id, posixpath.dirname(path))
+        if self.uid == 0:
+            return SFTP_OK
+        staged = posixpath.join(target_dir, name)
+        code = self.run_status("mv", "-f", "--", staged, path)
+        if code != SFTP_OK:
+            self.run("rm", "-f", "--", staged)
+        return code
+
+    def remove(self, path):
+        path = self.canonicalize(path)
+        container_cache.forget_listing(self.container.id, posixpath.dirname(path))
+        return self.run_status("rm", "-f", "--", path)
+
+    def rename(self, oldpath, newpath):
+        oldpath, newpath = self.canonicalize(oldpath), self.canonicalize(newpath)
+        if not isinstance(self.path_stat(newpath), int):
+            return SFTP_FAILURE
+        return self.posix_rename(oldpath, newpath)
+
+    def posix_rename(self, oldpath, newpath):
+        oldpath, newpath = self.canonicalize(oldpath), self.canonicalize(newpath)
+        container_cache.forget_listing(self.container.id, posixpath.dirname(oldpath))
+        container_cache.forget_listing(self.container.id, posixpath.dirname(newpath))
+        return self.run_status("mv", "-f", "--", oldpath, newpath)
+
+    def mkdir(self, path, attr):
+        path = self.canonicalize(path)
+        container_cache.forget_listing(self.container.id, posixpath.dirname(path))
+        if attr and attr.st_mode is not None:
+            return self.run_status("mkdir", "-m", "{:o}".format(attr.st_mode & 0o7777), "--", path)
+        return self.run_status("mkdir", "--", path)
+
+    def rmdir(self, path):
+        path = self.canonicalize(path)
+        container_cache.forget_listing(self.container.id, posixpath.dirname(path))
+        return self.run_status("rmdir", "--", path)
+
+    def chattr(self, path, attr):
+        path = self.canonicalize(path)
+        container_cache.forget_listing(self.container.id, posixpath.dirname(path))
+        if attr.st_mode is not None:
+            code = self.run_status("chmod", "{:o}".format(attr.st_mode & 0o7777), "--", path)
+            if code != SFTP_OK:
+                return code
+        if attr.st_mtime is not None:
+            stamp = datetime.datetime.utcfromtimestamp(attr.st_mtime).strftime("%Y%m%d%H%M.%S")
+            return self.run_status("env", "TZ=UTC", "touch", "-c", "-m", "-t", stamp, "--", path)
+        return SFTP_OK
+
+    def symlink(self, target_path, path):
+        path = self.canonicalize(path)
+        container_cache.forget_listing(self.container.id, posixpath.dirname(path))
+        return self.run_status("ln", "-s", "--", target_path, path)
+
+
+class ArchiveReader(SFTPHandle):
+    """
+    Sequential reads come straight off the archive stream, reading behind
+    the current position reopens it.
+    """
+
+    def __init__(self, sftp: ContainerSFTPInterface, path, flags=0):
+        super().__init__(flags)
+        self.sftp = sftp
+        self.path = path
+        self.stream = None
+        self.tar = None
+        self.file = None
+        self.member = None
+        self.pos = 0
+        self.aborted = False
+
+    def open_stream(self, hops=8):
+        self.close_stream()
+        try:
+            self.stream, self.tar = self.sftp.open_archive(self.path)
+            member = self.tar.next()
+        except NotFound:
+            self.close_stream()
+            return SFTP_NO_SUCH_FILE
+        except Exception:
+            self.close_stream()
+            raise
+        if member is not None and member.issym() and hops > 0:
+            # the archive holds the link itself, read its target instead
+            self.path = posixpath.normpath(posixpath.join(posixpath.dirname(self.path), member.linkname))
+            return self.open_stream(hops - 1)
+        if member is None or not member.isfile():
+            self.close_stream()
+            return SFTP_FAILURE
+        self.member = member
+        self.file = self.tar.extractfile(member)
+        self.pos = 0
+        return SFTP_OK
+
+    def close_stream(self):
+        if self.stream:
+            self.stream.close()
+        self.stream = self.tar = self.file = None
+
+    def read(self, offset, length):
+        if self.file is None or offset < self.pos:
+            code = self.open_stream()
+            if code != SFTP_OK:
+                return code
+        while self.pos < offset:
+            skipped = self.file.read(min(offset - self.pos, config["SFTP_CHUNK_SIZE"]))
+            if not skipped:
+                return b""
+            self.pos += len(skipped)
+        data = self.file.read(length)
+        self.pos += len(data)
+        return data
+
+    def stat(self):
+        return tar_attributes(self.member, posixpath.basename(self.path))
+
+    def close(self):
+        self.close_stream()
+
+
+class ArchiveWriter(SFTPHandle):
+    """
+    Writes land in a spool file, bounded in memory and on disk beyond
+    that, which is streamed to the container when the client closes.
+    A file growing past SFTP_UPLOAD_MAX fails the write and is dropped.
+    """
+
+    def __init__(self, sftp: ContainerSFTPInterface, path, flags, attr):
+        super().__init__(flags)
+        self.sftp = sftp
+        self.path = path
+        self.append = bool(flags & os.O_APPEND)
+        self.attr = attr
+        self.spool = tempfile.SpooledTemporaryFile(max_size=config["SFTP_SPOOL_MEMORY"])
+        self.aborted = False
+        self.closed = False
+
+    def prefill(self):
+        code = self.sftp.access(self.path, "-r")
+        if code != SFTP_OK:
+            return code
+        reader = ArchiveReader(self.sftp, self.path)
+        code = reader.open_stream()
+        if code != SFTP_OK:
+            return code
+        while True:
+            chunk = reader.file.read(config["SFTP_CHUNK_SIZE"])
+            if not chunk:
+                break
+            if not self.fits(self.spool.tell() + len(chunk)):
+                reader.close()
+                self.spool.close()
+                return SFTP_FAILURE
+            self.spool.write(chunk)
+        reader.close()
+        return SFTP_OK
+
+    def fits(self, size) -> bool:
+        if size <= config["SFTP_UPLOAD_MAX"]:
+            return True
+        pretty_logger.info("upload {} exceeds {} bytes".format(self.path, config["SFTP_UPLOAD_MAX"]))
+        # what was written so far is not committed as if complete
+        self.aborted = True
+        return False
+
+    def write(self, offset, data):
+        if self.aborted:
+            return SFTP_FAILURE
+        if self.append:
+            self.spool.seek(0, io.SEEK_END)
+        else:
+            self.spool.seek(offset)
+        if not self.fits(self.spool.tell() + len(data)):
+            return SFTP_FAILURE
+        self.spool.write(data)
+        return SFTP_OK
+
+    def read(self, offset, length):
+        self.spool.seek(offset)
+        return self.spool.read(length)
+
+    def stat(self):
+        attr = SFTPAttributes()
+        attr.st_size = self.spool.seek(0, io.SEEK_END)
+        attr.st_mode = stat.S_IFREG | (self.attr.st_mode & 0o7777 if self.attr and self.attr.st_mode is not None else 0o644)
+        attr.st_uid, attr.st_gid = self.sftp.uid, self.sftp.gid
+        return attr
+
+    def chattr(self, attr):
+        # applied to the archive header on close
+        if attr.st_size is not None:
+            if not self.fits(attr.st_size):
+                return SFTP_FAILURE
+            self.spool.truncate(attr.st_size)
+        if self.attr is None:
+            self.attr = attr
+        else:
+            if attr.st_mode is not None:
+                self.attr.st_mode = attr.st_mode
+            if attr.st_mtime is not None:
+                self.attr.st_mtime = attr.st_mtime
+        return SFTP_OK
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if self.aborted:
+                return
+            size = self.spool.seek(0, io.SEEK_END)
+            self.spool.seek(0)
+            code = self.sftp.commit(self.path, self.spool, size, self.attr)
+            if code != SFTP_OK:
+                # paramiko ignores the close return value, an exception is reported as failure
+                raise IOError("upload {} failed: {}".format(self.path, code))
+        finally:
+            self.spool.close()
+
+
+class IterStream(io.RawIOBase):
+    """
+    File object over the chunks of a docker archive stream, closing it
+    closes the response so its pooled connection is released.
+    """
+
+    def __init__(self, chunks, response=None):
+        self.chunks = chunks
+        self.response = response
+        self.buf = memoryview(b"")
+        self.offset = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while self.offset >= len(self.buf):
+            try:
+                self.buf = memoryview(next(self.chunks))
+            except StopIteration:
+                return 0
+            self.offset = 0
+        n = min(len(b), len(self.buf) - self.offset)
+        b[:n] = self.buf[self.offset:self.offset + n]
+        self.offset += n
+        return n
+
+    def close(self):
+        close = getattr(self.chunks, "close", None)
+        if close:
+            close()
+        if self.response is not None:
+            self.response.close()
+        super().close()
+
+
+def tar_stream(info: tarfile.TarInfo, fileobj, chunk_size=None):
+    """
+    Yield a one file tar in chunks, the content is read from fileobj as it goes.
+    """
+    chunk_size = chunk_size or config["SFTP_CHUNK_SIZE"]
+    yield info.tobuf(format=tarfile.PAX_FORMAT)
+    remain = info.size
+    while remain > 0:
+        chunk = fileobj.read(min(chunk_size, remain))
+        if not chunk:
+            raise IOError("spool ended {} bytes early".format(remain))
+        remain -= len(chunk)
+        yield chunk
+    padding = -info.size % tarfile.BLOCKSIZE
+    yield b"\0" * (padding + 2 * tarfile.BLOCKSIZE)
+
+
+def tar_attributes(member: tarfile.TarInfo, name) -> SFTPAttributes:
+    attr = SFTPAttributes()
+    attr.st_size = member.size
+    attr.st_uid, attr.st_gid = member.uid, member.gid
+    attr.st_mtime = attr.st_atime = int(member.mtime)
+    if member.isdir():
+        kind = stat.S_IFDIR
+    elif member.issym():
+        kind = stat.S_IFLNK
+    else:
+        kind = stat.S_IFREG
+    attr.st_mode = kind | member.mode
+    attr.filename = name
+    return attr
+
+
+# go os.FileMode type bits as returned by the docker path stat
+_GO_MODE_DIR = 1 << 31
+_GO_MODE_SYMLINK = 1 << 27
+
+
+def posix_mode(mode: int) -> int:
+    if mode & _GO_MODE_DIR:
+        kind = stat.S_IFDIR
+    elif mode & _GO_MODE_SYMLINK:
+        kind = stat.S_IFLNK
+    else:
+        kind = stat.S_IFREG
+    return kind | (mode & 0o777)
+
+
+_RFC3339 = re.compile(r"(\d{4})-(\d\d)-(\d\d)[Tt ](\d\d):(\d\d):(\d\d)(?:\.\d+)?(?:([Zz])|([+-])(\d\d):(\d\d))$")
+
+
+def parse_time(value) -> int:
+    """
+    RFC 3339 time with up to nanoseconds, as docker writes it. Parsed by
+    hand, `fromisoformat` before python 3.11 takes neither the `Z` nor
+    fractions other than 3 or 6 digits.
+    """
+    match = _RFC3339.match(value or "")
+    if not match:
+        return 0
+    year, month, day, hour, minute, second = (int(g) for g in match.group(1, 2, 3, 4, 5, 6))
+    offset = datetime.timedelta()
+    if not match.group(7):
+        offset = datetime.timedelta(hours=int(match.group(9)), minutes=int(match.group(10)))
+        if match.group(8) == "-":
+            offset = -offset
+    try:
+        moment = datetime.datetime(year, month, day, hour, minute, second, tzinfo=datetime.timezone(offset))
+    except ValueError:
+        return 0
+    return int(moment.timestamp())
+
+
+def error_status(err: bytes) -> int:
+    if b"No such file" in err:
+        return SFTP_NO_SUCH_FILE
+    if b"Permission denied" in err or b"Operation not permitted" in err:
+        return SFTP_PERMISSION_DENIED
+    if b"not found" in err or b"executable file" in err:
+        return SFTP_OP_UNSUPPORTED
+    return SFTP_FAILURE
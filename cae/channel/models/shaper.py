@@ -0,0 +1,160 @@
+from cae.config import channel_config as config
+from .cache import container_cache
+from pretty_logging import pretty_logger
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    `rate` bytes a second, holding BANDWIDTH_BURST seconds of it. Shared
+    by the relay loops, a read may take a little more than what was left
+    so tokens can go below zero.
+    """
+    __slots__ = ("rate", "burst", "tokens", "last", "lock", "refs")
+
+    def __init__(self, rate):
+        self.rate = rate
+        # room for a bulk read above the pty reserve even at low rates
+        self.burst = max(int(rate * config["BANDWIDTH_BURST"]), config["BANDWIDTH_MIN_READ"] * 4)
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+        self.refs = 0
+
+    def available(self, now) -> float:
+        with self.lock:
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            return self.tokens
+
+    def consume(self, n):
+        with self.lock:
+            self.tokens -= n
+
+
+class SessionShaping:
+    """
+    The buckets one session draws from, global, its instance and its user.
+    """
+    __slots__ = ("buckets", "pty", "throttled_bytes", "pauses")
+
+    def __init__(self, buckets, pty):
+        self.buckets = buckets  # [(key, bucket, reserve)]
+        self.pty = pty
+        self.throttled_bytes = 0
+        self.pauses = 0
+
+    def allowance(self) -> int:
+        """
+        :return bytes the session may relay now
+        """
+        now = time.monotonic()
+        return int(min(bucket.available(now) - reserve for _, bucket, reserve in self.buckets))
+
+    def consume(self, n):
+        for _, bucket, _ in self.buckets:
+            bucket.consume(n)
+
+    def min_read(self) -> int:
+        # a keystroke echo is never held for a full packet
+        return 1 if self.pty else config["BANDWIDTH_MIN_READ"]
+
+    def delay(self) -> float:
+        """
+        Seconds until the emptiest bucket allows a read again.
+        """
+        now = time.monotonic()
+        need = self.min_read()
+        return max(max((reserve + need - bucket.available(now)) / bucket.rate for _, bucket, reserve in self.buckets), 0.001)
+
+
+class BandwidthShaper:
+    """
+    Token buckets the relay loops check before reading a side of a
+    session, a session out of tokens is not read until they refill.
+    Sessions without any configured limit skip shaping altogether.
+
+    Pty sessions get priority on the global bucket, other sessions
+    (tunnels, exec, sftp) stop BANDWIDTH_PTY_RESERVE of its burst earlier
+    so keystrokes and screens still get through while bulk traffic
+    saturates it. Instance and user limits apply to every session.
+    """
+
+    def __init__(self):
+        self.buckets = {}  # key -> TokenBucket, while sessions use it
+        self.sessions = set()  # live SessionShaping
+        self.lock = threading.Lock()
+        self.shaped = 0
+        self.throttled_bytes = 0  # of finished sessions
+        self.pauses = 0
+
+    def limits(self, session) -> list:
+        """
+        :return [(key, bytes a second)] of the limits that apply, a
+        `cae.bandwidth` container label overrides the instance limit
+        """
+        user = session.client.user or {}
+        instance_id = user.get("instance_id")
+        instance_rate = config["BANDWIDTH_INSTANCE"]
+        entry = container_cache.entries.get(instance_id)
+        label = entry.container.labels.get("cae.bandwidth") if entry is not None else None
+        if label:
+            try:
+                instance_rate = int(label)
+            except ValueError:
+                pretty_logger.error("invalid cae.bandwidth label {!r} of {}".format(label, instance_id))
+        limits = [
+            ("global", config["BANDWIDTH_GLOBAL"]),
+            ("instance/{}".format(instance_id), instance_rate),
+            ("user/{}/{}".format(instance_id, user.get("username")), config["BANDWIDTH_USER"]),
+        ]
+        return [(key, rate) for key, rate in limits if rate > 0]
+
+    def attach(self, session):
+        """
+        :return the SessionShaping of the session or None when unlimited
+        """
+        limits = self.limits(session)
+        if not limits:
+            return None
+        pty = "term" in session.client.request.meta
+        buckets = []
+        with self.lock:
+            for key, rate in limits:
+                bucket = self.buckets.get(key)
+                if bucket is None or bucket.rate != rate:
+                    bucket = self.buckets[key] = TokenBucket(rate)
+                bucket.refs += 1
+                reserve = 0
+                if key == "global" and not pty:
+                    reserve = bucket.burst * config["BANDWIDTH_PTY_RESERVE"]
+                buckets.append((key, bucket, reserve))
+            self.shaped += 1
+            shaping = SessionShaping(buckets, pty)
+            self.sessions.add(shaping)
+        return shaping
+
+    def detach(self, shaping):
+        with self.lock:
+            self.sessions.discard(shaping)
+            self.throttled_bytes += shaping.throttled_bytes
+            self.pauses += shaping.pauses
+            for key, bucket, _ in shaping.buckets:
+                bucket.refs -= 1
+                if bucket.refs <= 0 and self.buckets.get(key) is bucket:
+                    del self.buckets[key]
+
+    def stats(self):
+        with self.lock:
+            live = list(self.sessions)
+        return {
+            "buckets": len(self.buckets),
+            "shaped_sessions": self.shaped,
+            # bytes read late because their session was paused
+            "throttled_bytes": self.throttled_bytes + sum(s.throttled_bytes for s in live),
+            "pauses": self.pauses + sum(s.pauses for s in live),
+        }
+
+
+shaper = BandwidthShaper()
@@ -1,96 +1,274 @@
-import os
 import socket
+import selectors
+import time
+from concurrent.futures import ThreadPoolExecutor
 from cae.config import channel_config as config
-from cae.channel.utils import ssh_key_gen
-from cae.channel.models import Connection, SSHInterface, InteractiveServer
+from cae.channel.utils import get_host_key, SelectEvent, tune_socket
+from cae.channel.models import Connection, SSHInterface, InteractiveServer, instance_cache, container_cache, relay_engine, \
+    SSHConnection, forward_manager, recorder, auditor, registry, resizer
+from cae.channel.models.limiter import connection_limiter, auth_failure_limiter, is_exempt
+from cae.channel.models.shaper import shaper
 from pretty_logging import pretty_logger
 import threading
 import traceback
 import paramiko
 
 
+class ChannelTransport(paramiko.Transport):
+    """
+    paramiko transport which hands accepted channels, its authentication
+    and its own shutdown to callbacks, so no thread has to block in
+    `accept()` per connection.
+    """
+
+    def __init__(self, sock, on_channel, on_authenticated, on_close, **kwargs):
+        super().__init__(sock, **kwargs)
+        self.on_channel = on_channel
+        self.on_authenticated = on_authenticated
+        self.on_close = on_close
+
+    def _queue_incoming_channel(self, channel):
+        self.on_channel(self, channel)
+
+    def _auth_trigger(self):
+        # check_auth_publickey accepts the key before its signature is verified, this runs after
+        super()._auth_trigger()
+        self.on_authenticated(self)
+
+    def run(self):
+        try:
+            super().run()
+        finally:
+            self.on_close(self)
+
+
+def listen_socket(reuse_port=False):
+    """
+    With reuse_port every channel worker binds its own socket and the
+    kernel spreads connections over them, else one socket is opened
+    before forking and shared.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, True)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, True)
+    sock.bind((config["BIND_HOST"], config["SSHD_PORT"]))
+    sock.listen(config["LISTEN_BACKLOG"])
+    sock.setblocking(False)
+    return sock
+
+
 class SSHServer:
-    def __init__(self):
+    def __init__(self, sock=None, worker=0, reuse_port=False):
+        self.sock = sock  # listening socket inherited from the supervisor
+        self.worker = worker
+        self.reuse_port = reuse_port
         self.stop_evt = threading.Event()
+        self.wakeup_evt = SelectEvent()
+        self.sel = selectors.DefaultSelector()
+        self.workers = ThreadPoolExecutor(max_workers=config["WORKER_THREADS"], thread_name_prefix="channel")
+        self.transports = {}
+        self.tasks = 0
+        self.lock = threading.Lock()
+        self.handshakes = 0  # accepted, not authenticated yet
+        self.handshaking = {}  # connection id -> (transport, deadline)
+        self.rejected_handshakes = 0
+        self.handshake_timeouts = 0
+        # host key and moduli are loaded once, not per handshake
+        self.host_key, _ = get_host_key(config["HOST_KEY_TYPE"], config["HOST_PRIVATE_KEY"], config["HOST_PUBLIC_KEY"])
+        if not paramiko.Transport.load_server_moduli():
+            pretty_logger.warning("Failed load moduli -- gex will be unsupported")
 
-    @property
-    def host_key(self):
-        host_key_path = config["HOST_PRIVATE_KEY"]
-        if not os.path.isfile(host_key_path):
-            self.gen_host_key()
-        return paramiko.RSAKey(filename=host_key_path)
-
-    @staticmethod
-    def gen_host_key():
-        ssh_private_key, ssh_public_key = ssh_key_gen()
-        with open(config["HOST_PRIVATE_KEY"], 'w', encoding="utf-8") as f:
-            f.write(ssh_private_key)
-        with open(config["HOST_PUBLIC_KEY"], "w", encoding="utf-8") as f:
-            f.write(ssh_public_key)
+    def listen(self):
+        if self.sock is not None:
+            self.sock.setblocking(False)
+            return self.sock
+        return listen_socket(reuse_port=self.reuse_port)
 
     def run(self):
-        host = config["BIND_HOST"]
-        port = config["SSHD_PORT"]
-        pretty_logger.info("Starting ssh server at {}:{}".format(host, port))
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, True)
-        sock.bind((host, port))
-        sock.listen(os.cpu_count())
-        while not self.stop_evt.is_set():
+        """
+        Event loop owning the listening socket, connections are handed to
+        the worker pool only for the handshake.
+        """
+        sock = self.listen()
+        instance_cache.start()
+        container_cache.start()
+        relay_engine.start()
+        SSHConnection.start()
+        registry.start()
+        pretty_logger.info("Starting ssh server worker {} at {}:{}".format(self.worker, *sock.getsockname()))
+        self.sel.register(sock, selectors.EVENT_READ)
+        self.sel.register(self.wakeup_evt, selectors.EVENT_READ)
+        last_stats = time.monotonic()
+        try:
+            while not self.stop_evt.is_set():
+                events = self.sel.select(timeout=1)
+                for key, _ in events:
+                    if key.fileobj is sock:
+                        self.accept(sock)
+                    elif key.fileobj is self.wakeup_evt:
+                        self.wakeup_evt.recv(1024)
+                self.reap_handshakes()
+                if time.monotonic() - last_stats >= config["STATS_INTERVAL"]:
+                    last_stats = time.monotonic()
+                    stats = self.stats()
+                    pretty_logger.info("Channel stats {}".format(stats))
+                    # summed over the workers by /api/session/stats
+                    self.submit(registry.publish_stats, stats)
+        finally:
+            self.sel.close()
+            sock.close()
+            self.workers.shutdown(wait=False)
+
+    def accept(self, sock):
+        while True:
             try:
                 client, addr = sock.accept()
-                t = threading.Thread(target=self.handle_connection, args=(client, addr))
-                t.daemon = True
-                t.start()
+            except (BlockingIOError, InterruptedError):
+                return
             except Exception as e:
                 pretty_logger.error(traceback.format_exc())
-                pretty_logger.error("Start SSH server error: {}".format(e))
+                pretty_logger.error("Accept SSH connection error: {}".format(e))
+                return
+            if not is_exempt(addr[0]) and not connection_limiter.allow(addr[0]):
+                pretty_logger.debug("Connection rate limited from: {}".format(addr))
+                client.close()
+                continue
+            with self.lock:
+                if self.handshakes >= config["MAX_HANDSHAKES"]:
+                    self.rejected_handshakes += 1
+                    client.close()
+                    continue
+                self.handshakes += 1
+            client.setblocking(True)
+            # keystrokes must not wait for Nagle
+            tune_socket(client, config["TCP_KEEPALIVE"])
+            self.submit(self.handle_connection, client, addr)
+
+    def submit(self, fn, *args):
+        with self.lock:
+            self.tasks += 1
+        future = self.workers.submit(fn, *args)
+        future.add_done_callback(self.task_done)
+        return future
+
+    def task_done(self, future):
+        with self.lock:
+            self.tasks -= 1
+        e = future.exception()
+        if e:
+            pretty_logger.error("Channel worker error: {!r}".format(e))
 
     def handle_connection(self, sock, addr):
         pretty_logger.info("Handle new connection from: {}".format(addr))
-        transport = paramiko.Transport(sock, gss_kex=False)
-        try:
-            transport.load_server_moduli()
-        except IOError:
-            pretty_logger.warning("Failed load moduli -- gex will be unsupported")
-        transport.add_server_key(self.host_key)
         connection = Connection.new_connection(addr=addr, sock=sock)
+        transport = ChannelTransport(
+            sock, self.on_channel, self.on_authenticated, self.on_transport_close, gss_kex=False,
+            default_window_size=config["CHANNEL_WINDOW_SIZE"], default_max_packet_size=config["CHANNEL_MAX_PACKET_SIZE"],
+        )
+        transport.connection = connection
+        connection.transport = transport
+        transport.add_server_key(self.host_key)
         server = SSHInterface(connection)
+        with self.lock:
+            self.transports[connection.id] = transport
+            self.handshaking[connection.id] = (transport, time.monotonic() + config["HANDSHAKE_TIMEOUT"])
         try:
             transport.start_server(server=server)
             transport.set_keepalive(60)
-            while transport.is_active():
-                chan = transport.accept()
-                server.event.wait(5)
-                if chan is None:
-                    continue
-
-                if not server.event.is_set():
-                    pretty_logger.warning("Client not request invalid, exiting")
-                    sock.close()
-                    continue
-                else:
-                    server.event.clear()
-
-                client = connection.clients.get(chan.get_id())
-                client.chan = chan
-                t = threading.Thread(target=self.dispatch, args=(client,))
-                t.daemon = True
-                t.start()
-            transport.close()
         except paramiko.SSHException as e:
             pretty_logger.debug("SSH negotiation failed: {}".format(e))
+            transport.close()
         except EOFError as e:
             pretty_logger.debug("Handle connection EOF Error: {}".format(e))
+            transport.close()
         except Exception as e:
             pretty_logger.error("Unexpect error occur on handle connection: {}".format(e))
-        finally:
-            Connection.remove_connection(connection.id)
-            sock.close()
+            transport.close()
+        if not transport.is_alive():
+            self.on_transport_close(transport)
+
+    def on_channel(self, transport, chan):
+        """
+        Called from the transport thread, must not block.
+        """
+        client = transport.connection.clients.get(chan.get_id())
+        if not client:
+            pretty_logger.warning("Channel {} without client request, closing".format(chan.get_id()))
+            chan.close()
+            return
+        client.chan = chan
+        self.submit(self.wait_dispatch, client)
+
+    def wait_dispatch(self, client):
+        if not client.request_evt.wait(config["CHANNEL_REQUEST_TIMEOUT"]):
+            pretty_logger.warning("Client not request invalid, exiting")
+            self.release_client(client)
+            return
+        self.dispatch(client)
+
+    def on_authenticated(self, transport):
+        """
+        Called from the transport thread once the client proved its key.
+        """
+        self.handshake_done(transport.connection)
+
+    def handshake_done(self, connection):
+        with self.lock:
+            if self.handshaking.pop(connection.id, None) is not None:
+                self.handshakes -= 1
+
+    def reap_handshakes(self):
+        """
+        Close connections which did not authenticate in HANDSHAKE_TIMEOUT.
+        """
+        now = time.monotonic()
+        with self.lock:
+            expired = [t for t, deadline in self.handshaking.values() if deadline < now]
+        for transport in expired:
+            self.handshake_timeouts += 1
+            pretty_logger.debug("Handshake timeout: {}".format(transport.connection.addr))
+            transport.close()
+            self.on_transport_close(transport)
+
+    def on_transport_close(self, transport):
+        connection = transport.connection
+        self.handshake_done(connection)
+        with self.lock:
+            if self.transports.pop(connection.id, None) is None:
+                return
+        forward_manager.close_connection(connection)
+        Connection.remove_connection(connection.id)
+
+    def stats(self):
+        return {
+            "connections": len(Connection.connections),
+            "channels": Connection.clients_num,
+            "threads": threading.active_count(),
+            "worker_tasks": self.tasks,
+            "worker_threads": config["WORKER_THREADS"],
+            "handshakes": self.handshakes,
+            "rejected_handshakes": self.rejected_handshakes,
+            "handshake_timeouts": self.handshake_timeouts,
+            "rate_limit": {
+                "connections": connection_limiter.stats(),
+                "auth_failures": auth_failure_limiter.stats(),
+            },
+            "instance_cache": instance_cache.stats(),
+            "container_cache": container_cache.stats(),
+            "relay": relay_engine.stats(),
+            "ssh_pool": SSHConnection.stats(),
+            "remote_forward": forward_manager.stats(),
+            "recorder": recorder.stats(),
+            "audit": auditor.stats(),
+            "registry": registry.stats(),
+            "resize": resizer.stats(),
+            "bandwidth": shaper.stats(),
+        }
 
     @staticmethod
     def dispatch(client):
-        supported = {"pty", "x11", "forward-agent", "direct-tcpip"}
+        supported = {"pty", "x11", "forward-agent", "direct-tcpip", "exec", "subsystem"}
         chan_type = client.request.type
         kind = client.request.kind
         try:
@@ -106,9 +284,18 @@ class SSHServer:
                 pretty_logger.error(msg)
                 client.send_unicode(msg)
         finally:
-            connection = Connection.get_connection(client.connection_id)
-            if connection:
-                connection.remove_client(client.id)
+            if client.session:
+                # relayed in the background, release the client when it ends
+                client.session.on_finish(lambda session: SSHServer.release_client(client))
+            else:
+                SSHServer.release_client(client)
+
+    @staticmethod
+    def release_client(client):
+        connection = Connection.get_connection(client.connection_id)
+        if connection:
+            connection.remove_client(client.id)
 
     def shutdown(self):
         self.stop_evt.set()
+        self.wakeup_evt.set()
@@ -1,24 +1,34 @@
+import codecs
+import fcntl
 import os
+import tempfile
 from io import StringIO
 import paramiko
-from . import char
 import re
 import pyte
 from binascii import hexlify
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ed25519
 import socket
+import struct
+
+
+KEY_CLASSES = {
+    'rsa': paramiko.RSAKey,
+    'dsa': paramiko.DSSKey,
+    'ecdsa': paramiko.ECDSAKey,
+    'ed25519': paramiko.Ed25519Key,
+}
 
 
 def ssh_key_string_to_obj(text, password=None):
     key = None
-    try:
-        key = paramiko.RSAKey.from_private_key(StringIO(text), password=password)
-    except paramiko.SSHException:
-        pass
-
-    try:
-        key = paramiko.DSSKey.from_private_key(StringIO(text), password=password)
-    except paramiko.SSHException:
-        pass
+    for key_class in KEY_CLASSES.values():
+        try:
+            key = key_class.from_private_key(StringIO(text), password=password)
+            break
+        except (paramiko.SSHException, ValueError):
+            pass
     return key
 
 
@@ -26,7 +36,7 @@ def ssh_pubkey_gen(private_key=None, username='jumpserver', hostname='localhost'
     if isinstance(private_key, str):
         private_key = ssh_key_string_to_obj(private_key)
 
-    if not isinstance(private_key, (paramiko.RSAKey, paramiko.DSSKey)):
+    if not isinstance(private_key, tuple(KEY_CLASSES.values())):
         raise IOError('Invalid private key')
 
     public_key = "%(key_type)s %(key_content)s %(username)s@%(hostname)s" % {
@@ -42,7 +52,8 @@ def ssh_key_gen(length=2048, type='rsa', password=None,
                 username='cae', hostname=None):
     """Generate user ssh private and public key
 
-    Use paramiko RSAKey generate it.
+    Use paramiko generate rsa/dsa/ecdsa key, ed25519 key by cryptography
+    as paramiko can only load it. `length` is the curve size for ecdsa.
     :return private key str and public key str
     """
 
@@ -55,16 +66,72 @@ def ssh_key_gen(length=2048, type='rsa', password=None,
         private_key_obj = paramiko.RSAKey.generate(length)
     elif type == 'dsa':
         private_key_obj = paramiko.DSSKey.generate(length)
+    elif type == 'ecdsa':
+        private_key_obj = paramiko.ECDSAKey.generate(bits=length if length in (256, 384, 521) else 256)
+    elif type == 'ed25519':
+        if password:
+            encryption = serialization.BestAvailableEncryption(password.encode())
+        else:
+            encryption = serialization.NoEncryption()
+        f.write(ed25519.Ed25519PrivateKey.generate().private_bytes(
+            serialization.Encoding.PEM, serialization.PrivateFormat.OpenSSH, encryption
+        ).decode())
+        private_key_obj = paramiko.Ed25519Key(file_obj=StringIO(f.getvalue()), password=password)
     else:
-        raise IOError('SSH private key must be `rsa` or `dsa`')
+        raise IOError('SSH private key must be `rsa`, `dsa`, `ecdsa` or `ed25519`')
 
-    private_key_obj.write_private_key(f, password=password)
+    if type != 'ed25519':
+        private_key_obj.write_private_key(f, password=password)
     private_key = f.getvalue()
     public_key = ssh_pubkey_gen(private_key_obj, username=username, hostname=hostname)
 
     return private_key, public_key
 
 
+_host_keys = {}
+
+
+def write_atomic(path, content, mode=0o644):
+    """
+    Readers see either no file or all of content, never a partial one.
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix=".tmp-")
+    try:
+        os.fchmod(fd, mode)
+        with open(fd, 'w', encoding="utf-8") as f:
+            f.write(content)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def get_host_key(key_type, private_key_file, public_key_file):
+    """Load the channel host key pair once per process, generate it if missing.
+
+    Channel workers starting together serialize on a lock file, so only
+    one of them generates the pair and the others load it.
+
+    :return (private key object, public key str)
+    """
+    cached = _host_keys.get(private_key_file)
+    if cached:
+        return cached
+    with open(private_key_file + ".lock", 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not os.path.isfile(private_key_file):
+            ssh_private_key, ssh_public_key = ssh_key_gen(type=key_type)
+            # the private key goes last, its presence means the pair is complete
+            write_atomic(public_key_file, ssh_public_key)
+            write_atomic(private_key_file, ssh_private_key, mode=0o600)
+        with open(private_key_file, encoding="utf-8") as f:
+            private_key = KEY_CLASSES[key_type].from_private_key(f)
+        with open(public_key_file, encoding="utf-8") as f:
+            public_key = f.read().strip()
+    _host_keys[private_key_file] = (private_key, public_key)
+    return private_key, public_key
+
+
 class TtyIOParser(object):
     def __init__(self, width=80, height=24):
         self.screen = pyte.Screen(width, height)
@@ -90,7 +157,7 @@ class TtyIOParser(object):
         try:
             for line in self.screen.display:
                 if line.strip():
-                    output.append(line)
+                    output.append(line.rstrip())
         except IndexError:
             pass
         self.screen.reset()
@@ -186,57 +253,176 @@ def wrap_with_title(text):
     return wrap_with_color(text, color='black', background='green')
 
 
+class LineEditor(object):
+    """
+    Buffered prompt input: reads whatever the client sent, applies the
+    control keys over the whole batch and echoes it with one write.
+    Lines pasted after the first are kept for the next readline.
+    """
+
+    def __init__(self, client, max_length=4096, recv_size=4096):
+        self.client = client
+        self.max_length = max_length
+        self.recv_size = recv_size
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+        self.pending = ""  # type-ahead after the last enter
+        self.escape = 0  # position inside an escape sequence, they are dropped
+        self.after_cr = False
+
+    def readline(self, prompt="", sensitive=False):
+        """
+        :param sensitive: echo `*` for each character
+        :return the line without its line end, None when the client is gone
+        :raise EOFError on Ctrl-D at an empty line
+        """
+        line = []
+        while True:
+            if self.pending:
+                text, self.pending = self.pending, ""
+            else:
+                data = self.client.recv(self.recv_size)
+                if len(data) == 0 or self.client.closed:
+                    return None
+                text = self.decoder.decode(data)
+            echo = []
+            for i, c in enumerate(text):
+                after_cr, self.after_cr = self.after_cr, False
+                if self.escape:
+                    self.escape = self.skip_escape(self.escape, c)
+                elif c in "\r\n":
+                    if c == "\n" and after_cr:
+                        continue
+                    self.after_cr = c == "\r"
+                    self.pending = text[i + 1:]
+                    echo.append("\r\n")
+                    self.write("".join(echo))
+                    return "".join(line)
+                elif c in "\x08\x7f":
+                    if line:
+                        line.pop()
+                        echo.append("\x08\x1b[K")
+                    else:
+                        echo.append("\x07")
+                elif c == "\x03":
+                    # Ctrl-C
+                    del line[:]
+                    echo.append("^C\r\n{} ".format(prompt))
+                elif c == "\x04":
+                    if not line:
+                        self.write("".join(echo))
+                        raise EOFError("Ctrl-D")
+                elif c == "\x15":
+                    # Ctrl-U
+                    if line:
+                        echo.append("\x08" * len(line) + "\x1b[K")
+                        del line[:]
+                elif c == "\x1b":
+                    self.escape = 1
+                elif c < " ":
+                    continue
+                elif len(line) >= self.max_length:
+                    echo.append("\x07")
+                else:
+                    line.append(c)
+                    echo.append("*" if sensitive else c)
+            self.write("".join(echo))
+
+    @staticmethod
+    def skip_escape(state, c) -> int:
+        """
+        :return the next escape state, 0 once `ESC x`, SS3 `ESC O x` or
+        CSI `ESC [ params final` (arrows, function keys) is consumed
+        """
+        if state == 1:
+            return {"[": 2, "O": 3}.get(c, 0)
+        if state == 2 and not "@" <= c <= "~":
+            return 2
+        return 0
+
+    def write(self, s):
+        if not s:
+            return
+        data = s.encode()
+        while data:
+            sent = self.client.send(data)
+            if not sent:
+                return
+            data = data[sent:]
+
+
 def net_input(client, prompt='Opt> ', sensitive=False, before=0, after=0):
     """实现了一个ssh input, 提示用户输入, 获取并返回
 
     :return user input string
     """
-    input_data = []
-    parser = TtyIOParser()
     msg = wrap_with_line_feed(prompt, before=before, after=after)
     client.send_unicode(msg)
+    # one editor per client, what was typed ahead is the next answer
+    if client.line_editor is None:
+        client.line_editor = LineEditor(client)
+    try:
+        option = client.line_editor.readline(prompt, sensitive=sensitive)
+    except EOFError:
+        return 'q'
+    if option is None:
+        return None
+    client.send(wrap_with_line_feed(b'', after=1))
+    return option.strip()
+
+
+def adapt_buffer_size(size, received, minimum, maximum):
+    """
+    Next recv size: grow while reads fill the buffer (bulk transfer),
+    shrink back when they come in small (interactive typing).
+    """
+    if received >= size:
+        return min(size * 2, maximum)
+    if received < size // 4:
+        return max(size // 2, minimum)
+    return size
+
+
+def tune_socket(sock, keepalive=(60, 10, 6)):
+    """
+    Low latency tcp for relayed connections: no Nagle delay, and dead
+    peers are noticed by keepalive (idle, interval, probes) in seconds.
+    """
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    idle, interval, probes = keepalive
+    for name, value in (("TCP_KEEPIDLE", idle), ("TCP_KEEPINTVL", interval), ("TCP_KEEPCNT", probes)):
+        if hasattr(socket, name):
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, name), value)
+
+
+def percentile(samples, p):
+    """
+    Nearest rank percentile of unsorted samples, None when empty.
+    """
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
 
-    while True:
-        data = client.recv(1)
-        if len(data) == 0 or client.closed:
-            break
-        # Client input backspace
-        if data in char.BACKSPACE_CHAR:
-            # If input words less than 0, should send 'BELL'
-            if len(input_data) > 0:
-                data = char.BACKSPACE_CHAR[data]
-                input_data.pop()
-            else:
-                data = char.BELL_CHAR
-            client.send(data)
-            continue
-
-        if data.startswith(b'\x03'):
-            # Ctrl-C
-            client.send_unicode('^C\r\n{} '.format(prompt))
-            input_data = []
-            continue
-        elif data.startswith(b'\x04'):
-            # Ctrl-D
-            return 'q'
-
-        # Todo: Move x1b to char
-        if data.startswith(b'\x1b') or data in char.UNSUPPORTED_CHAR:
-            client.send(b'')
-            continue
-
-        # If user types ENTER we should get user input
-        if data in char.ENTER_CHAR:
-            client.send(wrap_with_line_feed(b'', after=2))
-            option = parser.parse_input(input_data)
-            del input_data[:]
-            return option.strip()
-        else:
-            if sensitive:
-                client.send_unicode((len(data) * '*'))
-            else:
-                client.send(data)
-            input_data.append(data)
+
+def tcp_info(sock) -> dict:
+    """
+    Kernel rtt estimate of a tcp socket, empty where TCP_INFO is unavailable.
+    """
+    if not hasattr(socket, "TCP_INFO"):
+        return {}
+    try:
+        info = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, 104)
+    except OSError:
+        return {}
+    # struct tcp_info in linux/tcp.h: 8 bytes of u8 fields, then u32 rto, ato, ...
+    # rtt (15), rttvar (16) in microseconds, total_retrans (23)
+    fields = struct.unpack_from("8x24I", info)
+    return {
+        "rtt_ms": fields[15] / 1000,
+        "rttvar_ms": fields[16] / 1000,
+        "retransmits": fields[23],
+    }
 
 
 def get_private_key_fingerprint(key):
@@ -267,11 +453,13 @@ class SelectEvent:
         return getattr(self.p1, item)
 
 
-def parser_public_key(public_key: str):
-    s = public_key.split(" ")
+def parser_public_key(public_key: str) -> str:
+    """
+    :return the base64 blob of an authorized key line, "" for an empty one
+    """
+    s = public_key.split()
     if len(s) == 1:
-        return s
-    elif len(s) == 2:
-        return s[-1]
-    elif len(s) >= 3:
+        return s[0]
+    elif len(s) >= 2:
         return s[1]
+    return ""
@@ -16,10 +16,100 @@ config = {
     ]
 }
 
+host_key_type = env("CHANNEL_HOST_KEY_TYPE", cast=str, default="rsa")
+
 channel_config = {
     "BIND_HOST": "0.0.0.0",
     "SSHD_PORT": env("SSHD_PORT", cast=int, default=2222),
     "SSH_TIMEOUT": 15,
-    "HOST_PRIVATE_KEY": "/channel/id_rsa",
-    "HOST_PUBLIC_KEY": "/channel/id_rsa.pub",
+    # channel worker processes, 0 is one per cpu. The accept rate, handshake and
+    # auth failure limits below apply per worker
+    "CHANNEL_WORKERS": env("CHANNEL_WORKERS", cast=int, default=0),
+    "CHANNEL_REUSE_PORT": env("CHANNEL_REUSE_PORT", cast=bool, default="true"),  # else one socket shared by the workers
+    "SSH_POOL_SIZE": env("CHANNEL_SSH_POOL_SIZE", cast=int, default=256),  # upstream transports kept
+    "SSH_POOL_IDLE_TIMEOUT": env("CHANNEL_SSH_POOL_IDLE_TIMEOUT", cast=int, default=300),
+    "SSH_POOL_MAX_CHANNELS": env("CHANNEL_SSH_POOL_MAX_CHANNELS", cast=int, default=8),  # below sshd MaxSessions 10
+    "SSH_POOL_PREWARM": env("CHANNEL_SSH_POOL_PREWARM", cast=bool, default="false"),
+    "HOST_KEY_TYPE": host_key_type,  # rsa, ecdsa or ed25519
+    "HOST_PRIVATE_KEY": "/channel/id_{}".format(host_key_type),
+    "HOST_PUBLIC_KEY": "/channel/id_{}.pub".format(host_key_type),
+    "LISTEN_BACKLOG": env("CHANNEL_LISTEN_BACKLOG", cast=int, default=1024),
+    "WORKER_THREADS": env("CHANNEL_WORKER_THREADS", cast=int, default=256),
+    "CHANNEL_REQUEST_TIMEOUT": 5,
+    # brute force and scanner protection, each channel worker process keeps its own buckets
+    "LIMIT_CONNECTION_RATE": env("CHANNEL_LIMIT_CONNECTION_RATE", cast=float, default=20),  # per remote ip a second
+    "LIMIT_CONNECTION_BURST": env("CHANNEL_LIMIT_CONNECTION_BURST", cast=int, default=200),
+    # addresses or networks not connection rate limited, e.g. an office NAT or a CI runner pool
+    "LIMIT_EXEMPT": env("CHANNEL_LIMIT_EXEMPT", cast=str, default="").split(","),
+    "LIMIT_AUTH_FAILURE_RATE": env("CHANNEL_LIMIT_AUTH_FAILURE_RATE", cast=float, default=1),  # per remote address and instance name
+    "LIMIT_AUTH_FAILURE_BURST": env("CHANNEL_LIMIT_AUTH_FAILURE_BURST", cast=int, default=30),
+    "AUTH_NEGATIVE_TTL": env("CHANNEL_AUTH_NEGATIVE_TTL", cast=int, default=30),
+    "AUTH_NEGATIVE_MAX": 65536,
+    "MAX_HANDSHAKES": env("CHANNEL_MAX_HANDSHAKES", cast=int, default=128),  # not yet authenticated connections
+    "HANDSHAKE_TIMEOUT": env("CHANNEL_HANDSHAKE_TIMEOUT", cast=int, default=30),
+    "EXIT_STATUS_TIMEOUT": 5,
+    # per channel flow control window, bounds bytes in flight (and buffered) per transfer
+    "CHANNEL_WINDOW_SIZE": env("CHANNEL_WINDOW_SIZE", cast=int, default=8388608),
+    "CHANNEL_MAX_PACKET_SIZE": env("CHANNEL_MAX_PACKET_SIZE", cast=int, default=32768),
+    "SUBSYSTEMS": ["sftp"],
+    # login shells tried in sshd-less containers without a cae.shell label
+    "EXEC_SHELLS": env("CHANNEL_EXEC_SHELLS", cast=str, default="/bin/bash,/bin/sh").split(","),
+    "RESIZE_DEBOUNCE": env("CHANNEL_RESIZE_DEBOUNCE", cast=float, default=0.05),  # window changes within are coalesced
+    "RESIZE_THREADS": 4,
+    "DIRECT_CONNECT_TIMEOUT": env("CHANNEL_DIRECT_CONNECT_TIMEOUT", cast=int, default=5),
+    "TCP_KEEPALIVE": (60, 10, 6),  # idle, interval, probes of client, upstream and tunnel sockets
+    "REMOTE_FORWARD_MAX": env("CHANNEL_REMOTE_FORWARD_MAX", cast=int, default=1024),  # listeners on this node
+    "REMOTE_FORWARD_MAX_PER_USER": env("CHANNEL_REMOTE_FORWARD_MAX_PER_USER", cast=int, default=4),
+    "REMOTE_FORWARD_MIN_PORT": 1024,
+    "REMOTE_FORWARD_BACKLOG": 128,
+    "FORWARD_WORKERS": 16,
+    "SFTP_CHUNK_SIZE": 1048576,  # archive stream chunks, sshd-less containers
+    "SFTP_SPOOL_MEMORY": env("CHANNEL_SFTP_SPOOL_MEMORY", cast=int, default=8388608),  # uploads beyond go to disk
+    "SFTP_UPLOAD_MAX": env("CHANNEL_SFTP_UPLOAD_MAX", cast=int, default=4294967296),  # spooled size of one upload
+    "SFTP_LISTING_TTL": env("CHANNEL_SFTP_LISTING_TTL", cast=int, default=10),
+    # asciinema casts of pty sessions, zstd when zstandard is installed else gzip
+    "RECORD_ENABLED": env("CHANNEL_RECORD_ENABLED", cast=bool, default="false"),
+    "RECORD_DIR": env("CHANNEL_RECORD_DIR", cast=str, default="/channel/records"),
+    "RECORD_COMPRESS": env("CHANNEL_RECORD_COMPRESS", cast=str, default="zstd"),  # zstd, gzip or none
+    "RECORD_INPUT": env("CHANNEL_RECORD_INPUT", cast=bool, default="false"),  # keystrokes, passwords included
+    "RECORD_ROTATE_SIZE": env("CHANNEL_RECORD_ROTATE_SIZE", cast=int, default=67108864),
+    "RECORD_QUEUE_SIZE": 65536,
+    "RECORD_BATCH": 4096,
+    "RECORD_BATCH_INTERVAL": 0.05,
+    "RECORD_FLUSH_INTERVAL": 1,
+    # commands typed in pty sessions, parsed off the relay loops
+    "AUDIT_ENABLED": env("CHANNEL_AUDIT_ENABLED", cast=bool, default="false"),
+    "AUDIT_SINK": env("CHANNEL_AUDIT_SINK", cast=str, default="redis"),  # redis stream or file
+    "AUDIT_FILE": env("CHANNEL_AUDIT_FILE", cast=str, default="/channel/audit.log"),
+    "AUDIT_STREAM_MAXLEN": env("CHANNEL_AUDIT_STREAM_MAXLEN", cast=int, default=1000000),
+    "AUDIT_WORKERS": env("CHANNEL_AUDIT_WORKERS", cast=int, default=2),
+    "AUDIT_OUTPUT_MAX": 4096,  # output bytes parsed and kept per command
+    "AUDIT_QUEUE_SIZE": 65536,
+    "AUDIT_BATCH": 1024,
+    "AUDIT_BATCH_INTERVAL": 0.05,
+    "AUDIT_FLUSH_INTERVAL": 1,
+    "REGISTRY_INTERVAL": env("CHANNEL_REGISTRY_INTERVAL", cast=int, default=2),  # live sessions published to redis
+    "REGISTRY_TTL": 30,
+    "INSTANCE_CACHE_TTL": env("CHANNEL_INSTANCE_CACHE_TTL", cast=int, default=300),
+    "CONTAINER_CACHE_TTL": env("CHANNEL_CONTAINER_CACHE_TTL", cast=int, default=60),
+    "SSHD_NEGATIVE_TTL": env("CHANNEL_SSHD_NEGATIVE_TTL", cast=int, default=30),  # containers probed without sshd
+    "DOCKER_POOL_SIZE": env("CHANNEL_DOCKER_POOL_SIZE", cast=int, default=32),
+    "RELAY_BUFFER_MIN": env("CHANNEL_RELAY_BUFFER_MIN", cast=int, default=8192),
+    "RELAY_BUFFER_MAX": env("CHANNEL_RELAY_BUFFER_MAX", cast=int, default=2097152),  # paramiko default window size
+    # pty output read while more is ready goes out as one ssh packet, no delay is added
+    "PTY_COALESCE": env("CHANNEL_PTY_COALESCE", cast=int, default=16384),
+    "ECHO_SAMPLES": 512,  # input to output latencies kept per pty session
+    "ECHO_BUCKETS_MS": [1, 2, 5, 10, 20, 50, 100, 200, 500],  # upper bounds of the relay echo histogram, plus one above
+    # bandwidth limits in bytes a second, 0 is unlimited. The global one applies per channel worker,
+    # a `cae.bandwidth` container label overrides the instance one
+    "BANDWIDTH_GLOBAL": env("CHANNEL_BANDWIDTH_GLOBAL", cast=int, default=0),
+    "BANDWIDTH_INSTANCE": env("CHANNEL_BANDWIDTH_INSTANCE", cast=int, default=0),
+    "BANDWIDTH_USER": env("CHANNEL_BANDWIDTH_USER", cast=int, default=0),  # per user of an instance
+    "BANDWIDTH_BURST": 0.25,  # seconds of the rate a bucket holds
+    "BANDWIDTH_PTY_RESERVE": env("CHANNEL_BANDWIDTH_PTY_RESERVE", cast=float, default=0.25),  # of the global burst
+    "BANDWIDTH_MIN_READ": 4096,  # below this a session waits for tokens instead of reading
+    "RELAY_WINDOW_RETRY": 0.005,  # seconds, paramiko signals no window adjust to a relay loop
+    "RELAY_THREADS": env("CHANNEL_RELAY_THREADS", cast=int, default=2),
+    "RELAY_FINISH_THREADS": 8,
+    "STATS_INTERVAL": env("CHANNEL_STATS_INTERVAL", cast=int, default=60),
 }
@@ -1,3 +1,4 @@
 from .instance import bp_instance
 from .ingress import bp_ingress
 from .image import bp_image
+from .session import bp_session
@@ -62,6 +62,7 @@ def info_instance(request: Request, instance_id):
         "key": fields.Str(required=True),
         "value": fields.Str(required=True)
     }), required=False),
+    "shell": fields.Str(required=False),  # login shell of exec sessions
 }, location="json")
 def create_instance(request: Request, json_args: dict):
     if not json_args.get("name") or not json_args.get("image"):
@@ -85,6 +86,9 @@ def create_instance(request: Request, json_args: dict):
         "cap_add": ["SYSLOG", "SYS_PTRACE"],  # for rsyslog
     }
 
+    if json_args.get("shell"):
+        spec["labels"]["cae.shell"] = json_args.get("shell")
+
     ip_addr = network_model.assign_ip()
 
     # create container
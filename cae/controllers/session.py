@@ -0,0 +1,74 @@
+from madara.wrappers import Request
+from madara.blueprints import Blueprint
+from cae.repositorys.validation import use_args
+from cae.models import session as session_model
+from webargs import fields
+
+bp_session = Blueprint("bp_session")
+
+
+@bp_session.route("/list", methods=["GET"])
+@use_args({
+    "instance_id": fields.Str(required=False),
+    "user": fields.Str(required=False),
+}, location="query")
+def list_session(request: Request, query_args: dict):
+    result = []
+    for item in session_model.list_sessions():
+        if query_args.get("instance_id") and item.get("instance_id") != query_args.get("instance_id"):
+            continue
+        if query_args.get("user") and item.get("user") != query_args.get("user"):
+            continue
+        result.append(item)
+    result.sort(key=lambda x: x.get("date_start") or "")
+    return {
+        "code": 200,
+        "result": result
+    }
+
+
+@bp_session.route("/connections", methods=["GET"])
+def list_connection(request: Request):
+    result = session_model.list_connections()
+    result.sort(key=lambda x: x.get("date_start") or "")
+    return {
+        "code": 200,
+        "result": result
+    }
+
+
+@bp_session.route("/stats", methods=["GET"])
+def channel_stats(request: Request):
+    workers = session_model.list_stats()
+    return {
+        "code": 200,
+        "result": {
+            "workers": workers,
+            "total": session_model.aggregate_stats(list(workers.values())),
+        }
+    }
+
+
+@bp_session.route("/info/<session_id>", methods=["GET"])
+@use_args({"session_id": fields.Str(required=True)}, location="view_args")
+def info_session(request: Request, view_args: dict, session_id):
+    info = session_model.get_session(session_id)
+    if not info:
+        raise Exception("not found session {}".format(session_id))
+    return {
+        "code": 200,
+        "result": info
+    }
+
+
+@bp_session.route("/terminate/<session_id>", methods=["POST"])
+@use_args({"session_id": fields.Str(required=True)}, location="view_args")
+def terminate_session(request: Request, view_args: dict, session_id):
+    if not session_model.get_session(session_id):
+        raise Exception("not found session {}".format(session_id))
+    # the channel owning the session stops it, the registry drops it on its next flush
+    session_model.kill_session(session_id)
+    return {
+        "code": 200,
+        "result": "success"
+    }
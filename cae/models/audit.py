@@ -0,0 +1,18 @@
+from cae.config import config
+from cae.models import redis_client
+import json
+
+prefix = config.get("REDIS_KEY_PREFIX")
+audit_command_stream = "{}/audit/commands".format(prefix)
+
+
+def add_commands(records: list, maxlen=None):
+    """
+    Append command audit records to the stream in one round trip, the
+    stream is trimmed to about maxlen entries.
+    """
+    pipe = redis_client.pipeline(transaction=False)
+    for record in records:
+        pipe.xadd(audit_command_stream, {"record": json.dumps(record)}, maxlen=maxlen, approximate=True)
+    pipe.execute()
+
@@ -1,11 +1,14 @@
 
 from cae.config import config
 from cae.models import redis_client
+from cae.channel.utils import parser_public_key
 from docker.models.containers import Container
 import json
 
 prefix = config.get("REDIS_KEY_PREFIX")
 _instance_id_key = "{}/instanceid".format(prefix)
+_auth_key_prefix = "{}/authkey".format(prefix)
+instance_event_channel = "{}/instance/events".format(prefix)
 
 
 def get_instance(key) -> dict:
@@ -26,15 +29,61 @@ def get_instance_by_name(name) -> dict:
 
 def put_instance(key, ins: dict):
     _key = "{}/instance/{}".format(prefix, key)
-    redis_client.hset(_instance_id_key, ins.get("name"), key)
-    redis_client.set(_key, json.dumps(ins))
+    name = ins.get("name")
+    _auth_key = "{}/{}".format(_auth_key_prefix, name)
+    auth_key_index = make_auth_key_index(ins.get("auth_keys", []))
+    pipe = redis_client.pipeline()
+    pipe.hset(_instance_id_key, name, key)
+    pipe.set(_key, json.dumps(ins))
+    pipe.delete(_auth_key)
+    if auth_key_index:
+        pipe.hset(_auth_key, mapping=auth_key_index)
+    pipe.publish(instance_event_channel, name)
+    pipe.execute()
 
 
 def del_instance(key):
     _key = "{}/instance/{}".format(prefix, key)
     ins = get_instance(key)
-    redis_client.hdel(_instance_id_key, ins.get("name"))
-    redis_client.delete(_key)
+    name = ins.get("name")
+    pipe = redis_client.pipeline()
+    pipe.hdel(_instance_id_key, name)
+    pipe.delete(_key)
+    pipe.delete("{}/{}".format(_auth_key_prefix, name))
+    pipe.publish(instance_event_channel, name)
+    pipe.execute()
+
+
+def make_auth_key_index(auth_keys: list) -> dict:
+    """
+    public key blob -> authorized key line
+    """
+    index = {}
+    for line in auth_keys:
+        blob = parser_public_key(line)
+        if blob:
+            index.setdefault(blob, line)
+    return index
+
+
+def get_auth_key_index(name) -> tuple:
+    """
+    Instance id and public key index by instance name in one round trip.
+
+    :return (instance id, {key blob: auth key line})
+    """
+    pipe = redis_client.pipeline()
+    pipe.hget(_instance_id_key, name)
+    pipe.hgetall("{}/{}".format(_auth_key_prefix, name))
+    bts, index = pipe.execute()
+    if not bts:
+        return None, {}
+    instance_id = bts.decode()
+    if not index:
+        # instance saved before the index existed
+        ins = get_instance(instance_id) or {}
+        return instance_id, make_auth_key_index(ins.get("auth_keys", []))
+    return instance_id, {k.decode(): v.decode() for k, v in index.items()}
 
 
 def inspec_to_info(item: Container) -> dict:
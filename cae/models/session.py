@@ -0,0 +1,101 @@
+from cae.config import config
+from cae.models import redis_client
+import json
+
+prefix = config.get("REDIS_KEY_PREFIX")
+_sessions_prefix = "{}/channel/sessions".format(prefix)
+_connections_prefix = "{}/channel/connections".format(prefix)
+_stats_prefix = "{}/channel/stats".format(prefix)
+session_kill_channel = "{}/channel/session/kill".format(prefix)
+
+
+def publish_state(node, sessions: dict, removed_sessions: list, connections: dict, removed_connections: list, ttl: int):
+    """
+    Apply one batch of changes of a channel node in one round trip. The
+    node hashes expire unless refreshed, so a node that died leaves no
+    sessions behind.
+    """
+    session_key = "{}/{}".format(_sessions_prefix, node)
+    connection_key = "{}/{}".format(_connections_prefix, node)
+    pipe = redis_client.pipeline(transaction=False)
+    if sessions:
+        pipe.hset(session_key, mapping={k: json.dumps(v) for k, v in sessions.items()})
+    if removed_sessions:
+        pipe.hdel(session_key, *removed_sessions)
+    if connections:
+        pipe.hset(connection_key, mapping={k: json.dumps(v) for k, v in connections.items()})
+    if removed_connections:
+        pipe.hdel(connection_key, *removed_connections)
+    pipe.expire(session_key, ttl)
+    pipe.expire(connection_key, ttl)
+    pipe.execute()
+
+
+def clear_node(node):
+    redis_client.delete("{}/{}".format(_sessions_prefix, node), "{}/{}".format(_connections_prefix, node))
+
+
+def _list(key_prefix) -> list:
+    result = []
+    for key in redis_client.scan_iter("{}/*".format(key_prefix)):
+        result.extend(json.loads(v) for v in redis_client.hvals(key))
+    return result
+
+
+def list_sessions() -> list:
+    return _list(_sessions_prefix)
+
+
+def list_connections() -> list:
+    return _list(_connections_prefix)
+
+
+def get_session(session_id) -> dict:
+    for key in redis_client.scan_iter("{}/*".format(_sessions_prefix)):
+        bts = redis_client.hget(key, session_id)
+        if bts:
+            return json.loads(bts)
+    return None
+
+
+def kill_session(session_id) -> int:
+    """
+    :return number of channel nodes which got the request
+    """
+    return redis_client.publish(session_kill_channel, session_id)
+
+
+def publish_stats(node, stats: dict, ttl: int):
+    redis_client.set("{}/{}".format(_stats_prefix, node), json.dumps(stats), ex=ttl)
+
+
+def list_stats() -> dict:
+    """
+    :return {node: stats} of the live channel worker processes
+    """
+    result = {}
+    for key in redis_client.scan_iter("{}/*".format(_stats_prefix)):
+        bts = redis_client.get(key)
+        if bts:
+            result[key.decode()[len(_stats_prefix) + 1:]] = json.loads(bts)
+    return result
+
+
+def aggregate_stats(items: list) -> dict:
+    """
+    Sum the numbers of several workers' stats, nested dicts are summed
+    key by key and lists element-wise, anything else is left out.
+    """
+    total = {}
+    for item in items:
+        for k, v in item.items():
+            if isinstance(v, bool):
+                continue
+            if isinstance(v, (int, float)):
+                total[k] = total.get(k, 0) + v
+            elif isinstance(v, dict):
+                total[k] = aggregate_stats([total.get(k, {}), v])
+            elif isinstance(v, list) and all(isinstance(x, (int, float)) for x in v):
+                merged = total.get(k, [])
+                total[k] = [a + b for a, b in zip(merged, v)] + merged[len(v):] + v[len(merged):]
+    return total
@@ -1,4 +1,6 @@
 from cae.config import config
+from docker.models.containers import Container
+from docker.utils import decode_json_header
 import docker
 import os
 import json
@@ -6,8 +8,10 @@ import json
 docker_root = "/var/lib/docker"
 
 
-def get_docker_client() -> docker.DockerClient:
-    return docker.DockerClient(**config.get("DOCKER_CLIENT_ARGS", {}))
+def get_docker_client(**kwargs) -> docker.DockerClient:
+    args = dict(config.get("DOCKER_CLIENT_ARGS", {}))
+    args.update(kwargs)
+    return docker.DockerClient(**args)
 
 
 def get_container_config(container_id: str) -> dict:
@@ -31,3 +35,39 @@ def put_container_config(container_id: str, cfg: dict) -> dict:
         raise Exception("can not find container config.json")
     with open(config_json, "w", encoding="utf-8") as fd:
         fd.write(json.dumps(cfg))
+
+
+def container_path_stat(container: Container, path: str) -> dict:
+    """
+    Stat a path inside the container with HEAD /containers/{id}/archive,
+    no tar stream is transferred.
+    """
+    api = container.client.api
+    res = api.head(api._url("/containers/{0}/archive", container.id), params={"path": path})
+    api._raise_for_status(res)
+    encoded_stat = res.headers.get("x-docker-container-path-stat")
+    return decode_json_header(encoded_stat) if encoded_stat else {}
+
+
+def container_get_archive(container: Container, path: str):
+    """
+    GET /containers/{id}/archive as a streamed response, unlike
+    `Container.get_archive` the caller can close it to release the
+    pooled connection before reading it to the end.
+    """
+    api = container.client.api
+    res = api._get(api._url("/containers/{0}/archive", container.id), params={"path": path}, stream=True)
+    api._raise_for_status(res)
+    # a client may pause between reads for longer than the api timeout
+    api._disable_socket_timeout(api._get_raw_response_socket(res))
+    return res
+
+
+def check_container_sshd(container: Container) -> bool:
+    try:
+        stat = container_path_stat(container, "/var/run/sshd.pid")
+        if stat.get("size", 0) < 1:
+            return False
+        return True
+    except docker.errors.NotFound:
+        return False
@@ -1,11 +1,15 @@
 from cae import app
-from cae.config import config
+from cae.config import config, channel_config
 from cae.operators import launch_operators
-from cae.channel.services.sshd import SSHServer
+from cae.channel.services.sshd import SSHServer, listen_socket
+from cae.channel.utils import get_host_key
 from gunicorn.app.base import BaseApplication
 from pretty_logging import pretty_logger
 import multiprocessing
+import os
 import signal
+import socket
+import time
 
 
 class WebApplication(BaseApplication):
@@ -47,30 +51,78 @@ def start_operator():
     return process
 
 
-def start_channel():
+def start_channel(worker=0, sock=None, reuse_port=False):
 
     def _start_channel():
-        pretty_logger.info("start cae channel server")
-        sshd = SSHServer()
+        pretty_logger.info("start cae channel server worker {}".format(worker))
+        sshd = SSHServer(sock=sock, worker=worker, reuse_port=reuse_port)
         sshd.run()
 
-    process = multiprocessing.Process(target=_start_channel, daemon=False)
+    process = multiprocessing.Process(target=_start_channel, daemon=False, name="channel-{}".format(worker))
     process.start()
     return process
 
 
+class ChannelSupervisor:
+    """
+    Paramiko's crypto holds the GIL, one channel process per core lets ssh
+    throughput scale with the node. Workers share the port by SO_REUSEPORT
+    or a listening socket opened before forking, and are restarted when
+    they die.
+    """
+    restart_delay = 5
+
+    def __init__(self, workers=None):
+        self.workers = workers or channel_config["CHANNEL_WORKERS"] or os.cpu_count() or 1
+        self.reuse_port = channel_config["CHANNEL_REUSE_PORT"] and hasattr(socket, "SO_REUSEPORT")
+        self.sock = None
+        self.procs = []
+        self.started = []
+        self.stopping = False
+
+    def start(self):
+        # generated here when missing, workers only load it
+        get_host_key(channel_config["HOST_KEY_TYPE"], channel_config["HOST_PRIVATE_KEY"], channel_config["HOST_PUBLIC_KEY"])
+        if not self.reuse_port:
+            self.sock = listen_socket()
+        for i in range(self.workers):
+            self.procs.append(start_channel(i, self.sock, self.reuse_port))
+            self.started.append(time.monotonic())
+        pretty_logger.info("started {} channel workers, {}".format(
+            self.workers, "SO_REUSEPORT" if self.reuse_port else "shared socket"))
+
+    def supervise(self):
+        while not self.stopping:
+            for i, proc in enumerate(self.procs):
+                if proc.is_alive() or self.stopping:
+                    continue
+                # a worker failing right at start would otherwise spin
+                if time.monotonic() - self.started[i] < self.restart_delay:
+                    continue
+                pretty_logger.error("channel worker {} exited with {}, restarting".format(i, proc.exitcode))
+                self.procs[i] = start_channel(i, self.sock, self.reuse_port)
+                self.started[i] = time.monotonic()
+            time.sleep(1)
+
+    def kill(self):
+        self.stopping = True
+        for proc in self.procs:
+            proc.kill()
+
+
 def main():
 
     start_server()
     start_operator()
-    channel_proc = start_channel()
+    channels = ChannelSupervisor()
+    channels.start()
 
     def exit_kill(sig, frame):
-        channel_proc.kill()
+        channels.kill()
         pretty_logger.info("shutdown bye bye")
     for sig in [signal.SIGINT, signal.SIGHUP, signal.SIGTERM]:
         signal.signal(sig, exit_kill)
-    signal.pause()
+    channels.supervise()
 
 
 if __name__ == "__main__":
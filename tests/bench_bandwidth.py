@@ -0,0 +1,84 @@
+"""
+Bandwidth shaping of a bulk session next to an interactive one.
+
+An exec session (no pty) streams as fast as the far end writes while a
+pty session echoes single keystrokes. Run with the global limit off and
+on, the pty session should keep its echo latency under the limit.
+
+python tests/bench_bandwidth.py [global_mb_s] [seconds]
+"""
+import paramiko
+import statistics
+import sys
+import threading
+import time
+from bench_relay import ssh_pair, tcp_pair
+from bench_record import echo
+from cae.config import channel_config as config
+from cae.channel.models.connections import Client
+from cae.channel.models import exec, Session
+from cae.channel.models.shaper import shaper
+
+
+def new_session(host_key, meta):
+    user_chan, relay_client_chan = ssh_pair(host_key, host_key)
+    client = Client(chan=relay_client_chan, addr=("127.0.0.1", 0))
+    client.request.meta.update(meta)
+    near, far = tcp_pair()
+    server = exec.Server(chan=near, asset={}, system_user={}, container=None, exec_id=None)
+    session = Session.new_session(client, server, kind="exec")
+    session.bridge()
+    return session, user_chan, far
+
+
+def blast(far, stop):
+    payload = b"x" * 65536
+    while not stop.is_set():
+        far.sendall(payload)
+
+
+def bench(limit, seconds, host_key):
+    config["BANDWIDTH_GLOBAL"] = limit
+    bulk, bulk_user, bulk_far = new_session(host_key, {"width": 80, "height": 24})
+    pty, pty_user, pty_far = new_session(host_key, {"term": "xterm", "width": 80, "height": 24})
+    stop = threading.Event()
+    threading.Thread(target=blast, args=(bulk_far, stop), daemon=True).start()
+    threading.Thread(target=echo, args=(pty_far, stop), daemon=True).start()
+    received = [0]
+
+    def drain():
+        while not stop.is_set():
+            received[0] += len(bulk_user.recv(65536))
+
+    threading.Thread(target=drain, daemon=True).start()
+    time.sleep(0.2)
+    start = time.perf_counter()
+    base = received[0]
+    latencies = []
+    while time.perf_counter() - start < seconds:
+        t = time.perf_counter()
+        pty_user.sendall(b"a")
+        pty_user.recv(1)
+        latencies.append((time.perf_counter() - t) * 1000)
+        time.sleep(0.005)
+    elapsed = time.perf_counter() - start
+    result = {
+        "global_mb_s": limit / 1024 / 1024,
+        "bulk_mb_s": round((received[0] - base) / elapsed / 1024 / 1024, 1),
+        "echo_p50_ms": round(statistics.median(latencies), 3),
+        "echo_p99_ms": round(sorted(latencies)[int(len(latencies) * 0.99) - 1], 3),
+        "bandwidth": shaper.stats(),
+    }
+    stop.set()
+    for session in (bulk, pty):
+        session.stop_evt.set()
+        Session.remove_session(session.id)
+    return result
+
+
+if __name__ == "__main__":
+    limit = int(float(sys.argv[1]) * 1024 * 1024) if len(sys.argv) > 1 else 16 * 1024 * 1024
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 3
+    host_key = paramiko.RSAKey.generate(2048)
+    for rate in [0, limit]:
+        print(bench(rate, seconds, host_key))
@@ -0,0 +1,87 @@
+"""
+SSH handshake latency by host key type.
+
+python tests/bench_handshake.py [rounds]
+"""
+import os
+import paramiko
+import shutil
+import socket
+import tempfile
+import threading
+import statistics
+import sys
+import time
+from io import StringIO
+from cae.channel.utils import ssh_key_gen, get_host_key, KEY_CLASSES
+
+KEY_LENGTHS = {"rsa": 2048, "ecdsa": 256, "ed25519": None}
+
+
+def host_key(key_type, key_dir):
+    """
+    Generated and loaded the way the channel does on a fresh install.
+    """
+    return get_host_key(key_type, os.path.join(key_dir, "id_" + key_type), os.path.join(key_dir, "id_" + key_type + ".pub"))[0]
+
+
+def client_key(key_type):
+    private_key, _ = ssh_key_gen(length=KEY_LENGTHS[key_type], type=key_type)
+    return KEY_CLASSES[key_type].from_private_key(StringIO(private_key))
+
+
+class Interface(paramiko.ServerInterface):
+
+    def get_allowed_auths(self, username):
+        return "publickey"
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+
+def serve(sock, host_key, rounds):
+    paramiko.Transport.load_server_moduli()
+    for _ in range(rounds):
+        conn, _ = sock.accept()
+        transport = paramiko.Transport(conn)
+        transport.add_server_key(host_key)
+        transport.start_server(server=Interface())
+        transport.join()
+
+
+def bench(key_type, rounds, key_dir):
+    server_key = host_key(key_type, key_dir)
+    user_key = client_key(key_type)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    sock.listen(16)
+    port = sock.getsockname()[1]
+    t = threading.Thread(target=serve, args=(sock, server_key, rounds), daemon=True)
+    t.start()
+
+    costs = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        transport = paramiko.Transport(("127.0.0.1", port))
+        transport.connect(username="bench", pkey=user_key)
+        costs.append((time.perf_counter() - start) * 1000)
+        transport.close()
+    t.join()
+    sock.close()
+    costs.sort()
+    return {
+        "key": key_type,
+        "p50_ms": round(statistics.median(costs), 2),
+        "p99_ms": round(costs[min(len(costs) - 1, int(len(costs) * 0.99))], 2),
+        "mean_ms": round(statistics.mean(costs), 2),
+    }
+
+
+if __name__ == "__main__":
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    key_dir = tempfile.mkdtemp()
+    try:
+        for key_type in ["rsa", "ecdsa", "ed25519"]:
+            print(bench(key_type, rounds, key_dir))
+    finally:
+        shutil.rmtree(key_dir)
@@ -0,0 +1,107 @@
+"""
+Keystroke echo latency of a pty session with and without recording.
+
+Each round sends one byte from the ssh user side, the far end echoes it
+back, recording writes casts to a temporary directory. A background
+flood of output can be added to load the recorder while measuring.
+
+python tests/bench_record.py [rounds] [flood_kb_s]
+"""
+import paramiko
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from bench_relay import ssh_pair, tcp_pair
+from cae.config import channel_config as config
+from cae.channel.models.connections import Client
+from cae.channel.models import exec, Session, recorder
+
+
+def echo(far, stop):
+    while not stop.is_set():
+        data = far.recv(65536)
+        if not data:
+            return
+        far.sendall(data)
+
+
+def flood(far, rate, stop):
+    line = b"x" * 1023 + b"\n"
+    while not stop.is_set():
+        for _ in range(rate // 100):
+            far.sendall(line)
+        time.sleep(0.01)
+
+
+def drain(user_chan, stop):
+    while not stop.is_set():
+        if not user_chan.recv(65536):
+            return
+
+
+def bench(record, rounds, flood_rate, host_key):
+    config["RECORD_ENABLED"] = record
+    user_chan, relay_client_chan = ssh_pair(host_key, host_key)
+    client = Client(chan=relay_client_chan, addr=("127.0.0.1", 0))
+    client.request.meta.update({"term": "xterm", "width": 80, "height": 24})
+    near, far = tcp_pair()
+    server = exec.Server(chan=near, asset={}, system_user={}, container=None, exec_id=None)
+    session = Session.new_session(client, server, kind="exec")
+    done = threading.Event()
+    session.on_finish(lambda s: done.set())
+    session.bridge()
+
+    latencies = []
+    stop = threading.Event()
+    if flood_rate:
+        # a second session carries the flood, its output goes through the same recorder queue
+        flood_user, flood_client_chan = ssh_pair(host_key, host_key)
+        flood_client = Client(chan=flood_client_chan, addr=("127.0.0.1", 0))
+        flood_client.request.meta.update(client.request.meta)
+        flood_near, flood_far = tcp_pair()
+        flood_session = Session.new_session(flood_client, exec.Server(
+            chan=flood_near, asset={}, system_user={}, container=None, exec_id=None), kind="exec")
+        flood_session.bridge()
+        threading.Thread(target=flood, args=(flood_far, flood_rate, stop), daemon=True).start()
+        threading.Thread(target=drain, args=(flood_user, stop), daemon=True).start()
+    threading.Thread(target=echo, args=(far, stop), daemon=True).start()
+    time.sleep(0.2)
+    for _ in range(rounds):
+        start = time.perf_counter()
+        user_chan.sendall(b"a")
+        user_chan.recv(1)
+        latencies.append((time.perf_counter() - start) * 1000)
+    metrics = session.metrics()
+    stop.set()
+    session.stop_evt.set()
+    done.wait(5)
+    Session.remove_session(session.id)
+    if flood_rate:
+        flood_session.stop_evt.set()
+    latencies.sort()
+    return {
+        "record": record,
+        "flood_kb_s": flood_rate,
+        "p50_ms": round(statistics.median(latencies), 3),
+        "p99_ms": round(latencies[int(len(latencies) * 0.99) - 1], 3),
+        # measured by the relay, the far end only
+        "relay_echo_p50_ms": metrics.get("echo_p50_ms"),
+        "relay_echo_p99_ms": metrics.get("echo_p99_ms"),
+        "recorder": recorder.stats(),
+    }
+
+
+if __name__ == "__main__":
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    flood_rate = int(sys.argv[2]) if len(sys.argv) > 2 else 4096
+    config["RECORD_DIR"] = tempfile.mkdtemp()
+    host_key = paramiko.RSAKey.generate(2048)
+    try:
+        for rate in [0, flood_rate]:
+            for record in [False, True]:
+                print(bench(record, rounds, rate, host_key))
+    finally:
+        shutil.rmtree(config["RECORD_DIR"])
@@ -0,0 +1,113 @@
+"""
+Relay throughput of each session type against local stand-ins.
+
+The ssh user side and the stand-in sshd (proxy) are in-process paramiko
+transports, direct and exec relay to a plain local tcp socket. Importing
+cae builds the api app, so run it where the docker socket is reachable.
+
+python tests/bench_relay.py [megabytes]
+"""
+import paramiko
+import socket
+import sys
+import threading
+import time
+from cae.channel.utils import ObjDict
+from cae.channel.models.connections import Client
+from cae.channel.models import proxy, direct, exec, Session
+
+CHUNK = 256 * 1024
+
+
+class Interface(paramiko.ServerInterface):
+
+    def get_allowed_auths(self, username):
+        return "publickey"
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+
+def ssh_pair(host_key, user_key):
+    """
+    :return (client side channel, server side channel)
+    """
+    a, b = socket.socketpair()
+    server = paramiko.Transport(a)
+    server.add_server_key(host_key)
+    server.start_server(event=threading.Event(), server=Interface())
+    client = paramiko.Transport(b)
+    client.connect(username="bench", pkey=user_key)
+    chan = client.open_session()
+    return chan, server.accept(10)
+
+
+def tcp_pair():
+    """
+    :return (relay side socket, far end socket)
+    """
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+    near = socket.create_connection(listener.getsockname())
+    far, _ = listener.accept()
+    listener.close()
+    return near, far
+
+
+def pump(sender, receiver, total):
+    payload = b"x" * CHUNK
+
+    def _send():
+        sent = 0
+        while sent < total:
+            sender.sendall(payload)
+            sent += len(payload)
+
+    start = time.perf_counter()
+    threading.Thread(target=_send, daemon=True).start()
+    received = 0
+    while received < total:
+        data = receiver.recv(CHUNK)
+        if not data:
+            break
+        received += len(data)
+    return received / (time.perf_counter() - start) / 1024 / 1024
+
+
+def bench(kind, total, host_key, user_key):
+    user_chan, relay_client_chan = ssh_pair(host_key, user_key)
+    client = Client(chan=relay_client_chan, addr=("127.0.0.1", 0))
+    client.request.meta.update({"width": 80, "height": 24})
+    if kind == "proxy":
+        upstream_chan, far = ssh_pair(host_key, user_key)
+        asset = ObjDict(ip="127.0.0.1", ssh_port=22)
+        server = proxy.Server(upstream_chan, None, asset, ObjDict(username="bench"))
+    elif kind == "direct":
+        near, far = tcp_pair()
+        server = direct.Server(chan=near, asset={}, system_user={})
+    else:
+        near, far = tcp_pair()
+        server = exec.Server(chan=near, asset={}, system_user={}, container=None, exec_id=None)
+
+    session = Session.new_session(client, server, kind=kind)
+    done = threading.Event()
+    session.on_finish(lambda s: done.set())
+    session.bridge()
+    upload = pump(user_chan, far, total)
+    download = pump(far, user_chan, total)
+    session.stop_evt.set()
+    done.wait(5)
+    Session.remove_session(session.id)
+    return {"session": kind, "upload_mb_s": round(upload, 1), "download_mb_s": round(download, 1)}
+
+
+if __name__ == "__main__":
+    megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+    host_key = paramiko.RSAKey.generate(2048)
+    user_key = paramiko.RSAKey.generate(2048)
+    for kind in ["proxy", "direct", "exec"]:
+        print(bench(kind, megabytes * 1024 * 1024, host_key, user_key))
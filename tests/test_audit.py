@@ -0,0 +1,140 @@
+"""
+Command audit of pty sessions, parsed off the relay loop.
+"""
+import json
+import pytest
+import queue
+import time
+import types
+from cae.config import channel_config as config
+from cae.channel.models.connections import Client
+from cae.channel.models.audit import SessionAudit, CommandAuditor
+
+
+def session(sid="s1", pty=True, command=None):
+    client = Client(user={"instance_id": "i1", "username": "root"}, addr=("10.0.0.9", 0), login_from="ST")
+    if pty:
+        client.request.meta.update({"term": "xterm", "width": 80, "height": 24})
+    if command is not None:
+        client.request.type = "exec"
+    return types.SimpleNamespace(id=sid, client=client, command=command)
+
+
+def type_command(audit, ts, command, output):
+    """
+    :return the records fed back while the user types command and it prints output
+    """
+    records = []
+    for c in command:
+        records.append(audit.feed(ts, "i", c.encode()))
+        records.append(audit.feed(ts, "o", c.encode()))
+    records.append(audit.feed(ts, "i", b"\r"))
+    records.append(audit.feed(ts, "o", b"\r\n" + output + b"\r\nroot@box:~# "))
+    return [r for r in records if r]
+
+
+def wait(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return predicate()
+
+
+def test_commands_and_output():
+    audit = SessionAudit(session(), None)
+    audit.feed(1, "o", b"root@box:~# ")
+    assert type_command(audit, 2, "ls", b"file1  file2") == []
+    # the command is done once the user types again
+    record, = type_command(audit, 3, "pwd", b"/root")
+    assert record == {
+        "session_id": "s1", "instance_id": "i1", "user": "root", "remote_addr": "10.0.0.9", "login_from": "ST",
+        "command": "ls", "output": "file1  file2", "timestamp": 2,
+    }
+    record = audit.finish()
+    assert (record["command"], record["output"], record["timestamp"]) == ("pwd", "/root", 3)
+    assert audit.finish() is None
+
+
+def test_output_is_bounded(monkeypatch):
+    monkeypatch.setitem(config, "AUDIT_OUTPUT_MAX", 64)
+    audit = SessionAudit(session(), None)
+    audit.feed(1, "o", b"root@box:~# ")
+    type_command(audit, 2, "yes", b"y\r\n" * 1000)
+    record = audit.finish()
+    assert record["command"] == "yes"
+    assert len(record["output"]) <= 64
+
+
+def test_resize():
+    audit = SessionAudit(session(), None)
+    audit.feed(1, "r", (120, 40))
+    assert (audit.parser.screen.columns, audit.parser.screen.lines) == (120, 40)
+
+
+@pytest.fixture
+def audit_file(tmp_path, monkeypatch):
+    path = tmp_path / "audit.log"
+    monkeypatch.setitem(config, "AUDIT_ENABLED", True)
+    monkeypatch.setitem(config, "AUDIT_SINK", "file")
+    monkeypatch.setitem(config, "AUDIT_FILE", str(path))
+    monkeypatch.setitem(config, "AUDIT_WORKERS", 2)
+    monkeypatch.setitem(config, "AUDIT_BATCH_INTERVAL", 0.01)
+    monkeypatch.setitem(config, "AUDIT_FLUSH_INTERVAL", 0)
+
+    def records():
+        if not path.exists():
+            return []
+        return [json.loads(line) for line in path.read_text().splitlines()]
+
+    return records
+
+
+def test_auditor_writes_records(audit_file):
+    auditor = CommandAuditor()
+    assert auditor.new_audit(session(pty=False)) is None
+    # an exec request is recorded at once
+    assert auditor.new_audit(session(sid="e1", command="uptime")) is None
+    audit = auditor.new_audit(session())
+    auditor.feed(audit, "o", b"root@box:~# ")
+    for c in b"ls":
+        auditor.feed(audit, "i", bytes([c]))
+        auditor.feed(audit, "o", memoryview(bytearray([c])))
+    auditor.feed(audit, "i", b"\r")
+    auditor.feed(audit, "o", b"\r\nfile1\r\nroot@box:~# ")
+    auditor.stop(audit)
+    assert wait(lambda: len(audit_file()) == 2)
+    records = {r["session_id"]: r for r in audit_file()}
+    assert (records["e1"]["command"], records["e1"]["output"]) == ("uptime", None)
+    assert (records["s1"]["command"], records["s1"]["output"]) == ("ls", "file1")
+    assert auditor.stats()["commands"] == 2
+
+
+def test_disabled(monkeypatch):
+    monkeypatch.setitem(config, "AUDIT_ENABLED", False)
+    auditor = CommandAuditor()
+    assert auditor.new_audit(session()) is None
+    assert auditor.workers == []
+
+
+def test_dropped_chunks_mark_the_command():
+    auditor = CommandAuditor()
+    # a worker that is not running, its queue fills up
+    audit = SessionAudit(session(), types.SimpleNamespace(queue=queue.Queue(maxsize=1)))
+    auditor.feed(audit, "o", b"a")
+    auditor.feed(audit, "o", b"b")
+    auditor.resize(audit, 100, 30)
+    assert auditor.stats()["dropped"] == 2
+    assert audit.lost
+    audit.feed(1, "o", b"root@box:~# ls")
+    audit.feed(1, "i", b"\r")
+    record = audit.finish()
+    assert record["command"] == "ls" and record["incomplete"]
+    assert not audit.lost
+
+
+def test_failed_sink_is_counted(audit_file, monkeypatch):
+    monkeypatch.setitem(config, "AUDIT_FILE", "/proc/no-such-dir/audit.log")
+    auditor = CommandAuditor()
+    auditor.emit([{"command": "ls"}, {"command": "pwd"}])
+    assert auditor.stats()["failed"] == 2
+    assert auditor.stats()["commands"] == 0
@@ -0,0 +1,266 @@
+"""
+Instance and container caches of the channel and what invalidates them.
+"""
+import pytest
+import types
+from docker.errors import NotFound
+from cae.config import config as app_config, channel_config as config
+from cae.models import instance
+from cae.channel.models import cache as cache_module
+from cae.channel.models.cache import InstanceCache, ContainerCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache_module, "time", types.SimpleNamespace(monotonic=lambda: now[0]))
+    return now
+
+
+@pytest.fixture
+def redis(monkeypatch):
+    """
+    The auth key indexes in redis, counting round trips.
+    """
+    store = types.SimpleNamespace(instances={}, loads=0)
+
+    def get_auth_key_index(name):
+        store.loads += 1
+        if name not in store.instances:
+            return None, {}
+        instance_id, lines = store.instances[name]
+        return instance_id, instance.make_auth_key_index(lines)
+
+    monkeypatch.setattr(instance, "get_auth_key_index", get_auth_key_index)
+    return store
+
+
+def test_auth_key_index():
+    index = instance.make_auth_key_index(["ssh-ed25519 AAAA1 a@b", "AAAA2", "ssh-rsa AAAA1 again", ""])
+    assert index == {"AAAA1": "ssh-ed25519 AAAA1 a@b", "AAAA2": "AAAA2"}
+
+
+def test_instance_lookup_is_cached(redis, clock):
+    redis.instances["box"] = ("i1", ["ssh-ed25519 AAAA1 a@b", "ssh-rsa AAAA2"])
+    cache = InstanceCache(ttl=300)
+    found = cache.lookup("box", "AAAA2")
+    assert found == ("i1", "ssh-rsa AAAA2", ["ssh-ed25519 AAAA1 a@b", "ssh-rsa AAAA2"])
+    # every further key offered is a dict lookup
+    assert cache.lookup("box", "AAAA1")[1] == "ssh-ed25519 AAAA1 a@b"
+    assert redis.loads == 1
+    clock[0] += 301
+    cache.lookup("box", "AAAA1")
+    assert redis.loads == 2
+    assert cache.stats()["hits"] == 1
+
+
+def test_wrong_keys_are_remembered(redis, clock, monkeypatch):
+    monkeypatch.setitem(config, "AUTH_NEGATIVE_TTL", 30)
+    redis.instances["box"] = ("i1", ["ssh-rsa AAAA1"])
+    cache = InstanceCache(ttl=0)
+    assert cache.lookup("box", "WRONG") is None
+    assert cache.lookup("box", "WRONG") is None
+    assert cache.lookup("nobox", "AAAA1") is None
+    assert cache.lookup("nobox", "AAAA1") is None
+    assert redis.loads == 2
+    assert cache.stats()["negative_hits"] == 2
+    clock[0] += 31
+    assert cache.lookup("box", "WRONG") is None
+    assert redis.loads == 3
+
+
+def test_instance_change_invalidates(redis, clock):
+    redis.instances["box"] = ("i1", ["ssh-rsa AAAA1"])
+    cache = InstanceCache(ttl=300)
+    assert cache.lookup("box", "AAAA2") is None
+    # put_instance publishes the name, the key added is found at once
+    redis.instances["box"] = ("i1", ["ssh-rsa AAAA1", "ssh-rsa AAAA2"])
+    cache.invalidate("box")
+    assert cache.lookup("box", "AAAA2")[1] == "ssh-rsa AAAA2"
+    # del_instance
+    del redis.instances["box"]
+    cache.invalidate("box")
+    assert cache.lookup("box", "AAAA1") is None
+    # resubscribing drops everything
+    redis.instances["box"] = ("i2", ["ssh-rsa AAAA1"])
+    cache.invalidate()
+    assert cache.lookup("box", "AAAA1")[0] == "i2"
+
+
+def test_negative_cache_is_bounded(redis, monkeypatch):
+    monkeypatch.setitem(config, "AUTH_NEGATIVE_MAX", 4)
+    cache = InstanceCache()
+    for i in range(10):
+        cache.lookup("box{}".format(i), "KEY")
+    assert len(cache.failures) <= 4
+
+
+class Container:
+
+    def __init__(self, cid, labels=None, status="running", image="sha256:img"):
+        self.id = cid
+        self.name = cid
+        self.labels = dict({"cae.app": "true"}, **(labels or {}))
+        self.status = status
+        network = {app_config.get("DOCKER_NETWORK"): {"IPAddress": "10.0.0.2"}}
+        self.attrs = {"Id": cid, "Image": image, "NetworkSettings": {"Networks": network}}
+
+
+class Docker:
+
+    def __init__(self):
+        self.containers_ = {}
+        self.gets = 0
+        self.containers = self
+
+    def get(self, cid):
+        self.gets += 1
+        if cid not in self.containers_:
+            raise NotFound(cid)
+        return self.containers_[cid]
+
+
+@pytest.fixture
+def docker():
+    return Docker()
+
+
+def container_cache(docker, ttl=60):
+    cache = ContainerCache(ttl=ttl)
+    cache._dc = docker
+    return cache
+
+
+def event(action, cid, kind="container"):
+    if kind == "network":
+        return {"Type": "network", "Action": action, "Actor": {"Attributes": {"container": cid}}}
+    return {"Type": kind, "Action": action, "Actor": {"ID": cid}}
+
+
+def test_container_is_cached(docker, clock):
+    docker.containers_["c1"] = Container("c1")
+    cache = container_cache(docker)
+    entry = cache.get("c1")
+    assert entry.ip == "10.0.0.2"
+    assert cache.get("c1") is entry
+    assert docker.gets == 1
+    clock[0] += 61
+    assert cache.get("c1") is not entry
+    assert docker.gets == 2
+
+
+def test_only_running_cae_containers(docker, clock):
+    docker.containers_["stopped"] = Container("stopped", status="exited")
+    docker.containers_["other"] = Container("other", labels={"cae.app": "false"})
+    cache = container_cache(docker)
+    assert cache.get("stopped") is None
+    assert cache.get("other") is None
+    assert cache.get("missing") is None
+    assert cache.entries == {}
+
+
+def test_events_invalidate(docker, clock):
+    docker.containers_["c1"] = Container("c1")
+    cache = container_cache(docker)
+    for e in (event("stop", "c1"), event("disconnect", "c1", kind="network"), event("rename", "c1")):
+        cache.get("c1")
+        cache.on_event(e)
+        assert "c1" not in cache.entries
+    # exec and health events leave it
+    cache.get("c1")
+    cache.on_event(event("exec_start: sh", "c1"))
+    cache.on_event(event("health_status: healthy", "c1"))
+    assert "c1" in cache.entries
+
+
+def test_sshd_probe(docker, clock, monkeypatch):
+    probes = []
+    running = {"c1": False}
+
+    def check_container_sshd(container):
+        probes.append(container.id)
+        return running[container.id]
+
+    monkeypatch.setattr(cache_module.docker_service, "check_container_sshd", check_container_sshd)
+    monkeypatch.setitem(config, "SSHD_NEGATIVE_TTL", 30)
+    docker.containers_["c1"] = Container("c1")
+    cache = container_cache(docker)
+    entry = cache.get("c1")
+    assert not cache.has_sshd(entry)
+    assert not cache.has_sshd(entry)
+    assert len(probes) == 1
+    # a failed probe is retried after a while
+    running["c1"] = True
+    clock[0] += 31
+    assert cache.has_sshd(entry)
+    assert cache.has_sshd(entry)
+    assert len(probes) == 2
+    # kept over other events, reprobed after a restart
+    cache.on_event(event("stop", "c1"))
+    assert cache.has_sshd(entry)
+    cache.on_event(event("restart", "c1"))
+    assert cache.has_sshd(entry)
+    assert len(probes) == 3
+    # the label skips the probe
+    docker.containers_["c2"] = Container("c2", labels={"cae.sshd": "false"})
+    assert not cache.has_sshd(cache.get("c2"))
+    assert len(probes) == 3
+
+
+def test_login_shell_per_image(docker, clock, monkeypatch):
+    stats = []
+    present = {"/bin/sh", "/usr/bin/fish"}
+
+    def container_path_stat(container, path):
+        stats.append(path)
+        if path not in present:
+            raise NotFound(path)
+        return {}
+
+    monkeypatch.setattr(cache_module.docker_service, "container_path_stat", container_path_stat)
+    monkeypatch.setitem(config, "EXEC_SHELLS", ["/bin/bash", "/bin/sh"])
+    docker.containers_["c1"] = Container("c1")
+    docker.containers_["c2"] = Container("c2")
+    docker.containers_["c3"] = Container("c3", labels={"cae.shell": "/usr/bin/fish"})
+    cache = container_cache(docker)
+    assert cache.login_shell(cache.get("c1")) == "/bin/sh"
+    # same image, no probe
+    assert cache.login_shell(cache.get("c2")) == "/bin/sh"
+    assert stats == ["/bin/bash", "/bin/sh"]
+    assert cache.login_shell(cache.get("c3")) == "/usr/bin/fish"
+    cache.forget_shell(cache.get("c1"))
+    assert cache.login_shell(cache.get("c1")) == "/bin/sh"
+    assert len(stats) == 5
+    present.clear()
+    cache.forget_shell(cache.get("c1"))
+    with pytest.raises(Exception):
+        cache.login_shell(cache.get("c1"))
+
+
+def test_per_container_state_follows_the_process(docker, clock, monkeypatch):
+    monkeypatch.setitem(config, "SFTP_LISTING_TTL", 10)
+    cache = ContainerCache()
+    cache.set_public_key_digest("c1", "root", "d1")
+    cache.set_public_key_digest("c1", "app", "d2")
+    cache.set_passwd_entries("c1", "stat", {"root": {}})
+    cache.set_listing("c1", "/root", 0, {"a": 1})
+    cache.set_listing("c1", "/tmp", 1000, {"b": 1})
+    # listings are per uid and expire
+    assert cache.listing("c1", "/root", 0) == {"a": 1}
+    assert cache.listing("c1", "/root", 1000) is None
+    clock[0] += 11
+    assert cache.listing("c1", "/root", 0) is None
+    cache.set_listing("c1", "/root", 0, {"a": 2})
+    cache.forget_listing("c1", "/root")
+    assert cache.listing("c1", "/root", 0) is None
+    cache.forget_public_key("c1", "app")
+    assert cache.public_key_digest("c1", "root") == "d1"
+    assert cache.public_key_digest("c1", "app") is None
+    # a restart drops it all
+    started = []
+    cache.on_container_start(started.append)
+    cache.on_event(event("start", "c1"))
+    assert started == ["c1"]
+    assert cache.public_key_digest("c1", "root") is None
+    assert cache.passwd_entries("c1") is None
+    assert cache.listings == {}
@@ -0,0 +1,110 @@
+"""
+Exec requests as a real paramiko transport hands them to the interface.
+"""
+import json
+import paramiko
+import socket
+import threading
+import time
+from cae.config import channel_config as config
+from cae.channel.models.connections import Connection
+from cae.channel.models.exec import ExecServer
+from cae.channel.models.interface import SSHInterface
+
+
+class Interface(SSHInterface):
+
+    def check_auth_publickey(self, username, key):
+        self.connection.user = {"username": "root", "instance_id": "test"}
+        return paramiko.AUTH_SUCCESSFUL
+
+
+class API:
+    """
+    docker api stand-in, the exec command goes to the daemon as json.
+    """
+
+    def __init__(self):
+        self.body = None
+        self.resizes = []
+        self.far = None
+
+    def exec_create(self, container, cmd, **kwargs):
+        self.body = json.dumps({"Cmd": cmd})
+        return {"Id": "exec"}
+
+    def exec_start(self, exec_id, **kwargs):
+        # the far end stays open, the exec runs until the test ends it
+        sock, self.far = socket.socketpair()
+        return sock
+
+    def exec_resize(self, exec_id, height, width):
+        self.resizes.append((width, height))
+
+
+class Container:
+    id = "container"
+
+    def __init__(self, api):
+        self.client = type("DockerClient", (), {"api": api})()
+
+
+def exec_request(command, pty=False):
+    """
+    :return the relay client of a channel that requested `command`
+    """
+    a, b = socket.socketpair()
+    connection = Connection(sock=a, addr=("127.0.0.1", 0))
+    server = paramiko.Transport(a)
+    server.add_server_key(paramiko.RSAKey.generate(2048))
+    server.start_server(event=threading.Event(), server=Interface(connection))
+    user = paramiko.Transport(b)
+    user.connect(username="test:root", pkey=paramiko.RSAKey.generate(2048))
+    chan = user.open_session()
+    if pty:
+        chan.get_pty(width=80, height=24)
+    chan.exec_command(command)
+    relay_chan = server.accept(10)
+    client = connection.get_client(relay_chan)
+    # as the sshd's on_channel
+    client.chan = relay_chan
+    assert client.request_evt.wait(10)
+    return client
+
+
+def test_exec_command_is_decoded():
+    client = exec_request("echo 'héllo' >&2")
+    assert client.request.meta["command"] == "echo 'héllo' >&2"
+    api = API()
+    server = ExecServer(client, {}, {"username": "root"}, Container(api))
+    server.exec_run(user="root", tty=False, command=server.command)
+    assert json.loads(api.body)["Cmd"] == ["/bin/sh", "-c", "echo 'héllo' >&2"]
+
+
+def test_initial_size_does_not_override_a_window_change(monkeypatch):
+    monkeypatch.setitem(config, "RESIZE_DEBOUNCE", 0.2)
+    client = exec_request("top", pty=True)
+    api = API()
+    server = ExecServer(client, {}, {"username": "root"}, Container(api))
+    server.proxy()
+    # the window changes right after the start
+    client.request.meta.update({"width": 120, "height": 40})
+    client.resize()
+    deadline = time.monotonic() + 5
+    while not api.resizes and time.monotonic() < deadline:
+        time.sleep(0.01)
+    time.sleep(0.3)
+    client.session.stop_evt.set()
+    assert api.resizes == [(120, 40)]
+
+
+def test_initial_size_is_applied(monkeypatch):
+    monkeypatch.setitem(config, "RESIZE_DEBOUNCE", 0.01)
+    client = exec_request("top", pty=True)
+    api = API()
+    ExecServer(client, {}, {"username": "root"}, Container(api)).proxy()
+    deadline = time.monotonic() + 5
+    while not api.resizes and time.monotonic() < deadline:
+        time.sleep(0.01)
+    client.session.stop_evt.set()
+    assert api.resizes == [(80, 24)]
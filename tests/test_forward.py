@@ -0,0 +1,110 @@
+"""
+Remote forward listeners, bound for the instance only.
+"""
+import paramiko
+import pytest
+import socket
+import threading
+import time
+from cae.config import channel_config as config
+from cae.channel.models import forward
+from cae.channel.models.forward import ForwardManager
+
+
+class Transport:
+
+    def __init__(self):
+        self.opened = []
+        self.event = threading.Event()
+
+    def open_channel(self, kind, dest_addr, src_addr, timeout):
+        self.opened.append((kind, dest_addr, src_addr))
+        self.event.set()
+        raise paramiko.SSHException("refused by the test")
+
+
+class Connection:
+
+    def __init__(self, instance_id="i1", username="root"):
+        self.user = {"instance_id": instance_id, "username": username}
+        self.addr = ("10.0.0.1", 50000)
+        self.transport = Transport()
+
+
+@pytest.fixture
+def manager(monkeypatch):
+    # the instance is 127.0.0.2, the listener binds the address facing it
+    monkeypatch.setattr(forward, "instance_address", lambda instance_id: "127.0.0.2" if instance_id else None)
+    monkeypatch.setitem(config, "REMOTE_FORWARD_MAX_PER_USER", 2)
+    manager = ForwardManager()
+    yield manager
+    for f in manager.get_forwards():
+        manager.remove(f)
+
+
+def connect(port, source):
+    sock = socket.socket()
+    sock.bind((source, 0))
+    sock.connect(("127.0.0.1", port))
+    return sock
+
+
+def wait(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return predicate()
+
+
+def test_bind_for_the_instance(manager):
+    connection = Connection()
+    port = manager.add(connection, "localhost", 0)
+    assert port
+    f, = manager.get_forwards(connection)
+    assert f.sock.getsockname() == ("127.0.0.1", port)
+    assert f.peer == "127.0.0.2"
+    # the instance gets a forwarded-tcpip channel
+    connect(port, "127.0.0.2").close()
+    assert connection.transport.event.wait(5)
+    assert connection.transport.opened[0][:2] == ("forwarded-tcpip", ("localhost", port))
+    # anyone else is refused before a channel is opened
+    other = connect(port, "127.0.0.3")
+    assert wait(lambda: f.rejected == 2)
+    assert other.recv(1) == b""
+    assert len(connection.transport.opened) == 1
+
+
+def test_instance_without_address_is_refused(manager):
+    assert manager.add(Connection(instance_id=None), "", 0) is False
+    assert manager.get_forwards() == []
+
+
+def test_cancel_closes_the_listener(manager):
+    connection = Connection()
+    port = manager.add(connection, "localhost", 0)
+    f, = manager.get_forwards(connection)
+    manager.cancel(connection, "localhost", port + 1)
+    assert manager.get_forwards(connection) == [f]
+    manager.cancel(connection, "localhost", port)
+    assert manager.get_forwards(connection) == []
+    assert wait(lambda: f.sock.fileno() == -1)
+    with pytest.raises(ConnectionRefusedError):
+        connect(port, "127.0.0.2")
+    assert manager.users == {}
+
+
+def test_limits(manager):
+    connection = Connection()
+    assert manager.add(connection, "localhost", 80) is False
+    first = manager.add(connection, "localhost", 0)
+    assert manager.add(connection, "localhost", 0)
+    # per user
+    assert manager.add(connection, "localhost", 0) is False
+    assert manager.add(Connection(username="other"), "localhost", 0)
+    # the port is taken
+    assert manager.add(Connection(username="third"), "localhost", first) is False
+    manager.cancel(connection, "localhost", first)
+    assert manager.add(connection, "localhost", 0)
+    manager.close_connection(connection)
+    assert manager.get_forwards(connection) == []
+    assert manager.users == {("i1", "other"): 1}
@@ -0,0 +1,84 @@
+"""
+Token buckets limiting connections and auth failures per remote address.
+"""
+import pytest
+import types
+from cae.channel.models import limiter
+from cae.channel.models.limiter import RateLimiter, parse_networks, is_exempt
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """
+    A clock the test moves, for the limiter module only.
+    """
+    now = [1000.0]
+    monkeypatch.setattr(limiter, "time", types.SimpleNamespace(monotonic=lambda: now[0]))
+    return now
+
+
+def test_burst_then_rate(clock):
+    rl = RateLimiter(rate=2, burst=3)
+    assert [rl.allow("a") for _ in range(4)] == [True, True, True, False]
+    # other addresses have their own bucket
+    assert rl.allow("b")
+    clock[0] += 0.5
+    assert rl.allow("a")
+    assert not rl.allow("a")
+    # refills up to the burst only
+    clock[0] += 60
+    assert [rl.allow("a") for _ in range(4)] == [True, True, True, False]
+    assert rl.stats() == {"keys": 2, "rejected": 3}
+
+
+def test_cost(clock):
+    rl = RateLimiter(rate=1, burst=10)
+    assert rl.allow("a", cost=8)
+    assert not rl.allow("a", cost=3)
+    assert rl.allow("a", cost=2)
+
+
+def test_failures_only_are_charged(clock):
+    rl = RateLimiter(rate=1, burst=2)
+    # never charged, never limited and no bucket is made
+    assert not rl.limited("a")
+    assert rl.stats()["keys"] == 0
+    rl.charge("a")
+    assert not rl.limited("a")
+    rl.charge("a")
+    rl.charge("a")
+    assert rl.limited("a")
+    # checking does not take a token
+    clock[0] += 1
+    assert not rl.limited("a")
+    assert not rl.limited("a")
+    assert rl.stats()["rejected"] == 1
+
+
+def test_prune_keeps_the_table_bounded(clock):
+    rl = RateLimiter(rate=1, burst=2, max_keys=4)
+    for key in "abcd":
+        rl.allow(key)
+    clock[0] += 10
+    # everyone refilled, the full buckets are dropped
+    rl.allow("e")
+    assert set(rl.buckets) == {"e"}
+    for key in "fgh":
+        rl.allow(key)
+        rl.allow(key)
+        clock[0] += 0.1
+    # nobody refilled, the oldest half goes
+    rl.allow("i")
+    assert set(rl.buckets) == {"g", "h", "i"}
+
+
+def test_exempt_networks():
+    networks = parse_networks(["10.1.0.0/16", " 192.168.1.7 ", "", "2001:db8::/32"])
+    assert is_exempt("10.1.200.3", networks)
+    assert is_exempt("192.168.1.7", networks)
+    assert is_exempt("::ffff:10.1.0.1", networks)
+    assert is_exempt("2001:db8::1", networks)
+    assert not is_exempt("192.168.1.8", networks)
+    assert not is_exempt("10.2.0.1", networks)
+    assert not is_exempt("not an address", networks)
+    assert not is_exempt("10.1.0.1", [])
@@ -0,0 +1,133 @@
+"""
+Pool of upstream ssh transports: reuse, eviction and reaping.
+"""
+import pytest
+import types
+from collections import OrderedDict
+from cae.config import channel_config as config
+from cae.channel.utils import ObjDict
+from cae.channel.models import proxy
+from cae.channel.models.proxy import SSHConnection
+
+
+class Transport:
+
+    def __init__(self):
+        self.active = True
+
+    def is_active(self):
+        return self.active
+
+
+class Connection(SSHConnection):
+    """
+    Connects without a network, remembers what was shut down.
+    """
+    connects = 0
+    closed = []
+
+    def connect(self):
+        Connection.connects += 1
+        self.transport = Transport()
+
+    def shutdown(self):
+        Connection.closed.append(self)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(proxy, "time", types.SimpleNamespace(monotonic=lambda: now[0]))
+    return now
+
+
+@pytest.fixture(autouse=True)
+def pool(monkeypatch):
+    monkeypatch.setattr(SSHConnection, "connections", OrderedDict())
+    for name in ("hits", "misses", "evicted"):
+        monkeypatch.setattr(SSHConnection, name, 0)
+    monkeypatch.setattr(Connection, "connects", 0)
+    monkeypatch.setattr(Connection, "closed", [])
+    monkeypatch.setitem(config, "SSH_POOL_SIZE", 3)
+    monkeypatch.setitem(config, "SSH_POOL_MAX_CHANNELS", 2)
+    monkeypatch.setitem(config, "SSH_POOL_IDLE_TIMEOUT", 300)
+
+
+def connect(ip="10.0.0.2", username="root", user="u1"):
+    return Connection.new_connection(ObjDict(username=user), ObjDict(ip=ip, ssh_port=22),
+                                     ObjDict(username=username))
+
+
+def test_channels_share_a_transport(clock):
+    a, b = connect(), connect()
+    assert a is b and a.ref == 2
+    # full, a second transport
+    c = connect()
+    assert c is not a
+    assert Connection.connects == 2
+    assert connect(user="u2") is not a
+    stats = Connection.stats()
+    assert (stats["transports"], stats["channels"], stats["hits"], stats["misses"]) == (3, 4, 1, 3)
+
+
+def test_released_transport_stays_warm(clock):
+    a = connect()
+    a.close()
+    assert a.ref == 0 and Connection.closed == []
+    assert Connection.stats()["idle"] == 1
+    assert connect() is a
+    assert Connection.connects == 1
+
+
+def test_dead_transport_is_not_reused(clock):
+    a = connect()
+    a.close()
+    a.transport.active = False
+    b = connect()
+    assert b is not a
+    assert Connection.stats()["transports"] == 1
+    # not pooled, the last channel closes it
+    b.close()
+    b.transport.active = False
+    b.close()
+    assert Connection.closed == [b]
+
+
+def test_least_recently_used_idle_is_evicted(clock):
+    conns = [connect(ip="10.0.0.{}".format(i)) for i in range(3)]
+    for conn in conns:
+        clock[0] += 1
+        conn.close()
+    # reusing the first makes the second the least recently used
+    assert connect(ip="10.0.0.0") is conns[0]
+    connect(ip="10.0.0.9")
+    assert Connection.closed == [conns[1]]
+    assert Connection.stats()["evicted"] == 1
+    # busy transports are never evicted, the pool grows past the size instead
+    for conn in (conns[0], conns[2]):
+        connect(ip=conn.asset.ip)
+    connect(ip="10.0.0.10")
+    assert Connection.closed == [conns[1]]
+    assert Connection.stats()["transports"] == 4
+
+
+def test_reap_idle_and_dead(clock):
+    idle, busy, dead = connect(ip="10.0.0.1"), connect(ip="10.0.0.2"), connect(ip="10.0.0.3")
+    idle.close()
+    dead.close()
+    dead.transport.active = False
+    Connection.reap()
+    assert Connection.closed == [dead]
+    clock[0] += 301
+    Connection.reap()
+    assert Connection.closed == [dead, idle]
+    assert Connection.stats()["transports"] == 1
+    assert busy.ref == 1
+
+
+def test_no_idle_timeout_closes_at_once(clock, monkeypatch):
+    monkeypatch.setitem(config, "SSH_POOL_IDLE_TIMEOUT", 0)
+    a = connect()
+    a.close()
+    assert Connection.closed == [a]
+    assert Connection.stats()["transports"] == 0
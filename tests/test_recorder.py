@@ -0,0 +1,122 @@
+"""
+asciinema recordings of pty sessions, written off the relay loop.
+"""
+import gzip
+import json
+import os
+import pytest
+import time
+import types
+from cae.config import channel_config as config
+from cae.channel.models.connections import Client
+from cae.channel.models.recorder import Recording, SessionRecorder
+
+
+@pytest.fixture
+def record_dir(tmp_path, monkeypatch):
+    monkeypatch.setitem(config, "RECORD_DIR", str(tmp_path))
+    monkeypatch.setitem(config, "RECORD_ENABLED", True)
+    monkeypatch.setitem(config, "RECORD_COMPRESS", "gzip")
+    monkeypatch.setitem(config, "RECORD_BATCH_INTERVAL", 0.01)
+    monkeypatch.setitem(config, "RECORD_FLUSH_INTERVAL", 0)
+    return tmp_path
+
+
+def session(sid="s1", pty=True):
+    client = Client(user={"instance_id": "i1", "username": "root"}, addr=("127.0.0.1", 0))
+    if pty:
+        client.request.meta.update({"term": "xterm", "width": 100, "height": 30})
+    return types.SimpleNamespace(id=sid, client=client)
+
+
+def read_cast(path):
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rb") as f:
+        header, *events = [json.loads(line) for line in f.read().decode().splitlines()]
+    return header, events
+
+
+def wait(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return predicate()
+
+
+def test_only_pty_sessions_when_enabled(record_dir, monkeypatch):
+    recorder = SessionRecorder()
+    assert recorder.new_recording(session(pty=False)) is None
+    monkeypatch.setitem(config, "RECORD_ENABLED", False)
+    assert recorder.new_recording(session()) is None
+    assert recorder.thread is None
+
+
+def test_cast(record_dir):
+    recording = Recording(session(), 100, 30, "xterm")
+    recording.event(10.0, "o", b"hello ")
+    # a character split across reads
+    recording.event(10.5, "o", "wörld".encode()[:2])
+    recording.event(10.75, "o", "wörld".encode()[2:])
+    recording.event(11.0, "r", (120, 40))
+    recording.event(11.5, "i", b"ls\r")
+    recording.close()
+    assert recording.path.endswith("s1.cast.gz")
+    header, events = read_cast(recording.path)
+    assert (header["version"], header["width"], header["height"]) == (2, 100, 30)
+    assert header["title"] == "root@i1" and header["env"] == {"TERM": "xterm"}
+    assert events == [[0.0, "o", "hello "], [0.5, "o", "w"], [0.75, "o", "örld"], [1.0, "r", "120x40"],
+                      [1.5, "i", "ls\r"]]
+
+
+def test_rotate(record_dir, monkeypatch):
+    monkeypatch.setitem(config, "RECORD_COMPRESS", "none")
+    monkeypatch.setitem(config, "RECORD_ROTATE_SIZE", 300)
+    recording = Recording(session(), 80, 24, "xterm")
+    for i in range(20):
+        recording.event(float(i), "o", b"x" * 40)
+        recording.commit()
+    recording.close()
+    parts = sorted(os.listdir(os.path.dirname(recording.path)))
+    assert parts[0] == "s1.1.cast" and parts[-1] == "s1.cast" and len(parts) > 2
+    events = []
+    for part in parts:
+        header, part_events = read_cast(os.path.join(os.path.dirname(recording.path), part))
+        # each part is a cast of its own, timed from its start
+        assert part_events[0][0] == 0.0
+        events += part_events
+    assert len(events) == 20
+
+
+def test_writer_thread(record_dir):
+    recorder = SessionRecorder()
+    recording = recorder.new_recording(session())
+    recorder.record(recording, "o", memoryview(bytearray(b"$ ")))
+    recorder.resize(recording, 90, 20)
+    recorder.record(recording, "o", b"ls\r\n")
+    recorder.stop(recording)
+    assert wait(lambda: recording.file is None and recorder.written == 3)
+    header, events = read_cast(recording.path)
+    assert [e[1:] for e in events] == [["o", "$ "], ["r", "90x20"], ["o", "ls\r\n"]]
+    assert recorder.stats()["recordings"] == 1
+
+
+def test_full_queue_drops(record_dir, monkeypatch):
+    monkeypatch.setitem(config, "RECORD_QUEUE_SIZE", 2)
+    recorder = SessionRecorder()
+    recording = Recording(session(), 80, 24, "xterm")
+    for _ in range(3):
+        recorder.record(recording, "o", b"abcd")
+    recorder.resize(recording, 90, 20)
+    stats = recorder.stats()
+    assert (stats["queued"], stats["dropped"], stats["dropped_bytes"]) == (2, 2, 4)
+
+
+def test_unwritable_dir_gives_up_the_recording(record_dir, monkeypatch):
+    monkeypatch.setitem(config, "RECORD_DIR", "/proc/no-such-dir")
+    recorder = SessionRecorder()
+    recording = recorder.new_recording(session())
+    recorder.record(recording, "o", b"a")
+    recorder.record(recording, "o", b"b")
+    recorder.stop(recording)
+    assert wait(lambda: recording.failed and recorder.queue.empty())
+    assert recorder.written == 0
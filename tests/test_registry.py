@@ -0,0 +1,119 @@
+"""
+The registry publishing live sessions and connections to the api.
+"""
+import importlib
+import pytest
+import threading
+import types
+from cae.channel.models.registry import SessionRegistry
+
+# the package exports the registry instance under the module's name
+registry_module = importlib.import_module("cae.channel.models.registry")
+
+
+class Session:
+
+    def __init__(self, sid):
+        self.id = sid
+        self.bytes_up = 0
+        self.bytes_down = 0
+        self.stop_evt = threading.Event()
+
+    def to_json(self):
+        return {"id": self.id, "bytes_up": self.bytes_up, "bytes_down": self.bytes_down}
+
+
+class Connection:
+
+    def __init__(self, cid):
+        self.id = cid
+
+    def to_json(self):
+        return {"id": self.id}
+
+
+@pytest.fixture
+def published(monkeypatch):
+    """
+    What each flush sent in its one pipeline, a flush fails while `down` is set.
+    """
+    state = types.SimpleNamespace(calls=[], down=threading.Event())
+
+    def publish_state(node, sessions, removed_sessions, connections, removed_connections, ttl):
+        if state.down.is_set():
+            raise ConnectionError("redis down")
+        state.calls.append((sessions, sorted(removed_sessions), connections, sorted(removed_connections)))
+
+    monkeypatch.setattr(registry_module, "session_model", types.SimpleNamespace(publish_state=publish_state))
+    return state
+
+
+def test_only_changes_are_sent(published):
+    registry = SessionRegistry()
+    a, b = Session("a"), Session("b")
+    registry.add_session(a)
+    registry.add_session(b)
+    registry.update_connection(Connection("c1"))
+    registry.flush()
+    sessions, _, connections, _ = published.calls[-1]
+    assert set(sessions) == {"a", "b"}
+    assert sessions["a"]["node"] == registry.node
+    assert set(connections) == {"c1"}
+    # nothing moved
+    registry.flush()
+    assert published.calls[-1] == ({}, [], {}, [])
+    # byte counters move without an event
+    a.bytes_down += 10
+    registry.flush()
+    assert list(published.calls[-1][0]) == ["a"]
+    assert published.calls[-1][0]["a"]["bytes_down"] == 10
+    registry.remove_session("b")
+    registry.remove_connection("c1")
+    registry.flush()
+    assert published.calls[-1] == ({}, ["b"], {}, ["c1"])
+    assert registry.stats()["flushes"] == 4
+
+
+def test_a_failed_flush_is_sent_again(published):
+    registry = SessionRegistry()
+    registry.add_session(Session("a"))
+    registry.add_session(Session("b"))
+    registry.update_connection(Connection("c1"))
+    registry.update_connection(Connection("c2"))
+    published.down.set()
+    registry.flush()
+    registry.remove_session("b")
+    registry.remove_connection("c2")
+    published.down.clear()
+    registry.flush()
+    sessions, removed_sessions, connections, removed_connections = published.calls[-1]
+    assert set(sessions) == {"a"}
+    assert removed_sessions == ["b"]
+    assert set(connections) == {"c1"}
+    assert removed_connections == ["c2"]
+    assert registry.stats()["errors"] == 1
+
+
+def test_readded_session_is_not_removed(published):
+    registry = SessionRegistry()
+    a = Session("a")
+    registry.add_session(a)
+    registry.remove_session("a")
+    registry.add_session(a)
+    registry.flush()
+    assert published.calls[-1][1] == []
+    # removing an unknown id sends nothing
+    registry.remove_session("x")
+    registry.remove_connection("x")
+    registry.flush()
+    assert published.calls[-1] == ({}, [], {}, [])
+
+
+def test_kill(published):
+    registry = SessionRegistry()
+    a = Session("a")
+    registry.add_session(a)
+    registry.kill("unknown")
+    registry.kill("a")
+    assert a.stop_evt.is_set()
+    assert registry.stats()["kills"] == 1
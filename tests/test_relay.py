@@ -0,0 +1,236 @@
+"""
+Relay loop isolation between sessions.
+
+Uses the in-process stand-ins of bench_relay, run with pytest where cae
+imports (the docker socket is reachable).
+"""
+import paramiko
+import pytest
+import socket
+import threading
+import time
+from bench_relay import Interface, ssh_pair, tcp_pair
+from cae.channel.models.connections import Client
+from cae.channel.models import exec, Session, relay_engine
+
+
+def throttle(src, dst, rate, stop):
+    """
+    Copy src to dst at about rate bytes a second.
+    """
+    while not stop.is_set():
+        try:
+            data = src.recv(4096)
+        except OSError:
+            return
+        if not data:
+            return
+        dst.sendall(data)
+        time.sleep(len(data) / rate)
+
+
+def pipe(src, dst, stop):
+    throttle(src, dst, float("inf"), stop)
+
+
+def slow_ssh_pair(host_key, rate, stop):
+    """
+    ssh user side behind a link of `rate` bytes a second towards the user.
+    :return (client side channel, server side channel)
+    """
+    relay_sock, relay_link = socket.socketpair()
+    user_link, user_sock = socket.socketpair()
+    for sock in (relay_sock, relay_link):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 16384)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 16384)
+    threading.Thread(target=throttle, args=(relay_link, user_link, rate, stop), daemon=True).start()
+    threading.Thread(target=pipe, args=(user_link, relay_link, stop), daemon=True).start()
+    server = paramiko.Transport(relay_sock)
+    server.add_server_key(host_key)
+    server.start_server(event=threading.Event(), server=Interface())
+    client = paramiko.Transport(user_sock)
+    client.connect(username="test", pkey=host_key)
+    chan = client.open_session()
+    return chan, server.accept(10)
+
+
+def new_session(user_chan, relay_chan, term):
+    client = Client(chan=relay_chan, addr=("127.0.0.1", 0))
+    client.request.meta.update({"width": 80, "height": 24})
+    if term:
+        client.request.meta["term"] = "xterm"
+    near, far = tcp_pair()
+    server = exec.Server(chan=near, asset={}, system_user={}, container=None, exec_id=None)
+    session = Session.new_session(client, server, kind="exec")
+    session.bridge()
+    return session, far
+
+
+def test_slow_client_does_not_stall_other_sessions(monkeypatch):
+    relay_engine.start()
+    monkeypatch.setattr(relay_engine, "loops", relay_engine.loops[:1])
+    host_key = paramiko.RSAKey.generate(2048)
+    stop = threading.Event()
+    # a 200 KB/s client downloading as fast as the far end writes
+    slow_user, slow_relay = slow_ssh_pair(host_key, 200 * 1024, stop)
+    slow, slow_far = new_session(slow_user, slow_relay, term=False)
+    # an interactive session on the same relay loop
+    fast_user, fast_relay = slow_ssh_pair(host_key, float("inf"), stop)
+    fast, fast_far = new_session(fast_user, fast_relay, term=True)
+    assert slow.loop is fast.loop
+
+    def flood():
+        payload = b"x" * 65536
+        try:
+            while not stop.is_set():
+                slow_far.sendall(payload)
+        except OSError:
+            pass
+
+    def echo():
+        while not stop.is_set():
+            data = fast_far.recv(4096)
+            if not data:
+                return
+            fast_far.sendall(data)
+
+    threading.Thread(target=flood, daemon=True).start()
+    threading.Thread(target=echo, daemon=True).start()
+    # let the slow link and its buffers fill up
+    time.sleep(1)
+    latencies = []
+    try:
+        for _ in range(50):
+            start = time.perf_counter()
+            fast_user.sendall(b"a")
+            assert fast_user.recv(1) == b"a"
+            latencies.append(time.perf_counter() - start)
+            time.sleep(0.01)
+    finally:
+        stop.set()
+        for session in (slow, fast):
+            session.stop_evt.set()
+            Session.remove_session(session.id)
+        # the stalled link would block closing the channels on collection
+        for chan in (slow_user, slow_relay, fast_user, fast_relay):
+            chan.get_transport().close()
+    latencies.sort()
+    assert latencies[len(latencies) // 2] < 0.05
+    assert latencies[-1] < 0.5
+
+
+def test_exec_stderr_is_relayed_before_eof():
+    host_key = paramiko.RSAKey.generate(2048)
+    user_chan, relay_chan = ssh_pair(host_key, host_key)
+    near, far = ssh_pair(host_key, host_key)
+    client = Client(chan=relay_chan, addr=("127.0.0.1", 0))
+    server = exec.Server(chan=near, asset={}, system_user={}, container=None, exec_id=None)
+    session = Session.new_session(client, server, kind="exec", command="cmd")
+    # as ExecServer.finish closes the user's channel after the exit status
+    session.on_finish(lambda session: relay_chan.close())
+    session.bridge()
+    payload = bytes(range(256)) * 4096
+    # hold the relay loop so all of it is buffered by the time it reads
+    session.loop.call(time.sleep, 0.5)
+    far.sendall_stderr(payload)
+    far.sendall(b"done")
+    far.close()
+    user_chan.settimeout(10)
+    received = []
+    while True:
+        data = user_chan.recv_stderr(65536)
+        if not data:
+            break
+        received.append(data)
+    try:
+        assert b"".join(received) == payload
+    finally:
+        session.stop_evt.set()
+        Session.remove_session(session.id)
+
+
+def hold_loops(seconds):
+    """
+    Keep every relay loop busy, what is queued meanwhile runs afterwards.
+    """
+    relay_engine.start()
+    for loop in relay_engine.loops:
+        loop.call(time.sleep, seconds)
+
+
+def socket_session(pair=None):
+    near, user = pair or tcp_pair()
+    server, far = tcp_pair()
+    client = Client(chan=near, addr=("127.0.0.1", 0))
+    session = Session.new_session(client, exec.Server(chan=server, asset={}, system_user={}, container=None,
+                                                      exec_id=None), kind="exec")
+    finished = threading.Event()
+    session.on_finish(lambda session: finished.set())
+    return session, user, far, finished
+
+
+def test_stop_before_the_loop_adds():
+    session, user, far, finished = socket_session()
+    hold_loops(0.3)
+    sessions = sum(loop.sessions for loop in relay_engine.loops)
+    session.bridge()
+    session.stop_evt.set()
+    assert finished.wait(5)
+    assert session.is_finished
+    assert sum(loop.sessions for loop in relay_engine.loops) == sessions
+    assert all(session.client.chan.fileno() not in loop.sel.get_map() for loop in relay_engine.loops)
+    Session.remove_session(session.id)
+
+
+def test_stop_before_bridge():
+    session, user, far, finished = socket_session()
+    session.stop_evt.set()
+    assert finished.wait(5)
+    session.bridge()
+    assert session.loop is None
+    assert session.recording is None and session.shaping is None
+    Session.remove_session(session.id)
+
+
+def test_failed_add_finishes_the_session(monkeypatch):
+    relay_engine.start()
+
+    def register(session):
+        raise ValueError("no endpoints")
+
+    for loop in relay_engine.loops:
+        monkeypatch.setattr(loop, "register", register)
+    session, user, far, finished = socket_session()
+    session.bridge()
+    assert finished.wait(5)
+    assert session.is_finished
+    Session.remove_session(session.id)
+
+
+def test_reused_fd_replaces_the_stale_endpoint(monkeypatch):
+    relay_engine.start()
+    monkeypatch.setattr(relay_engine, "loops", relay_engine.loops[:1])
+    old, old_user, old_far, old_finished = socket_session()
+    old.bridge()
+    old_user.sendall(b"ping")
+    assert old_far.recv(4) == b"ping"
+    listener = socket.create_server(("127.0.0.1", 0))
+    # closed behind the loop's back, the next socket gets its number
+    hold_loops(0.3)
+    fd = old.client.chan.fileno()
+    old.client.chan.close()
+    near = socket.create_connection(listener.getsockname())
+    user, _ = listener.accept()
+    listener.close()
+    if near.fileno() != fd:
+        pytest.skip("fd {} was not reused".format(fd))
+    session, user, far, finished = socket_session((near, user))
+    session.bridge()
+    assert old_finished.wait(5)
+    user.sendall(b"ping")
+    assert far.recv(4) == b"ping"
+    assert not finished.is_set()
+    session.stop_evt.set()
+    assert finished.wait(5)
+    for s in (old, session):
+        Session.remove_session(s.id)
@@ -0,0 +1,216 @@
+"""
+sftp for sshd-less containers against a stand-in container.
+
+The container is a local directory tree, `docker exec` runs the command
+on this host as the user and the archive api tars the tree as root, the
+way docker does. Switching users needs root.
+"""
+import base64
+import io
+import json
+import os
+import pytest
+import subprocess
+import tarfile
+import tempfile
+from docker.errors import NotFound
+from docker.models.containers import ExecResult
+from paramiko import SFTP_OK, SFTP_FAILURE, SFTP_NO_SUCH_FILE, SFTP_PERMISSION_DENIED
+from cae.config import channel_config as config
+from cae.channel.models.sftp import ContainerSFTPInterface, ArchiveWriter, IterStream, parse_time
+
+pytestmark = pytest.mark.skipif(os.geteuid() != 0, reason="runs commands as another user")
+
+ROOT = {"username": "root", "uid": "0", "gid": "0", "home": "/root"}
+NOBODY = {"username": "nobody", "uid": "65534", "gid": "65534", "home": "/"}
+
+
+class Response:
+
+    def __init__(self, data):
+        self.data = data
+        self.closed = False
+
+    def iter_content(self, chunk_size, decode):
+        for i in range(0, len(self.data), chunk_size):
+            yield self.data[i:i + chunk_size]
+
+    def close(self):
+        self.closed = True
+
+
+class API:
+    """
+    The archive endpoints of the docker api, as root.
+    """
+
+    def __init__(self):
+        self.responses = []
+
+    def _url(self, path, container_id):
+        return path
+
+    def _raise_for_status(self, res):
+        pass
+
+    def _get_raw_response_socket(self, res):
+        return None
+
+    def _disable_socket_timeout(self, sock):
+        pass
+
+    def _get(self, url, params, stream):
+        path = params["path"]
+        if not os.path.lexists(path):
+            raise NotFound(path)
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode="w") as tar:
+            tar.add(path, arcname=os.path.basename(path))
+        res = Response(buf.getvalue())
+        self.responses.append(res)
+        return res
+
+    def head(self, url, params):
+        path = params["path"]
+        if not os.path.lexists(path):
+            raise NotFound(path)
+        st = os.lstat(path)
+        mode = st.st_mode & 0o777 | (1 << 31 if os.path.isdir(path) else 0)
+        info = {"name": os.path.basename(path), "size": st.st_size, "mode": mode,
+                "mtime": "2024-01-02T03:04:05.123456789Z", "linkTarget": ""}
+        header = base64.b64encode(json.dumps(info).encode()).decode()
+        return type("Response", (), {"headers": {"x-docker-container-path-stat": header}})()
+
+
+class Container:
+    id = "container"
+
+    def __init__(self):
+        self.client = type("DockerClient", (), {"api": API()})()
+
+    def exec_run(self, cmd, user, demux):
+        proc = subprocess.run(cmd, user=user, capture_output=True)
+        return ExecResult(proc.returncode, (proc.stdout or None, proc.stderr or None))
+
+    def put_archive(self, path, data):
+        with tarfile.open(fileobj=io.BytesIO(b"".join(data))) as tar:
+            tar.extractall(path)
+        return True
+
+
+@pytest.fixture
+def tree():
+    """
+    root/public/file 0644 and root/private/known_hosts 0644 under a 0700 dir
+    """
+    root = tempfile.mkdtemp()
+    os.chmod(root, 0o755)
+    for name, mode in (("public", 0o755), ("private", 0o700)):
+        os.mkdir(os.path.join(root, name), mode)
+    for path in ("public/file", "private/known_hosts"):
+        with open(os.path.join(root, path), "w") as f:
+            f.write("content of {}\n".format(path))
+        os.chmod(os.path.join(root, path), 0o644)
+    yield root
+    subprocess.run(["rm", "-rf", root])
+
+
+def sftp(userinfo):
+    return ContainerSFTPInterface(None, Container(), userinfo)
+
+
+def test_parse_time_rfc3339_nano():
+    assert parse_time("2024-01-02T03:04:05Z") == 1704164645
+    assert parse_time("2024-01-02T03:04:05.1234Z") == 1704164645
+    assert parse_time("2024-01-02T03:04:05.123456789Z") == 1704164645
+    assert parse_time("2024-01-02T05:04:05.5+02:00") == 1704164645
+    assert parse_time("2024-01-01T22:04:05-05:00") == 1704164645
+    assert parse_time("") == 0
+    assert parse_time(None) == 0
+    assert parse_time("yesterday") == 0
+
+
+def test_user_reads_what_they_may(tree):
+    fs = sftp(NOBODY)
+    handle = fs.open(os.path.join(tree, "public/file"), os.O_RDONLY, None)
+    assert handle.read(0, 100) == b"content of public/file\n"
+    handle.close()
+    attr = fs.stat(os.path.join(tree, "public/file"))
+    assert attr.st_size == len("content of public/file\n")
+    assert attr.st_mtime == 1704164645
+    assert fs.stat(os.path.join(tree, "public/missing")) == SFTP_NO_SUCH_FILE
+
+
+def test_user_can_not_read_below_a_private_dir(tree):
+    # the file itself is 0644, its directory is root's 0700
+    path = os.path.join(tree, "private/known_hosts")
+    fs = sftp(NOBODY)
+    assert fs.open(path, os.O_RDONLY, None) == SFTP_PERMISSION_DENIED
+    assert fs.stat(path) == SFTP_PERMISSION_DENIED
+    assert fs.lstat(path) == SFTP_PERMISSION_DENIED
+    assert fs.readlink(path) == SFTP_PERMISSION_DENIED
+    assert fs.walk_folder(os.path.join(tree, "private")) == SFTP_PERMISSION_DENIED
+    assert fs.open(path, os.O_RDWR, None) == SFTP_PERMISSION_DENIED
+    assert fs.container.client.api.responses == []
+    # root still can
+    fs = sftp(ROOT)
+    handle = fs.open(path, os.O_RDONLY, None)
+    assert handle.read(0, 100) == b"content of private/known_hosts\n"
+    handle.close()
+    assert set(fs.walk_folder(os.path.join(tree, "private"))) == {"known_hosts"}
+
+
+def test_user_can_not_list_a_private_dir(tree):
+    fs = sftp(NOBODY)
+    assert fs.list_folder(os.path.join(tree, "private")) == SFTP_PERMISSION_DENIED
+    assert [a.filename for a in fs.list_folder(os.path.join(tree, "public"))] == ["file"]
+    # root's listing is not served to the user
+    assert [a.filename for a in sftp(ROOT).list_folder(os.path.join(tree, "private"))] == ["known_hosts"]
+    assert fs.stat(os.path.join(tree, "private/known_hosts")) == SFTP_PERMISSION_DENIED
+
+
+def test_open_write_without_create(tree):
+    fs = sftp(ROOT)
+    path = os.path.join(tree, "public/new")
+    assert fs.open(path, os.O_WRONLY, None) == SFTP_NO_SUCH_FILE
+    handle = fs.open(path, os.O_WRONLY | os.O_CREAT, None)
+    assert handle.write(0, b"new\n") == SFTP_OK
+    handle.close()
+    with open(path) as f:
+        assert f.read() == "new\n"
+
+
+def test_archive_responses_are_closed(tree):
+    fs = sftp(ROOT)
+    handle = fs.open(os.path.join(tree, "public/file"), os.O_RDONLY, None)
+    assert handle.read(8, 6) == b"of pub"
+    # reading behind reopens the stream
+    assert handle.read(0, 7) == b"content"
+    handle.close()
+    assert fs.open(os.path.join(tree, "public"), os.O_RDONLY, None) == SFTP_FAILURE
+    responses = fs.container.client.api.responses
+    assert len(responses) == 3
+    assert all(res.closed for res in responses)
+
+
+def test_upload_limit(tree, monkeypatch):
+    monkeypatch.setitem(config, "SFTP_UPLOAD_MAX", 10)
+    fs = sftp(ROOT)
+    path = os.path.join(tree, "public/big")
+    handle = fs.open(path, os.O_WRONLY | os.O_CREAT, None)
+    assert isinstance(handle, ArchiveWriter)
+    assert handle.write(0, b"12345") == SFTP_OK
+    assert handle.write(5, b"123456") == SFTP_FAILURE
+    assert handle.write(0, b"1") == SFTP_FAILURE
+    handle.close()
+    # dropped, not committed truncated
+    assert not os.path.exists(path)
+
+
+def test_iter_stream():
+    data = bytes(range(256)) * 1000
+    chunks = [data[i:i + 1000] for i in range(0, len(data), 1000)]
+    stream = io.BufferedReader(IterStream(iter(chunks)), 4096)
+    assert stream.read(10) == data[:10]
+    assert stream.read() == data[10:]
+    assert stream.read() == b""
@@ -0,0 +1,125 @@
+"""
+Bandwidth token buckets shared by the sessions of an instance and user.
+"""
+import pytest
+import types
+from cae.config import channel_config as config
+from cae.channel.utils import ObjDict
+from cae.channel.models import shaper as shaper_module
+from cae.channel.models.connections import Client
+from cae.channel.models.shaper import BandwidthShaper, TokenBucket
+
+MB = 1024 * 1024
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(shaper_module, "time", types.SimpleNamespace(monotonic=lambda: now[0]))
+    return now
+
+
+@pytest.fixture
+def limits(monkeypatch):
+    monkeypatch.setitem(config, "BANDWIDTH_GLOBAL", 8 * MB)
+    monkeypatch.setitem(config, "BANDWIDTH_INSTANCE", 2 * MB)
+    monkeypatch.setitem(config, "BANDWIDTH_USER", 0)
+    monkeypatch.setitem(config, "BANDWIDTH_PTY_RESERVE", 0.25)
+    monkeypatch.setattr(shaper_module.container_cache, "entries", {})
+    return shaper_module.container_cache.entries
+
+
+def session(instance_id="i1", username="root", pty=False):
+    client = Client(user={"instance_id": instance_id, "username": username}, addr=("127.0.0.1", 0))
+    if pty:
+        client.request.meta["term"] = "xterm"
+    return types.SimpleNamespace(client=client)
+
+
+def test_token_bucket(clock):
+    bucket = TokenBucket(MB)
+    assert bucket.burst == int(MB * config["BANDWIDTH_BURST"])
+    assert bucket.available(clock[0]) == bucket.burst
+    # a read may overdraw
+    bucket.consume(bucket.burst + 1000)
+    assert bucket.available(clock[0]) == -1000
+    clock[0] += 0.1
+    assert bucket.available(clock[0]) == pytest.approx(MB * 0.1 - 1000)
+    clock[0] += 60
+    assert bucket.available(clock[0]) == bucket.burst
+
+
+def test_low_rates_still_fit_a_read():
+    assert TokenBucket(1000).burst == config["BANDWIDTH_MIN_READ"] * 4
+
+
+def test_unlimited_sessions_are_not_shaped(monkeypatch):
+    for key in ("BANDWIDTH_GLOBAL", "BANDWIDTH_INSTANCE", "BANDWIDTH_USER"):
+        monkeypatch.setitem(config, key, 0)
+    assert BandwidthShaper().attach(session()) is None
+
+
+def test_sessions_share_buckets(limits, clock):
+    shaper = BandwidthShaper()
+    a, b = shaper.attach(session()), shaper.attach(session(username="other"))
+    other = shaper.attach(session(instance_id="i2"))
+    assert [key for key, _, _ in a.buckets] == ["global", "instance/i1"]
+    assert a.buckets[1][1] is b.buckets[1][1]
+    assert other.buckets[1][1] is not a.buckets[1][1]
+    assert a.buckets[0][1] is other.buckets[0][1]
+    instance = a.buckets[1][1]
+    allowance = a.allowance()
+    a.consume(allowance)
+    assert instance.available(clock[0]) == instance.burst - allowance
+    assert b.allowance() == a.allowance()
+    # a bucket goes with its last session
+    shaper.detach(a)
+    assert "instance/i1" in shaper.buckets
+    shaper.detach(b)
+    assert "instance/i1" not in shaper.buckets
+    shaper.detach(other)
+    assert shaper.buckets == {}
+    assert shaper.stats()["shaped_sessions"] == 3
+
+
+def test_pty_sessions_keep_a_global_reserve(limits, clock, monkeypatch):
+    monkeypatch.setitem(config, "BANDWIDTH_GLOBAL", MB)
+    monkeypatch.setitem(config, "BANDWIDTH_INSTANCE", 0)
+    shaper = BandwidthShaper()
+    bulk, pty = shaper.attach(session(instance_id="i2")), shaper.attach(session(pty=True))
+    burst = shaper.buckets["global"].burst
+    bulk_reserve = dict((key, reserve) for key, _, reserve in bulk.buckets)["global"]
+    assert bulk_reserve == burst * 0.25
+    assert all(reserve == 0 for _, _, reserve in pty.buckets)
+    # bulk drains the global bucket down to the reserve
+    bulk.consume(bulk.allowance())
+    assert bulk.allowance() <= 0
+    assert pty.allowance() > 0
+    assert pty.min_read() == 1
+    assert bulk.min_read() == config["BANDWIDTH_MIN_READ"]
+    # until the global bucket refilled past reserve and one read
+    assert bulk.delay() == pytest.approx(config["BANDWIDTH_MIN_READ"] / MB, rel=0.01)
+
+
+def test_instance_label(limits, clock):
+    shaper = BandwidthShaper()
+    limits["i1"] = ObjDict(container=types.SimpleNamespace(labels={"cae.bandwidth": str(MB)}))
+    assert dict(shaper.limits(session()))["instance/i1"] == MB
+    # a malformed label falls back to BANDWIDTH_INSTANCE
+    limits["i1"].container.labels["cae.bandwidth"] = "1M"
+    assert dict(shaper.limits(session()))["instance/i1"] == 2 * MB
+    # "0" lifts the instance limit
+    limits["i1"].container.labels["cae.bandwidth"] = "0"
+    assert [key for key, _ in shaper.limits(session())] == ["global"]
+
+
+def test_changed_rate_gets_a_new_bucket(limits, monkeypatch):
+    shaper = BandwidthShaper()
+    old = shaper.attach(session())
+    monkeypatch.setitem(config, "BANDWIDTH_INSTANCE", MB)
+    new = shaper.attach(session())
+    assert new.buckets[1][1].rate == MB
+    assert old.buckets[1][1].rate == 2 * MB
+    # the old session's detach leaves the new bucket alone
+    shaper.detach(old)
+    assert shaper.buckets["instance/i1"] is new.buckets[1][1]
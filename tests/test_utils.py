@@ -0,0 +1,90 @@
+"""
+Prompt input of the channel against a scripted client.
+"""
+import pytest
+from cae.channel.utils import LineEditor, net_input, parser_public_key
+
+
+class Client:
+    """
+    Hands out one scripted recv at a time and keeps what was echoed.
+    """
+
+    def __init__(self, *reads):
+        self.reads = list(reads)
+        self.sent = b""
+        self.closed = False
+        self.line_editor = None
+
+    def recv(self, size):
+        return self.reads.pop(0) if self.reads else b""
+
+    def send(self, data):
+        self.sent += data
+        return len(data)
+
+    def send_unicode(self, s):
+        self.send(s.encode())
+
+    @property
+    def echo(self):
+        return self.sent.decode()
+
+
+def test_backspace_and_kill_line():
+    client = Client(b"ab\x7fc\x08\x08\x08d\r")
+    assert LineEditor(client).readline() == "d"
+    # the third backspace hits an empty line and rings
+    assert client.echo == "ab\x08\x1b[Kc" + "\x08\x1b[K" * 2 + "\x07d\r\n"
+    client = Client(b"abc\x15xy\r")
+    assert LineEditor(client).readline() == "xy"
+    assert client.echo == "abc\x08\x08\x08\x1b[Kxy\r\n"
+
+
+def test_escape_sequences_are_dropped():
+    # arrows (CSI), F1 (SS3), a CSI with params and alt-x
+    client = Client(b"a\x1b[Db\x1bOPc\x1b[1;5Cd\x1bxe\r")
+    assert LineEditor(client).readline() == "abcde"
+    assert client.echo == "abcde\r\n"
+
+
+def test_escape_split_across_reads():
+    client = Client(b"a\x1b", b"[", b"Ab\r")
+    assert LineEditor(client).readline() == "ab"
+
+
+def test_sensitive_echo():
+    client = Client(b"s3cr\xc3\xa9t\r")
+    assert LineEditor(client).readline(sensitive=True) == "s3crét"
+    assert client.echo == "******\r\n"
+
+
+def test_type_ahead_is_kept_for_the_next_line():
+    client = Client(b"first\r\nsecond\rthird", b"\n")
+    editor = LineEditor(client)
+    assert editor.readline() == "first"
+    assert editor.readline() == "second"
+    assert editor.readline() == "third"
+    assert editor.readline() is None
+
+
+def test_ctrl_c_and_ctrl_d():
+    client = Client(b"abc\x03x\r")
+    assert LineEditor(client).readline("Opt> ") == "x"
+    assert "^C\r\nOpt> " in client.echo
+    with pytest.raises(EOFError):
+        LineEditor(Client(b"\x04")).readline()
+
+
+def test_net_input_keeps_type_ahead_across_prompts():
+    client = Client(b"1\r2\r")
+    assert net_input(client) == "1"
+    assert net_input(client, sensitive=True) == "2"
+    assert net_input(client) is None
+
+
+def test_parser_public_key():
+    assert parser_public_key("AAAAC3Nza") == "AAAAC3Nza"
+    assert parser_public_key("ssh-ed25519 AAAAC3Nza") == "AAAAC3Nza"
+    assert parser_public_key("ssh-ed25519  AAAAC3Nza user@host\n") == "AAAAC3Nza"
+    assert parser_public_key(" ") == ""